@@ -1,8 +1,11 @@
 from core.args import parse, config, get_model_provider, get_memorystore_provider, get_vision_provider
-from core.logging import get_logger
+from core.logging import get_logger, setup_logging, stop_logging
+from core.sharding import ShardSupervisor, get_shard_count
+from core.sharedstore import get_shared_store
 from client.bot import TerminalBot, TwitterBot, DiscordBot
 
 import sys
+import asyncio
 import traceback
 
 logger = get_logger(__name__)
@@ -15,11 +18,152 @@ def get_key(dictionary, key, required=True, default=None):
     else:
         return default
 
+def get_discord_bot(chatbot_config, model_provider, memory_store_provider, memory_store_args, vision_provider, shard_ids=None, shard_count=None, close_provider=True):
+    return DiscordBot(
+        name=chatbot_config['name'],
+        prompt=chatbot_config['prompt'],
+        model_provider=model_provider,
+        memory_store_provider=memory_store_provider,
+        vision_provider=vision_provider,
+        bearer_token=get_key(chatbot_config['client_args'], 'bearer_token'),
+        priority_channel=get_key(chatbot_config['client_args'], 'priority_channel'),
+        conditional_response=get_key(chatbot_config['client_args'], 'conditional_response', required=False, default=True),
+        idle_messaging=get_key(chatbot_config['client_args'], 'idle_messaging', required=False, default=False),
+        idle_messaging_interval=get_key(chatbot_config['client_args'], 'idle_messaging_interval', required=False, default=100),
+        nicknames=get_key(chatbot_config['client_args'], 'nicknames'),
+        status=get_key(chatbot_config['client_args'], 'status', required=False, default=None),
+        context_size=get_key(chatbot_config['client_args'], 'context_size', required=False, default=924),
+        tokenizer=get_key(chatbot_config['client_args'], 'tokenizer', required=False, default='gpt2'),
+        history_size=get_key(chatbot_config['client_args'], 'history_size', required=False, default=40),
+        max_concurrent_responses=get_key(chatbot_config['client_args'], 'max_concurrent_responses', required=False, default=4),
+        logging_channel=get_key(chatbot_config['client_args'], 'logging_channel', required=False, default=None),
+        private_role_id=get_key(chatbot_config['client_args'], 'private_role_id', required=False, default=None),
+        anonymous_role_id=get_key(chatbot_config['client_args'], 'anonymous_role_id', required=False, default=None),
+        mem_args = memory_store_args,
+        supporter_guild_id = get_key(chatbot_config['client_args'], 'supporter_guild_id', required=False, default=None),
+        supporter_role_ids = get_key(chatbot_config['client_args'], 'supporter_role_ids', required=False, default=None),
+        public = get_key(chatbot_config['client_args'], 'public', required=False, default=False),
+        rate_limit = get_key(chatbot_config['client_args'], 'rate_limit', required=False, default=False),
+        rate_limits = get_key(chatbot_config['client_args'], 'rate_limits', required=False, default={'channel': {'max_calls': 5, 'period': 80.0}}),
+        supporter_rate_limits = get_key(chatbot_config['client_args'], 'supporter_rate_limits', required=False, default=None),
+        prefilter = get_key(chatbot_config['client_args'], 'prefilter', required=False, default=None),
+        prefetch = get_key(chatbot_config['client_args'], 'prefetch', required=False, default=None),
+        # opt-in, every streamed chunk prefills the whole prompt again on the model server
+        streaming = get_key(chatbot_config['client_args'], 'streaming', required=False, default=None),
+        sharding = get_key(chatbot_config['client_args'], 'sharding', required=False, default=None),
+        shard_ids = shard_ids,
+        shard_count = shard_count,
+        close_provider = close_provider
+    )
+
+def run_shards(path, shard_ids, shard_count):
+    # entry point of a shard worker process
+    chatbot_config = config(path)
+    # every worker writes its own file, rotating one file from several processes isn't safe
+    setup_logging(chatbot_config.get('logging', None), suffix=f'shards-{shard_ids[0]}')
+    bot = None
+    exit_code = 0
+    try:
+        model_provider = get_model_provider(chatbot_config)
+        memory_store_provider, memory_store_args = get_memorystore_provider(chatbot_config)
+        if memory_store_args is not None and memory_store_args['index_refresh_interval'] is None:
+            # the other workers write to the same store, their memories are read back once a minute
+            memory_store_args['index_refresh_interval'] = 60.0
+        vision_provider = get_vision_provider(chatbot_config)
+        bot = get_discord_bot(chatbot_config, model_provider, memory_store_provider, memory_store_args, vision_provider, shard_ids=shard_ids, shard_count=shard_count)
+        logger.info(f'Starting {chatbot_config["name"]} with Discord as the client - Shards: {shard_ids}/{shard_count}')
+        bot.run()
+    except KeyboardInterrupt:
+        exit_code = 0
+    except Exception as e:
+        logger.error(e)
+        logger.error(traceback.format_exc())
+        exit_code = 1
+    finally:
+        if bot is not None:
+            bot.close()
+        # forked workers exit without running atexit
+        stop_logging()
+        sys.exit(exit_code)
+
+def supervise(path, chatbot_config):
+    # spread the shards of one bot over several processes on this host
+    sharding = chatbot_config['client_args']['sharding']
+    shard_count = sharding.get('shard_count', None)
+    if shard_count is None:
+        shard_count = get_shard_count(chatbot_config['client_args']['bearer_token'])
+        logger.info(f'Using the recommended shard count: {shard_count}')
+    supervisor = ShardSupervisor(
+        run_shards,
+        (path,),
+        shard_count=shard_count,
+        processes=sharding['processes'],
+        store=get_shared_store(sharding.get('store', 'shared.db')),
+        report_interval=sharding.get('report_interval', 30.0)
+    )
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        print('Exiting...')
+    logger.info('Exiting...')
+
+def host(paths):
+    # every persona gets its own bot, prompt, limits and gensettings, while configs
+    # with the same model endpoints share one connection pool and configs with
+    # the same database share one memory store provider
+    configs = [config(path) for path in paths]
+    setup_logging(configs[0].get('logging', None))
+    for chatbot_config in configs:
+        if chatbot_config['client'] != 'discord':
+            raise Exception('only discord configs can be hosted together')
+        if (chatbot_config['client_args'].get('sharding', None) or {}).get('processes', 1) > 1:
+            raise Exception('configs sharded over several processes have to be run on their own')
+
+    # pycord binds the client to the current event loop when it is created
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    model_pools = {}
+    memory_stores = {}
+    bots = []
+    exit_code = 0
+    try:
+        for chatbot_config in configs:
+            logger.info('Getting providers for %s...'%chatbot_config['name'])
+            model_provider = get_model_provider(chatbot_config, shared=model_pools)
+            memory_store_provider, memory_store_args = get_memorystore_provider(chatbot_config, shared=memory_stores)
+            vision_provider = get_vision_provider(chatbot_config)
+            bots.append(get_discord_bot(chatbot_config, model_provider, memory_store_provider, memory_store_args, vision_provider, close_provider=False))
+        logger.info(f'Starting {len(bots)} personas with Discord as the client - Model connection pools: {len(model_pools)} - Memory stores: {len(memory_stores)}')
+        loop.run_until_complete(asyncio.gather(*[bot.start() for bot in bots]))
+    except KeyboardInterrupt:
+        print('Exiting...')
+        exit_code = 0
+    except Exception as e:
+        logger.error(e)
+        logger.error(traceback.format_exc())
+        exit_code = 1
+    finally:
+        logger.info('Exiting...')
+        loop.run_until_complete(asyncio.gather(*[bot.client.close() for bot in bots], return_exceptions=True))
+        # every persona has drained its memory queue, nothing uses the shared pools anymore
+        loop.run_until_complete(asyncio.gather(*[bot.model_provider.close() for bot in bots if hasattr(bot.model_provider, 'close')], return_exceptions=True))
+        loop.close()
+        sys.exit(exit_code)
+
 def main():
     logger.info('Initializing ELIZA...')
 
     logger.info('Loading config...')
-    chatbot_config = config(parse())
+    paths = parse().config
+    if len(paths) > 1:
+        host(paths)
+        return
+    chatbot_config = config(paths[0])
+    setup_logging(chatbot_config.get('logging', None))
+    if chatbot_config['client'] == 'discord' and (chatbot_config['client_args'].get('sharding', None) or {}).get('processes', 1) > 1:
+        supervise(paths[0], chatbot_config)
+        return
     bot = None
     exit_code = 0
     try:
@@ -33,29 +177,7 @@ def main():
             logger.info('Starting %s with the terminal as the client...'%chatbot_config['name'])
             bot.run()
         elif chatbot_config['client'] == 'discord':
-            bot = DiscordBot(
-                name=chatbot_config['name'],
-                prompt=chatbot_config['prompt'],
-                model_provider=model_provider,
-                memory_store_provider=memory_store_provider,
-                vision_provider=vision_provider,
-                bearer_token=get_key(chatbot_config['client_args'], 'bearer_token'),
-                priority_channel=get_key(chatbot_config['client_args'], 'priority_channel'),
-                conditional_response=get_key(chatbot_config['client_args'], 'conditional_response', required=False, default=True),
-                idle_messaging=get_key(chatbot_config['client_args'], 'idle_messaging', required=False, default=False),
-                idle_messaging_interval=get_key(chatbot_config['client_args'], 'idle_messaging_interval', required=False, default=100),
-                nicknames=get_key(chatbot_config['client_args'], 'nicknames'),
-                status=get_key(chatbot_config['client_args'], 'status', required=False, default=None),
-                context_size=get_key(chatbot_config['client_args'], 'context_size', required=False, default=924),
-                logging_channel=get_key(chatbot_config['client_args'], 'logging_channel', required=False, default=None),
-                private_role_id=get_key(chatbot_config['client_args'], 'private_role_id', required=False, default=None),
-                anonymous_role_id=get_key(chatbot_config['client_args'], 'anonymous_role_id', required=False, default=None),
-                mem_args = memory_store_args,
-                supporter_guild_id = get_key(chatbot_config['client_args'], 'supporter_guild_id', required=False, default=None),
-                supporter_role_ids = get_key(chatbot_config['client_args'], 'supporter_role_ids', required=False, default=None),
-                public = get_key(chatbot_config['client_args'], 'public', required=False, default=False),
-                rate_limit = get_key(chatbot_config['client_args'], 'rate_limit', required=False, default=False)
-            )
+            bot = get_discord_bot(chatbot_config, model_provider, memory_store_provider, memory_store_args, vision_provider)
             logger.info('Starting %s with Discord as the client...'%chatbot_config['name'])
             bot.run()
         elif chatbot_config['client'] == 'twitter':
@@ -68,7 +190,16 @@ def main():
                 access_token=chatbot_config['client_args']['access_token'],
                 access_token_secret=chatbot_config['client_args']['access_token_secret'],
                 username=chatbot_config['client_args']['username'],
-                tweet_example=chatbot_config['client_args']['tweet_example']
+                tweet_example=chatbot_config['client_args']['tweet_example'],
+                conversation_cache_size=get_key(chatbot_config['client_args'], 'conversation_cache_size', required=False, default=4096),
+                workers=get_key(chatbot_config['client_args'], 'workers', required=False, default=4),
+                queue_size=get_key(chatbot_config['client_args'], 'queue_size', required=False, default=256),
+                queue_policy=get_key(chatbot_config['client_args'], 'queue_policy', required=False, default='drop_oldest'),
+                tweet_interval=get_key(chatbot_config['client_args'], 'tweet_interval', required=False, default=3600),
+                tweet_batch_size=get_key(chatbot_config['client_args'], 'tweet_batch_size', required=False, default=4),
+                tweet_buffer_min=get_key(chatbot_config['client_args'], 'tweet_buffer_min', required=False, default=2),
+                tweet_buffer_max=get_key(chatbot_config['client_args'], 'tweet_buffer_max', required=False, default=8),
+                tweet_buffer_file=get_key(chatbot_config['client_args'], 'tweet_buffer_file', required=False, default='tweet_buffer.json')
             )
             logger.info('Starting %s with Twitter as the client...'%chatbot_config['name'])
             bot.run()
@@ -1,26 +1,45 @@
+import copy
 import json
-import random
+import math
 import re
 import time
+import threading
 import traceback
 import asyncio
 from typing import ContextManager
 import regex
-import datetime
 from shimeji import ChatBot
-from shimeji.memory import memory_context, str_to_numpybin, array_to_str
+from shimeji.memory import memory_context, str_to_numpybin
 from shimeji.preprocessor import ContextPreprocessor
 from shimeji.postprocessor import NewlinePrunerPostprocessor
-from shimeji.util import ContextEntry, INSERTION_TYPE_NEWLINE, TRIM_DIR_TOP, TRIM_TYPE_SENTENCE
 
 import tweepy
 import discord
-from discord.ext import tasks
 
 import logging
-from core.logging import get_logger
-from core.utils import cut_trailing_sentence, anti_spam, replace_emojis_pings, replace_emojis_pings_inverse, set_guild, set_roles
-from core.ratelimiter import AsyncRateLimiter
+from core.logging import get_logger, set_log_context, reset_log_context, log_context
+from core.utils import cut_trailing_sentence, complete_sentences
+from core.ratelimiter import HierarchicalRateLimiter
+from core.msgcache import MessageCache
+from core.antispam import SpamFilter
+from core.authstore import get_auth_registry
+from core.mentions import MentionIndex
+from core.scheduler import ChannelScheduler
+from core.memqueue import MemoryIngestQueue
+from core.batching import HiddenBatcher
+from core.memindex import get_memory_index
+from core.context import ContextBuilder, get_tokenizer
+from core.labelcache import ImageLabelCache
+from core.vision import ImageLabeler, top_labels
+from core.sharedstore import get_shared_store
+from core.looplag import LoopLagMonitor
+from core.streaming import StreamingMessage
+from core.prefilter import ResponsePrefilter, HashedNgramScorer
+from core.prefetch import ContextPrefetcher
+from core.tweets import ConversationResolver
+from core.tweetqueue import TweetWorkerPool
+from core.tweetbuffer import TweetBuffer
+from core.idle import IdleScheduler
 
 logger = get_logger(__name__)
 
@@ -80,11 +99,38 @@ class DiscordBot(Bot):
 
         intents = discord.Intents().all()
 
-        self.client = discord.Bot(intents=intents, activity=activity, status=discord.Status.online)
+        self.shared_store = None
+        self.lag_monitor = None
+        sharding = self.kwargs.get('sharding', None)
+        if sharding is not None:
+            # without shard_ids this process runs every shard, with them only its own group
+            self.client = discord.AutoShardedBot(
+                intents=intents,
+                activity=activity,
+                status=discord.Status.online,
+                shard_count=self.kwargs.get('shard_count', None) or sharding.get('shard_count', None),
+                shard_ids=self.kwargs.get('shard_ids', None)
+            )
+            self.shared_store = get_shared_store(sharding.get('store', 'shared.db'))
+            self.lag_monitor = LoopLagMonitor(self.report_lag, report_interval=sharding.get('report_interval', 30.0))
+        else:
+            self.client = discord.Bot(intents=intents, activity=activity, status=discord.Status.online)
 
+        self.label_cache = None
         if ('vision_provider' in self.kwargs) and (self.kwargs['vision_provider'] is not None):
-            self.labels = self.compile_label(self.kwargs['vision_provider']['text_sets'])
+            self.labeler = ImageLabeler(self.kwargs['vision_provider']['text_sets'])
+            self.labels = self.labeler.labels
+            self.label_cache = ImageLabelCache(
+                namespace=json.dumps([self.kwargs['vision_provider']['model'], self.kwargs['vision_provider']['text_sets'], self.labels]),
+                max_entries=self.kwargs['vision_provider'].get('cache_size', 1024),
+                ttl=self.kwargs['vision_provider'].get('cache_ttl', 86400),
+                filename=self.kwargs['vision_provider'].get('cache_file', None)
+            )
+        self.auth_registry = None
         if self.kwargs['public'] is True:
+            self.auth_registry = get_auth_registry('auth.json', shared=self.shared_store)
+            # AuthCog checks supporters against this persona's guild and roles
+            self.client.persona = self
             self.client.load_extension('client.authcog')
         
         self.chatbot = ChatBot(
@@ -94,7 +140,6 @@ class DiscordBot(Bot):
             postprocessors=[NewlinePrunerPostprocessor()]
         )
 
-        self.debounce = {}
         self.logging_channel = None
         self.privacy_role = None
         self.anonymous_role = None
@@ -102,8 +147,73 @@ class DiscordBot(Bot):
         self.supporter_guild = None
         self.mem_args = self.kwargs['mem_args']
         self.kwargs = kwargs
-        self.last_message = None
-        self.rate_limiters = {} # {channel_id: ratelimiter}
+        self.rate_limiter = HierarchicalRateLimiter(
+            self.kwargs['rate_limits'],
+            role_limits={int(role_id): limits for role_id, limits in (self.kwargs['supporter_rate_limits'] or {}).items()},
+            shared=self.shared_store
+        )
+        self.rate_limit_notices = {} # {channel_id: cooldown end}
+        self.message_cache = MessageCache(self.kwargs['history_size'])
+        self.spam_filter = SpamFilter(threshold=0.8)
+        self.mention_indexes = {} # {guild_id: MentionIndex}
+        self.context_builder = ContextBuilder(
+            get_tokenizer(self.kwargs['tokenizer']),
+            name=self.name,
+            prompt=self.kwargs['prompt'],
+            context_size=self.kwargs['context_size']
+        )
+        self.prefilter = None
+        if self.kwargs['prefilter'] is not None:
+            prefilter = self.kwargs['prefilter']
+            self.prefilter = ResponsePrefilter(
+                min_length=prefilter.get('min_length', 0),
+                min_gap=prefilter.get('min_gap', None),
+                max_channel_rate=prefilter.get('max_channel_rate', None),
+                scorer=HashedNgramScorer.load(prefilter['scorer']) if prefilter.get('scorer', None) else None,
+                skip_below=prefilter.get('skip_below', 0.05),
+                respond_above=prefilter.get('respond_above', None),
+                audit_rate=prefilter.get('audit_rate', 0.05),
+                log_file=prefilter.get('log_file', None)
+            )
+        self.memories_ctx = None # (memory count, memory context)
+        self.prefetcher = None
+        if self.kwargs['prefetch'] is not None:
+            self.prefetcher = ContextPrefetcher(
+                self.warm_context,
+                ttl=self.kwargs['prefetch'].get('ttl', 30.0),
+                min_interval=self.kwargs['prefetch'].get('min_interval', 5.0),
+                max_inflight=self.kwargs['prefetch'].get('max_inflight', 8)
+            )
+        self.idle_scheduler = None
+        if self.kwargs['idle_messaging'] and self.kwargs['idle_messaging_interval'] is not None:
+            self.idle_scheduler = IdleScheduler(self.idle_respond, self.kwargs['idle_messaging_interval'])
+        # streaming needs a provider that can return a reply in pieces
+        self.streaming = self.kwargs['streaming'] is not None and hasattr(self.model_provider, 'response_stream_async')
+        if self.kwargs['streaming'] is not None and not self.streaming:
+            logger.warning('The model provider can not stream replies, sending them whole.')
+        self.scheduler = ChannelScheduler(self.process_message, max_concurrent=self.kwargs['max_concurrent_responses'])
+        self.memory_queue = None
+        self.memory_index = None
+        if self.kwargs['memory_store_provider'] is not None:
+            # personas sharing a memory store share its index too, so each sees the others' memories
+            self.memory_index = get_memory_index(
+                self.kwargs['memory_store_provider'],
+                self.mem_args['model'],
+                dtype=self.mem_args['index_dtype'],
+                refresh_interval=self.mem_args['index_refresh_interval']
+            )
+            self.memory_refresh = None
+            # the ingest workers encode whatever is queued in one batch
+            self.hidden_batcher = HiddenBatcher(self.model_provider, max_batch_size=self.mem_args['encode_batch_size'])
+            self.memory_queue = MemoryIngestQueue(
+                self.kwargs['memory_store_provider'],
+                self.hidden_batcher,
+                self.mem_args,
+                workers=self.mem_args['ingest_workers'],
+                max_queued=self.mem_args['ingest_queue_size'],
+                memory_index=self.memory_index,
+                batch_size=self.mem_args['encode_batch_size']
+            )
 
     def get_priority_channel(self, priority_channels):
         if isinstance(priority_channels, list):
@@ -114,8 +224,8 @@ class DiscordBot(Bot):
             raise Exception(f'Invalid priority channel type: {type(priority_channels)}')
     
     async def get_msg_ctx(self, channel):
-        messages = await channel.history(limit=40).flatten()
-        messages, to_remove = anti_spam(messages)
+        messages = await self.message_cache.history(channel, limit=self.kwargs['history_size'])
+        messages, to_remove = self.spam_filter.filter(messages)
         if to_remove:
             logger.info(f'Removed {to_remove} messages from the context.')
         chain = []
@@ -134,171 +244,220 @@ class DiscordBot(Bot):
                 chain.append(f'{message.author.name}: [Image attached]')
         return '\n'.join(chain)
 
+    def report_lag(self, lag):
+        # every shard in this process shares the event loop and so its lag
+        reports = []
+        for shard_id, shard in self.client.shards.items():
+            latency = shard.latency if math.isfinite(shard.latency) else 0.0 # inf until the first heartbeat
+            reports.append((shard_id, lag['avg'], lag['max'], latency))
+        # the store can wait on another process's lock, so it's written from a thread
+        asyncio.get_running_loop().run_in_executor(None, self.write_lag_reports, reports)
+        logger.info(f'Event loop lag - Shards: {list(self.client.shards)} - avg: {lag["avg"] * 1000:.2f}ms - max: {lag["max"] * 1000:.2f}ms')
+
+    def write_lag_reports(self, reports):
+        try:
+            for report in reports:
+                self.shared_store.report_shard(*report)
+        except Exception as e:
+            logger.error(f'Failed to write the shard lag reports: {e}')
+
     async def on_ready(self):
         logger.info(f'Connected to Discord - ID: {self.client.user.id} - Name: {self.client.user.name}')
+        if self.lag_monitor is not None:
+            self.lag_monitor.start()
         self.cache_roles()
         logger.info(f'Cached roles.')
+        if self.memory_index is not None:
+            await self.memory_index.warm(self.kwargs['memory_store_provider'])
+        if self.idle_scheduler is not None:
+            await self.seed_idle()
+            logger.info(f'Starting idle messaging - Channels: {len(self.idle_scheduler.last)}')
+            self.idle_scheduler.start()
     
     async def build_ctx(self, conversation):
-        contextmgr = ContextPreprocessor(self.kwargs['context_size'])
-
-        prompt = self.kwargs['prompt']
-        prompt_entry = ContextEntry(
-            text=prompt,
-            prefix='',
-            suffix='\n',
-            reserved_tokens=512,
-            insertion_order=1000,
-            insertion_position=-1,
-            insertion_type=INSERTION_TYPE_NEWLINE,
-            forced_activation=True,
-            cascading_activation=False
-        )
-        contextmgr.add_entry(prompt_entry)
-
         # memories
-        if self.kwargs['memory_store_provider'] is not None:
-            memories = await self.kwargs['memory_store_provider'].get()
-            if not memories:
-                logger.info('No memories found.')
+        memories_ctx = None
+        if self.memory_index is not None:
+            # the store is read once, afterwards the index is kept up to date by the ingest queue
+            await self.memory_index.warm(self.kwargs['memory_store_provider'])
+            if self.memory_refresh is None or self.memory_refresh.done():
+                # other processes' memories are picked up in the background, the turn doesn't wait for them
+                self.memory_refresh = asyncio.ensure_future(self.memory_index.refresh(self.kwargs['memory_store_provider']))
+            count = len(self.memory_index.memories)
+            if self.memories_ctx is not None and self.memories_ctx[0] == count:
+                # nothing was remembered since the last context
+                memories_ctx = self.memories_ctx[1]
             else:
-                memories_ctx = memory_context(memories[-1], memories, short_term=self.mem_args['short_term_amount'], long_term=self.mem_args['long_term_amount'])
-                memories_entry = ContextEntry(
-                    text=memories_ctx,
-                    prefix='',
-                    suffix='\n',
-                    reserved_tokens=0,
-                    insertion_order=800,
-                    insertion_position=0,
-                    trim_direction=TRIM_DIR_TOP,
-                    trim_type=TRIM_TYPE_SENTENCE,
-                    insertion_type=INSERTION_TYPE_NEWLINE,
-                    forced_activation=True,
-                    cascading_activation=False
-                )
-                contextmgr.add_entry(memories_entry)
-        
-        # conversation
-        conversation_entry = ContextEntry(
-            text=conversation,
-            prefix='',
-            suffix=f'\n{self.name}:',
-            reserved_tokens=512,
-            insertion_order=0,
-            insertion_position=-1,
-            trim_direction=TRIM_DIR_TOP,
-            trim_type=TRIM_TYPE_SENTENCE,
-            insertion_type=INSERTION_TYPE_NEWLINE,
-            forced_activation=True,
-            cascading_activation=False
-        )
-        contextmgr.add_entry(conversation_entry)
+                memories = self.memory_index.candidates(self.mem_args['short_term_amount'], self.mem_args['long_term_amount'])
+                if not memories:
+                    logger.info('No memories found.')
+                else:
+                    memories_ctx = memory_context(memories[-1], memories, short_term=self.mem_args['short_term_amount'], long_term=self.mem_args['long_term_amount'])
+                self.memories_ctx = (count, memories_ctx)
 
-        return contextmgr.context(self.kwargs['context_size'])
+        return self.context_builder.build(conversation, memories=memories_ctx)
     
-    def compile_label(self, text_sets):
-        labels = []
-        for text_set in text_sets:
-            loaded_labels = []
-            with open(text_set['filename']) as f:
-                loaded_labels = f.read().split('\n')
-            labels.append([f'{text_set["prefix"]}{p}{text_set["suffix"]}' for p in loaded_labels])
-        return labels
-
-    async def __limited(self, until):
-        self.debounce[self.last_message.channel.id] = False
-        duration = int(round(until - time.time()))
-        self.rate_limiters[str(self.last_message.channel.id)][1] = until
-        self.rate_limiters[str(self.last_message.channel.id)][2] = True
-        await self.last_message.channel.send(f'<Please wait for ``{duration}`` seconds! **``This message will delete itself when the cooldown is over.``** Don\'t want to wait? Help us pay for server costs so we can keep the AI free! ``discord.gg/touhouai``>', delete_after=until - time.time())
-
-    async def respond(self, conversation, message):
+    async def rate_limited(self, message, acquire=False):
+        # returns how many seconds the message has to wait, 0 if it can be answered now
+        if self.kwargs['rate_limit'] != True:
+            return 0.0
+        role = self.supporter_role(message)
+        if role is not None and self.kwargs['supporter_rate_limits'] is None:
+            # supporters aren't rate limited unless they have limits of their own
+            return 0.0
+        ids = {
+            'guild_id': message.guild.id if message.guild is not None else None,
+            'channel_id': message.channel.id,
+            'user_id': message.author.id,
+            'role': role
+        }
+        # the shared levels live in a SQLite store that can block, so they're checked from a thread
+        if acquire:
+            return await self.rate_limiter.try_acquire_async(**ids)
+        return await self.rate_limiter.check_async(**ids)
+
+    async def __limited(self, message, wait):
+        now = time.time()
+        if self.rate_limit_notices.get(message.channel.id, 0) > now:
+            # the channel already has a notice up for this cooldown
+            return
+        self.rate_limit_notices = {channel_id: until for channel_id, until in self.rate_limit_notices.items() if until > now}
+        self.rate_limit_notices[message.channel.id] = now + wait
+        duration = int(round(wait))
+        await message.channel.send(f'<Please wait for ``{duration}`` seconds! **``This message will delete itself when the cooldown is over.``** Don\'t want to wait? Help us pay for server costs so we can keep the AI free! ``discord.gg/touhouai``>', delete_after=wait)
+
+    def private_author(self, message):
+        # authors with the Private or Anonymous role, the roles remember() checks
+        if message.guild is None:
+            return False
+        for name in ('Private', 'Anonymous'):
+            role = discord.utils.get(message.guild.roles, name=name)
+            if role is not None and message.author.get_role(role.id) is not None:
+                return True
+        return False
+
+    async def remember(self, message):
+        # private authors are never stored, anonymous ones without their name
+        anonymous = True
+        anonymous_role = discord.utils.get(message.guild.roles, name='Anonymous')
+        private_role = discord.utils.get(message.guild.roles, name='Private')
+        if private_role is not None:
+            # check if the user has the private role, if the user does, don't encode
+            if message.author.get_role(private_role.id) is None:
+                if message.author.get_role(anonymous_role.id) is None:
+                    anonymous = False
+                message_content = self.get_mention_index(message.guild).replace_inverse(message.content)
+                message_content = re.sub(r'\<[^>]*\>', '', message_content.lstrip().rstrip()).lstrip().rstrip()
+                author_name = message.author.name
+                if message_content != '':
+                    if anonymous:
+                        encoded_user_message = f'Deleted User: {message_content}'
+                        author_name = 'Deleted User'
+                    else:
+                        encoded_user_message = f'{message.author.name}: {message_content}'
+                    await self.memory_queue.submit(
+                        author_id=message.author.id,
+                        author=author_name,
+                        text=message_content,
+                        encode_text=encoded_user_message,
+                        dedupe_text=message.content
+                    )
+
+    async def respond(self, conversation, message, merged=()):
         async with message.channel.typing():
 
             encoded_image_label = ''
 
             if self.kwargs['vision_provider'] is not None:
                 if message.attachments:
-                    attachment_url = message.attachments[0].proxy_url
-                    if attachment_url.lower().endswith(('.png', '.jpg', '.jpeg', '.tiff', '.webp')):
-                        clip_labels = await self.model_provider.image_label_async(self.kwargs['vision_provider']['model'], attachment_url, self.labels)
-
-                        sorted_labels = []
-                        for label_set in clip_labels['labels']:
-                            sorted_labels.append(sorted(label_set.items(), key=lambda x: x[1], reverse=True))
-
-                        sorted_labels = sorted(sorted_labels, key=lambda x: x[0][1], reverse=True)[:self.kwargs['vision_provider']['top_k']]
-
-                        for label in sorted_labels:
-                            encoded_image_label += f' {label[0][0]}'
+                    attachment = message.attachments[0]
+                    if attachment.proxy_url.lower().endswith(('.png', '.jpg', '.jpeg', '.tiff', '.webp')):
+                        clip_labels = await self.label_cache.labels(
+                            attachment,
+                            lambda: self.labeler.label(self.model_provider, self.kwargs['vision_provider']['model'], attachment.proxy_url)
+                        )
+
+                        for label in top_labels(clip_labels, self.kwargs['vision_provider']['top_k']):
+                            encoded_image_label += f' {label}'
                         
                         encoded_image_label = f'\n{message.author.name}: [Image Attached:{encoded_image_label}]'
 
             if self.kwargs['memory_store_provider'] is not None:
-                encoded_user_message = ''
-                anonymous = True
-                anonymous_role = discord.utils.get(message.guild.roles, name='Anonymous')
-                private_role = discord.utils.get(message.guild.roles, name='Private')
-                if private_role is not None:
-                    # check if the user has the private role, if the user does, don't encode
-                    if message.author.get_role(private_role.id) is None:
-                        if message.author.get_role(anonymous_role.id) is None:
-                            anonymous = False
-                        message_content = replace_emojis_pings_inverse(text=message.content, users=message.guild.members, emojis=message.guild.emojis)
-                        message_content = re.sub(r'\<[^>]*\>', '', message_content.lstrip().rstrip()).lstrip().rstrip()
-                        author_name = message.author.name
-                        if message_content != '':
-                            if anonymous:
-                                encoded_user_message = f'Deleted User: {message_content}'
-                                author_name = 'Deleted User'
-                            else:
-                                encoded_user_message = f'{message.author.name}: {message_content}'
-                            if await self.kwargs['memory_store_provider'].check_duplicates(
-                                text=message.content,
-                                duplicate_ratio=0.8) == False:
-                                await self.kwargs['memory_store_provider'].add(
-                                    author_id=message.author.id,
-                                    author=author_name,
-                                    text=message_content,
-                                    encoding_model=self.mem_args['model'],
-                                    encoding=array_to_str(await self.model_provider.hidden_async(
-                                        self.mem_args['model'],
-                                        encoded_user_message,
-                                        layer=self.mem_args['model_layer']
-                                    ))
-                                )
+                # the messages merged into this turn came first
+                for merged_message in list(merged) + [message]:
+                    await self.remember(merged_message)
+            started = time.perf_counter()
             conversation = await self.build_ctx(conversation + encoded_image_label)
+            if self.prefetcher is not None:
+                self.prefetcher.spent(message.channel.id, time.perf_counter() - started)
 
-            response = await self.chatbot.respond_async(conversation, push_chain=False)
-            response = cut_trailing_sentence(response)
-        
+            if self.streaming:
+                response = await self.stream_response(conversation, message)
+            else:
+                response = await self.chatbot.respond_async(conversation, push_chain=False)
+                response = cut_trailing_sentence(response)
+
+        if not self.streaming:
+            response = self.finish_response(response, message)
+            await message.channel.send(response)
+
+        if self.memory_queue is not None and response.strip():
+            # encode bot response, an empty one has nothing to remember
+            await self.memory_queue.submit(
+                author_id=self.client.user.id,
+                author=self.name,
+                text=response,
+                encode_text=f'{self.name}: {response}'
+            )
+    
+    async def should_respond(self, conversation, message):
+        if self.prefilter is None:
+            return await self.chatbot.should_respond_async(conversation, push_chain=False)
+        # settle the obvious cases locally before asking the model
+        text = re.sub(r'\<[^>]*\>', '', message.content).strip()
+        predicted, reason, score, context = self.prefilter.decide(text, message.channel.id)
+        if predicted is not None and not self.prefilter.audit():
+            self.prefilter.skipped(reason)
+            logger.info(f'Prefiltered message - ID: {message.id} - Respond: {predicted} - Reason: {reason} - Saved calls: {self.prefilter.saved}')
+            return predicted
+        decision = await self.chatbot.should_respond_async(conversation, push_chain=False)
+        # authors who opted out with the Private or Anonymous role stay out of the decision log
+        self.prefilter.record(text, context, predicted, score, decision, log=not self.private_author(message))
+        return decision
+
+    def finish_response(self, response, message):
         # trim left whitespace from response and fix emojis and pings
         response = response.lstrip()
         if message.guild != None:
-            response = replace_emojis_pings(text=response, users=message.guild.members, emojis=message.guild.emojis)
+            response = self.get_mention_index(message.guild).replace(response)
+        return response
+
+    async def stream_response(self, conversation, message):
+        # send the reply a sentence at a time while it's being generated
+        streamed = StreamingMessage(message.channel, edit_interval=self.kwargs['streaming'].get('edit_interval', 1.0))
+        text = ''
+        async for chunk in self.model_provider.response_stream_async(conversation, chunk_length=self.kwargs['streaming'].get('chunk_length', 16)):
+            text += chunk
+            if '\n' in text:
+                # newlines end the reply, same as NewlinePrunerPostprocessor
+                text = text[:text.index('\n')]
+                break
+            await streamed.update(self.finish_response(complete_sentences(text), message))
+        response = self.finish_response(cut_trailing_sentence(text), message)
+        await streamed.finish(response)
+        return response
+
+    def get_mention_index(self, guild):
+        if guild.id not in self.mention_indexes:
+            self.mention_indexes[guild.id] = MentionIndex.from_guild(guild)
+            logger.info(f'Built mention index - Guild: {guild.id} - Members: {len(self.mention_indexes[guild.id].member_names)}')
+        return self.mention_indexes[guild.id]
 
-        if self.kwargs['memory_store_provider'] is not None:
-            # encode bot response
-            if await self.kwargs['memory_store_provider'].check_duplicates(text=response, duplicate_ratio=0.8) == False:
-                await self.kwargs['memory_store_provider'].add(
-                    author_id=self.client.user.id,
-                    author=self.name,
-                    text=response,
-                    encoding_model=self.mem_args['model'],
-                    encoding=array_to_str(await self.model_provider.hidden_async(
-                        self.mem_args['model'],
-                        f'{self.name}: {response}',
-                        layer=self.mem_args['model_layer']))
-                )
-
-        await message.channel.send(response)
-    
     def cache_roles(self):
         # cache guild and roles
         if self.supporter_guild is None:
             if self.kwargs['supporter_guild_id'] is not None:
                 self.supporter_guild = self.client.get_guild(self.kwargs['supporter_guild_id'])
-                set_guild(self.supporter_guild)
             else:
                 return False
         if self.supporter_roles is None:
@@ -308,7 +467,6 @@ class DiscordBot(Bot):
                     role = discord.utils.get(self.supporter_guild.roles, id=role_id)
                     if role is not None:
                         self.supporter_roles.append(role)
-                        set_roles(self.supporter_roles)
             else:
                 return False
         return True
@@ -329,23 +487,37 @@ class DiscordBot(Bot):
 
         return False # User doesn't have role -- not authorized
     
+    def supporter_role(self, message):
+        # the first supporter role the author has, None if they aren't a supporter
+        if not self.cache_roles():
+            return None
+
+        member = self.supporter_guild.get_member(message.author.id)
+        if member is None:
+            return None
+
+        for role in self.supporter_roles:
+            if member.get_role(role.id) is not None:
+                return role.id
+
+        return None
+
     def authorized_guild(self, message):
         if self.kwargs['public'] is False:
             logger.info(f'Chatbot is private')
             return False
         self.cache_roles()
-        channel_id = str(message.channel.id)
-        with open('auth.json', 'r') as fp:
-            auth_data = json.load(fp)
-            if channel_id in auth_data:
-                return True
-            else:
-                return False
+        return self.auth_registry.is_authorized(message.channel.id)
 
     async def on_message(self, message):
         priority_channels = self.get_priority_channel(self.kwargs['priority_channel'])
         if (message.channel.id not in priority_channels) and (not self.authorized_guild(message)) and (not isinstance(message.channel, discord.channel.DMChannel)):
             return
+        self.message_cache.append(message)
+        if self.idle_scheduler is not None and not isinstance(message.channel, discord.channel.DMChannel) and message.channel.id in priority_channels:
+            self.idle_scheduler.touch(message, message.author.id == self.client.user.id)
+        if self.prefilter is not None:
+            self.prefilter.observe(message.channel.id, message.author.id == self.client.user.id)
         if message.author.id == self.client.user.id:
             return
         
@@ -354,58 +526,62 @@ class DiscordBot(Bot):
             if not self.authorized_dm(message):
                 return
 
-        # check if ratelimited
-        self.last_message = message
-        channel_id = str(message.channel.id)
-        if channel_id in self.rate_limiters:
-            if self.last_message != None:
-                if self.rate_limiters[str(self.last_message.channel.id)][1] > time.time():
-                    # ratelimited
-                    message_content = re.sub(r'\<[^>]*\>', '', message.content.lower())
-                    if self.client.user.mentioned_in(message) or any(t in message_content for t in self.kwargs['nicknames']):
-                        await self.__limited(until=self.rate_limiters[channel_id][1])
-                        return
-        else:
-            self.rate_limiters[channel_id] = [AsyncRateLimiter(max_calls=5, period=80.0, callback=self.__limited), time.time()-1, False] #[ratelimiter, until, rate_limited]
-
-        if message.channel.id not in self.debounce:
-            self.debounce[message.channel.id] = False
-
-        if self.debounce[message.channel.id] == True:
-            logger.info(f'Debouncing message - ID: {message.id}')
-            return
-        else:
-            logger.info(f'Processing message - ID: {message.id}')
-            self.debounce[message.channel.id] = True
+        message_content = re.sub(r'\<[^>]*\>', '', message.content.lower())
+        mentioned = self.client.user.mentioned_in(message) or any(t in message_content for t in self.kwargs['nicknames'])
 
+        # check if ratelimited
+        if mentioned and self.kwargs['conditional_response'] != True:
+            wait = await self.rate_limited(message)
+            if wait > 0:
+                await self.__limited(message, wait)
+                return
+        if message.channel.id in self.scheduler.channels:
+            logger.info(f'Queueing message - ID: {message.id}')
+        self.scheduler.submit(message, mentioned)
+
+    async def process_message(self, messages, waited, idle=False):
+        # the turn answers the newest message, the ones merged into it are remembered and charged too
+        message = messages[-1][0]
+        merged = [merged_message for merged_message, _ in messages[:-1]]
+        mentions = [mention for mention, mentioned in messages if mentioned]
+        mentioned = bool(mentions)
+        # the scheduler handles a channel's messages in one task, so the context is reset after each
+        log_token = set_log_context(message_id=message.id, channel_id=message.channel.id, persona=self.name)
+        logger.info(f'Processing message - ID: {message.id} - Waited: {waited:.2f}s - Merged: {len(merged)}')
         try:
+            if self.prefetcher is not None:
+                await self.prefetcher.claim(message.channel.id)
+            started = time.perf_counter()
             conversation = await self.get_msg_ctx(message.channel)
-            if message.guild != None:
-                message_content = replace_emojis_pings_inverse(text=message.content, users=message.guild.members, emojis=message.guild.emojis)
-            message_content = re.sub(r'\<[^>]*\>', '', message.content.lower())
-            if self.kwargs['conditional_response'] == True:
-                if self.client.user.mentioned_in(message) or any(t in message_content for t in self.kwargs['nicknames']):
-                    await self.respond(conversation, message)
-                elif await self.chatbot.should_respond_async(conversation, push_chain=False):
-                    await self.respond(conversation, message)
+            if self.prefetcher is not None:
+                self.prefetcher.spent(message.channel.id, time.perf_counter() - started)
+            if idle:
+                # the channel went quiet, the bot speaks up on its own
+                await self.respond(conversation, message)
+                self.idle_scheduler.done(message)
+                logger.info(f'Processed idle response - ID: {message.id} - {self.idle_scheduler.stats()}')
+            elif self.kwargs['conditional_response'] == True:
+                if mentioned:
+                    await self.respond(conversation, message, merged)
+                elif await self.should_respond(conversation, message):
+                    await self.respond(conversation, message, merged)
             else:
-                if self.client.user.mentioned_in(message) or any(t in message_content for t in self.kwargs['nicknames']):
-                    if (self.kwargs['rate_limit'] == True) and (not self.authorized_dm(message)):
-                        async with self.rate_limiters[channel_id][0]:
-                            if self.rate_limiters[channel_id][2]:
-                                self.rate_limiters[channel_id][2] = False
-                                await self.rate_limiters[channel_id][0].pop_call()
-                                self.debounce[message.channel.id] = False
-                                return
-                            await self.respond(conversation, message)
-                    else:
-                        await self.respond(conversation, message)
+                if mentioned:
+                    # every mention in the turn takes a token, not only the newest one
+                    waits = [await self.rate_limited(mention, acquire=True) for mention in mentions]
+                    if all(wait > 0 for wait in waits):
+                        await self.__limited(message, min(waits))
+                        return
+                    limited = {mention.id for mention, wait in zip(mentions, waits) if wait > 0}
+                    await self.respond(conversation, message, [m for m in merged if m.id not in limited])
                 elif isinstance(message.channel, discord.channel.DMChannel):
-                    await self.respond(conversation, message)
+                    await self.respond(conversation, message, merged)
         
         except Exception as e:
             logger.error(e)
             logger.error(traceback.format_exc())
+            if idle:
+                self.idle_scheduler.retry(message)
             embed = discord.Embed(
                 title='Error',
                 description=str(f'**Exception:** **``{repr(e)}``**\n```{traceback.format_exc()}```'),
@@ -427,35 +603,130 @@ class DiscordBot(Bot):
                     )
                     await self.logging_channel.send(embed=embed, file=discord.File('error.txt'))
         finally:
-            self.debounce[message.channel.id] = False
+            if self.prefetcher is not None:
+                saved = self.prefetcher.finish(message.channel.id)
+                if saved is not None:
+                    logger.info(f'Used prefetched context - ID: {message.id} - Saved: {saved * 1000:.2f}ms - {self.prefetcher.stats()}')
+            reset_log_context(log_token)
     
-    @tasks.loop(seconds=10)
-    async def idle_loop(self):
-        await self.client.wait_until_ready()
-        if self.kwargs['idle_messaging_interval'] != None:
-            # get last message in a random priority channel
-            priority_channels = self.get_priority_channel(self.kwargs['priority_channel'])
-            channel = self.client.get_channel(random.choice(priority_channels))
-            message = await channel.history(limit=1).flatten()
-            # check if message author is bot
-            if message[0].author.id == self.client.user.id:
-                return
-            if (datetime.datetime.now(datetime.timezone.utc) - message[0].created_at).total_seconds() >= self.kwargs['idle_messaging_interval']:
-                # if it's been more than 5 minutes, send a response
-                conversation = await self.get_msg_ctx(channel)
-                await self.respond(conversation, message[0])
-                logger.info(f'Processed idle response - ID: {message[0].id}')
+    async def on_typing(self, channel, user, when):
+        if self.prefetcher is None or user.id == self.client.user.id or isinstance(channel, discord.channel.DMChannel):
+            return
+        priority_channels = self.get_priority_channel(self.kwargs['priority_channel'])
+        if channel.id not in priority_channels and not (self.kwargs['public'] is True and self.auth_registry.is_authorized(channel.id)):
+            return
+        self.prefetcher.typing(channel)
 
-    def run(self):
-        logger.info(f'Starting Discord Bot.')
+    async def warm_context(self, channel):
+        # the same work a message does before generating, only to fill the caches
+        conversation = await self.get_msg_ctx(channel)
+        await self.build_ctx(conversation)
+
+    async def on_raw_message_edit(self, payload):
+        self.message_cache.edit(payload.channel_id, payload.message_id, payload.data)
+
+    async def on_raw_message_delete(self, payload):
+        self.message_cache.remove(payload.channel_id, [payload.message_id])
+
+    async def on_raw_bulk_message_delete(self, payload):
+        self.message_cache.remove(payload.channel_id, payload.message_ids)
+
+    async def on_guild_channel_delete(self, channel):
+        self.message_cache.evict(channel.id)
+
+    async def on_member_join(self, member):
+        if member.guild.id in self.mention_indexes:
+            self.mention_indexes[member.guild.id].add_member(member)
+
+    async def on_member_remove(self, member):
+        if member.guild.id in self.mention_indexes:
+            self.mention_indexes[member.guild.id].remove_member(member)
+
+    async def on_member_update(self, before, after):
+        if after.guild.id in self.mention_indexes:
+            self.mention_indexes[after.guild.id].update_member(after)
+
+    async def on_user_update(self, before, after):
+        if before.name != after.name:
+            for index in self.mention_indexes.values():
+                index.update_member(after)
+
+    async def on_guild_emojis_update(self, guild, before, after):
+        if guild.id in self.mention_indexes:
+            self.mention_indexes[guild.id].set_emojis(after)
+
+    async def on_guild_remove(self, guild):
+        self.mention_indexes.pop(guild.id, None)
+
+    async def seed_idle(self):
+        # the last message of each priority channel, read once; after that on_message keeps it current
+        for channel_id in self.get_priority_channel(self.kwargs['priority_channel']):
+            channel = self.client.get_channel(channel_id)
+            if channel is None:
+                # the channel is on a shard that another process runs
+                continue
+            try:
+                messages = await self.message_cache.history(channel, limit=1)
+            except Exception as e:
+                logger.error(f'Failed to read the last message of channel {channel_id}: {e}')
+                continue
+            if messages:
+                self.idle_scheduler.touch(messages[0], messages[0].author.id == self.client.user.id)
+
+    async def idle_respond(self, message):
+        # a turn like any other, so it waits for a slot and never runs alongside another in the channel
+        queued = self.scheduler.submit(message, idle=True)
+        if not queued:
+            logger.info(f'Skipped idle response, the channel is busy - ID: {message.id}')
+        return queued
+
+    def setup(self):
+        logger.info(f'Starting Discord Bot - Name: {self.name}')
         self.on_ready = self.client.event(self.on_ready)
         self.on_message = self.client.event(self.on_message)
+        self.on_typing = self.client.event(self.on_typing)
+        self.on_raw_message_edit = self.client.event(self.on_raw_message_edit)
+        self.on_raw_message_delete = self.client.event(self.on_raw_message_delete)
+        self.on_raw_bulk_message_delete = self.client.event(self.on_raw_bulk_message_delete)
+        self.on_guild_channel_delete = self.client.event(self.on_guild_channel_delete)
+        self.on_member_join = self.client.event(self.on_member_join)
+        self.on_member_remove = self.client.event(self.on_member_remove)
+        self.on_member_update = self.client.event(self.on_member_update)
+        self.on_user_update = self.client.event(self.on_user_update)
+        self.on_guild_emojis_update = self.client.event(self.on_guild_emojis_update)
+        self.on_guild_remove = self.client.event(self.on_guild_remove)
+
+        # drain background work before the client disconnects
+        self._client_close = self.client.close
+        self.client.close = self.shutdown
 
-        if self.kwargs['idle_messaging']:
-            logger.info('Starting idle messaging loop.')
-            self.idle_loop.start()
-
+    def run(self):
+        self.setup()
         self.client.run(self.kwargs['bearer_token'])
+
+    async def start(self):
+        # for running several bots on one event loop
+        self.setup()
+        await self.client.start(self.kwargs['bearer_token'])
+
+    async def shutdown(self):
+        logger.info(f'Channel scheduler - {self.scheduler.stats()}')
+        logger.info(f'Message cache - {self.message_cache.stats()}')
+        if self.prefilter is not None:
+            logger.info(f'Response prefilter - {self.prefilter.stats()}')
+            self.prefilter.close()
+        if self.prefetcher is not None:
+            logger.info(f'Context prefetch - {self.prefetcher.stats()}')
+        if self.lag_monitor is not None:
+            self.lag_monitor.stop()
+        if self.idle_scheduler is not None:
+            self.idle_scheduler.stop()
+        if self.memory_queue is not None:
+            await self.memory_queue.close()
+        if self.kwargs.get('close_provider', True) and hasattr(self.model_provider, 'close'):
+            # a provider shared with other personas is closed by the host once they're all done
+            await self.model_provider.close()
+        await self._client_close()
     
     def close(self):
         asyncio.run(self.client.close())
@@ -494,6 +765,24 @@ class TwitterBot(Bot):
 
         self.expansions = ["referenced_tweets.id", "author_id"]
         self.user_fields = ["name"]
+        self.resolver = ConversationResolver(self.client_api, max_entries=self.kwargs['conversation_cache_size'])
+        # scheduled tweets get their own copy of the args, taken before anything changes the shared ones
+        self.tweet_args = copy.deepcopy(model_provider.kwargs['args'])
+        self.tweet_buffer = TweetBuffer(
+            self.generate_tweets,
+            batch_size=self.kwargs['tweet_batch_size'],
+            min_buffered=self.kwargs['tweet_buffer_min'],
+            max_buffered=self.kwargs['tweet_buffer_max'],
+            filename=self.kwargs['tweet_buffer_file']
+        )
+        # shimeji's provider sets the prompt on its shared args, so generations take turns
+        self.generate_lock = threading.Lock()
+        self.tweet_queue = TweetWorkerPool(
+            self.process_tweet,
+            workers=self.kwargs['workers'],
+            max_queued=self.kwargs['queue_size'],
+            policy=self.kwargs['queue_policy']
+        )
 
         # add rule to check if user is talking to the bot
         self.client.add_rules(
@@ -506,81 +795,101 @@ class TwitterBot(Bot):
     # tweet helper
     def tweet(self, text, reply_to=None):
         if reply_to:
-            self.client_api.create_tweet(
+            response = self.client_api.create_tweet(
                 text=text,
                 in_reply_to_tweet_id=reply_to
             )
         else:
-            self.client_api.create_tweet(text=text)
+            response = self.client_api.create_tweet(text=text)
+        # replies to this tweet won't have to look it up again
+        self.resolver.add(int(response.data['id']), self.name, response.data['text'], [reply_to] if reply_to else [])
     
-    def initial_tweet(self):
-        mp = self.model_provider
-        args = mp.kwargs['args']
-        args.prompt = f'{self.kwargs["tweet_example"]}\nA tweet from {self.name}:'
-        args.sample_args.temp = 0.85
-        args.gen_args.eos_token_id = 198
-        args.gen_args.min_length = 1
-        response = mp.generate(args).rstrip('\n')
-        self.tweet(response)
-
-    def flatten(self, arr):
-        rt = []
-        for i in arr:
-            if isinstance(i, list):
-                rt.extend(self.flatten(i))
+    async def generate_tweets(self, count):
+        # every candidate is generated from its own copy of the args, concurrently when the provider can
+        requests = []
+        for _ in range(count):
+            args = copy.deepcopy(self.tweet_args)
+            args.prompt = f'{self.kwargs["tweet_example"]}\nA tweet from {self.name}:'
+            args.sample_args.temp = 0.85
+            args.gen_args.eos_token_id = 198
+            args.gen_args.min_length = 1
+            if hasattr(self.model_provider, 'generate_async'):
+                requests.append(self.model_provider.generate_async(args))
             else:
-                rt.append(i)
-        return rt
+                requests.append(asyncio.get_running_loop().run_in_executor(None, self.model_provider.generate, args))
+        responses = await asyncio.gather(*requests, return_exceptions=True)
+        for response in responses:
+            if isinstance(response, Exception):
+                logger.error(f'Failed to generate a tweet: {response!r}')
+        return [response.rstrip('\n') for response in responses if isinstance(response, str)]
+
+    async def post_tweet(self):
+        if not self.tweet_buffer.buffer:
+            await self.tweet_buffer.refill()
+        text = self.tweet_buffer.pop()
+        if text is None:
+            logger.info('No tweet to post.')
+            return
+        logger.info('Tweeting...')
+        await asyncio.get_running_loop().run_in_executor(None, self.tweet, text)
+        self.tweet_buffer.posted(text)
 
     # return a list of strings that are the conversational history of a tweet
     def get_conversation(self, id):
-        conversation = []
-        tweet = self.client_api.get_tweet(id, expansions=self.expansions, user_fields=self.user_fields)
-        
-        for user in tweet.includes['users']:
-            author = user['name']
-
-        conversation.append(f"{author}: {tweet.data.text}")
-        if 'tweets' in tweet.includes:
-            for tweet_id in tweet.includes['tweets']:
-                # prepend parent tweet to conversation, since get_conversation returns an array, expand it
-                conversation.insert(0, self.get_conversation(tweet_id.id))
-        
-        return self.flatten(conversation)
+        conversation = self.resolver.resolve(id)
+        logger.info(f'Resolved conversation - ID: {id} - Tweets: {len(conversation)} - {self.resolver.stats()}')
+        return conversation
     
-    # on_tweet: check if tweet is in reply to bot, if it is, get the conversation and respond
+    # on_tweet: runs on the streaming thread, so it only queues the tweet
     def on_tweet(self, tweet):
         logger.info(f'Tweet received: {tweet.id}')
-        conversation = self.get_conversation(tweet.id)
-        #check if last tweet is from bot
-        if conversation[-1].startswith(self.name):
-            return
+        # tweets of one conversation are answered in order
+        self.tweet_queue.submit(tweet, key=tweet.conversation_id or tweet.id)
+
+    # check if tweet is in reply to bot, if it is, get the conversation and respond
+    def process_tweet(self, tweet, waited):
+        # each worker thread handles one tweet at a time
+        with log_context(tweet_id=tweet.id, conversation_id=tweet.conversation_id, persona=self.name):
+            logger.info(f'Processing tweet - ID: {tweet.id} - Waited: {waited:.2f}s')
+            conversation = self.get_conversation(tweet.id)
+            if not conversation:
+                # the tweet was deleted or made private before we got to it
+                logger.info(f'Tweet is no longer available - ID: {tweet.id}')
+                return
+            #check if last tweet is from bot
+            if conversation[-1].startswith(self.name):
+                return
 
-        # replace @username with nothing
-        for i in range(len(conversation)):
-            conversation[i] = conversation[i].replace(f'@{self.kwargs["username"]} ', '')
-            conversation[i] = regex.sub(r'@[^ ]*', '', conversation[i])
-            conversation[i] = regex.sub(' +', ' ', conversation[i])
+            # replace @username with nothing
+            for i in range(len(conversation)):
+                conversation[i] = conversation[i].replace(f'@{self.kwargs["username"]} ', '')
+                conversation[i] = regex.sub(r'@[^ ]*', '', conversation[i])
+                conversation[i] = regex.sub(' +', ' ', conversation[i])
         
-        response = self.chatbot.respond('\n'.join(conversation), push_chain=False)
-        self.tweet(response, reply_to=tweet.id)
+            with self.generate_lock:
+                response = self.chatbot.respond('\n'.join(conversation), push_chain=False)
+            self.tweet(response, reply_to=tweet.id)
 
     async def loop_tweet(self):
-        asyncio.set_event_loop(asyncio.new_event_loop())
         while True:
             try:
-                logger.info('Tweeting...')
-                self.initial_tweet()
+                await self.post_tweet()
+                # top the buffer up now, so the next post doesn't wait for the model
+                await self.tweet_buffer.refill()
+                logger.info(f'Tweet buffer - {self.tweet_buffer.stats()}')
             except Exception:
+                logger.error(traceback.format_exc())
                 logger.info('Failed to tweet... Sleeping.')
-            await asyncio.sleep(3600)
+            await asyncio.sleep(self.kwargs['tweet_interval'])
 
     def run(self):
         # create a task that runs loop_tweet in a separate thread by creating a new event loop
-        self.client.filter(expansions=self.expansions, user_fields=self.user_fields, threaded=True)
+        self.client.filter(expansions=self.expansions, user_fields=self.user_fields, tweet_fields=['conversation_id'], threaded=True)
         asyncio.run(self.loop_tweet())
 
     def close(self):
+        self.client.disconnect()
+        self.tweet_queue.close()
         for task in asyncio.Task.all_tasks():
             try:
                 task.cancel()
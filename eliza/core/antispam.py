@@ -0,0 +1,125 @@
+import sys
+import time
+import types
+import random
+import collections
+from difflib import SequenceMatcher
+
+from .utils import anti_spam
+
+
+class SpamFilter(object):
+
+    """Drops near-duplicate messages from a channel history.
+
+    Gives the same result as core.utils.anti_spam: a message is removed when
+    any message before it in the list is more similar than threshold. Pairs
+    are rejected with the cheap upper bounds of SequenceMatcher before the
+    full ratio is computed, and verdicts are cached per message ID pair so a
+    history that only gained a message or two since the last turn costs a
+    handful of comparisons instead of all of them.
+    """
+
+    def __init__(self, threshold=0.8, cache_size=16384):
+        if cache_size <= 0:
+            raise ValueError('Spam filter cache size should be > 0')
+
+        self.threshold = threshold
+        self.cache_size = cache_size
+        # {(message_id, message_id): (content, content, verdict)}
+        self._verdicts = collections.OrderedDict()
+
+        self.cache_hits = 0
+        self.pruned = 0
+        self.compared = 0
+
+    def _exceeds(self, a, b):
+        la, lb = len(a), len(b)
+        if la + lb == 0:
+            # SequenceMatcher rates two empty strings as identical
+            return 1.0 > self.threshold
+        # same bound as real_quick_ratio, without building a matcher
+        if 2.0 * min(la, lb) / (la + lb) <= self.threshold:
+            self.pruned += 1
+            return False
+        matcher = SequenceMatcher(None, a, b)
+        if matcher.quick_ratio() <= self.threshold:
+            self.pruned += 1
+            return False
+        self.compared += 1
+        return matcher.ratio() > self.threshold
+
+    def similar(self, a, b):
+        # the ratio is not symmetric, a has to be the message that comes first
+        key = (a.id, b.id)
+        cached = self._verdicts.get(key)
+        if cached is not None and cached[0] == a.content and cached[1] == b.content:
+            self.cache_hits += 1
+            self._verdicts.move_to_end(key)
+            return cached[2]
+
+        verdict = self._exceeds(a.content, b.content)
+        self._verdicts[key] = (a.content, b.content, verdict)
+        if len(self._verdicts) > self.cache_size:
+            self._verdicts.popitem(last=False)
+        return verdict
+
+    def filter(self, messages):
+        to_remove = set()
+        for j in range(1, len(messages)):
+            for i in range(j):
+                if self.similar(messages[i], messages[j]):
+                    # one earlier match is enough to drop the message
+                    to_remove.add(j)
+                    break
+        messages = [messages[i] for i in range(len(messages)) if i not in to_remove]
+        return messages, len(to_remove)
+
+    def stats(self):
+        return {
+            'cached': len(self._verdicts),
+            'cache_hits': self.cache_hits,
+            'pruned': self.pruned,
+            'compared': self.compared,
+        }
+
+
+def bench(histories=200, size=40, seed=0):
+    # rolling channel histories with some near-duplicates, checked against anti_spam
+    rng = random.Random(seed)
+    words = ['hello', 'there', 'what', 'is', 'the', 'bot', 'doing', 'today', 'lol', 'no', 'yes', 'maybe', 'cat', 'dog', 'spam']
+    messages = []
+    for index in range(histories + size):
+        if messages and rng.random() < 0.2:
+            content = rng.choice(messages[-size:]).content + rng.choice(['', '!', ' lol'])
+        else:
+            content = ' '.join(rng.choice(words) for _ in range(rng.randint(1, 16)))
+        messages.append(types.SimpleNamespace(id=index, content=content))
+
+    spam_filter = SpamFilter(threshold=0.8)
+    old = new = 0.0
+    for start in range(histories):
+        history = messages[start:start + size]
+        started = time.perf_counter()
+        expected = anti_spam(history, threshold=0.8)
+        old += time.perf_counter() - started
+        started = time.perf_counter()
+        result = spam_filter.filter(history)
+        new += time.perf_counter() - started
+        if [m.id for m in result[0]] != [m.id for m in expected[0]] or result[1] != expected[1]:
+            print(f'SpamFilter differs from anti_spam on history {start}')
+            return 1
+    print(f'{histories} histories of {size} messages, identical output')
+    print(f'anti_spam: {old:.3f}s - SpamFilter: {new:.3f}s - {spam_filter.stats()}')
+    return 0
+
+
+def main(argv):
+    # python -m core.antispam --bench
+    if argv != ['--bench']:
+        print('usage: python -m core.antispam --bench')
+        return 1
+    return bench()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
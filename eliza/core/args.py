@@ -1,5 +1,9 @@
 from shimeji.model_provider import ModelProvider, Sukima_ModelProvider, ModelGenRequest, ModelGenArgs, ModelSampleArgs, ModelLogitBiasArgs, ModelPhraseBiasArgs
 from shimeji.memorystore_provider import MemoryStoreProvider, PostgreSQL_MemoryStoreProvider
+from .providers import PooledSukima_ModelProvider
+from .stub import Stub_ModelProvider
+from .transport import HTTPTransport
+from .balancer import EndpointBalancer
 from .logging import get_logger
 import argparse
 import json
@@ -14,15 +18,16 @@ def parse():
 
     parser.add_argument(
         '-c', '--config',
-        help="Path to the config file.",
+        help="Path to the config file. Pass several Discord configs to run them all in one process.",
         type=str,
+        nargs='+',
         required=True
     )
 
     return parser.parse_args()
 
-def config(args):
-    with open(args.config, encoding='utf-8') as f:
+def config(path):
+    with open(path, encoding='utf-8') as f:
         return json.load(f)
 
 def get_item(obj, key):
@@ -31,20 +36,33 @@ def get_item(obj, key):
     else:
         return None
 
-def get_memorystore_provider(args):
+def get_memorystore_provider(args, shared=None):
+    # with a shared dict, configs that use the same database share one provider and its connection pool
     if 'memory_store' not in args:
         logger.warning('running without memory store -- the chatbot will not be able to remember anything')
         return None, None
     
     if 'database_type' in args['memory_store']:
         if args['memory_store']['database_type'] == 'postgresql':
-            return PostgreSQL_MemoryStoreProvider(
-                database_uri=args['memory_store']['database_uri']
-            ), {
+            key = ('postgresql', args['memory_store']['database_uri'])
+            if shared is None or key not in shared:
+                provider = PostgreSQL_MemoryStoreProvider(
+                    database_uri=args['memory_store']['database_uri']
+                )
+                if shared is not None:
+                    shared[key] = provider
+            else:
+                provider = shared[key]
+            return provider, {
                 'model': args['memory_store']['model'],
                 'model_layer': args['memory_store']['model_layer'],
                 'short_term_amount': args['memory_store']['short_term_amount'],
                 'long_term_amount': args['memory_store']['long_term_amount'],
+                'ingest_workers': args['memory_store'].get('ingest_workers', 2),
+                'ingest_queue_size': args['memory_store'].get('ingest_queue_size', 256),
+                'encode_batch_size': args['memory_store'].get('encode_batch_size', 16),
+                'index_dtype': args['memory_store'].get('index_dtype', 'float32'),
+                'index_refresh_interval': args['memory_store'].get('index_refresh_interval', None),
             }
         else:
             raise Exception('database_type is not supported.')
@@ -57,63 +75,123 @@ def get_vision_provider(args):
     
     return args['vision_provider']
 
-def get_model_provider(args):
+def get_gen_request(gensettings):
     # load model provider gen_args into basemodel
+    gen_settings = gensettings.get("gen_args", {})
+    sample_settings = gensettings.get("sample_args", {})
+    gen_args = ModelGenArgs(
+        max_length=get_item(gen_settings, "max_length"),
+        max_time=get_item(gen_settings, "max_time"),
+        min_length=get_item(gen_settings, "min_length"),
+        eos_token_id=get_item(gen_settings, "eos_token_id"),
+        logprobs=get_item(gen_settings, "logprobs"),
+        best_of=get_item(gen_settings, "best_of"),
+    )
+    # logit biases are an array in gensettings['sample_args']['logit_biases']
+    logit_biases = None
+    if 'logit_biases' in sample_settings:
+        logit_biases = [ModelLogitBiasArgs(
+            id=logit_bias["id"],
+            bias=logit_bias["bias"]
+        ) for logit_bias in sample_settings["logit_biases"]]
+    # phrase biases are an array in gensettings['sample_args']['phrase_biases']
+    phrase_biases = None
+    if 'phrase_biases' in sample_settings:
+        phrase_biases = [ModelPhraseBiasArgs(
+            sequences=phrase_bias["sequences"],
+            bias=phrase_bias["bias"],
+            ensure_sequence_finish=phrase_bias["ensure_sequence_finish"],
+            generate_once=phrase_bias["generate_once"]
+        ) for phrase_bias in sample_settings["phrase_biases"]]
+    
+    sample_args = ModelSampleArgs(
+        temp=get_item(sample_settings, "temp"),
+        top_p=get_item(sample_settings, "top_p"),
+        top_a=get_item(sample_settings, "top_a"),
+        top_k=get_item(sample_settings, "top_k"),
+        typical_p=get_item(sample_settings, "typical_p"),
+        tfs=get_item(sample_settings, "tfs"),
+        rep_p=get_item(sample_settings, "rep_p"),
+        rep_p_range=get_item(sample_settings, "rep_p_range"),
+        rep_p_slope=get_item(sample_settings, "rep_p_slope"),
+        bad_words=get_item(sample_settings, "bad_words"),
+        logit_biases=logit_biases,
+        phrase_biases=phrase_biases
+    )
+
+    return ModelGenRequest(
+        model=gensettings.get("model", ""),
+        prompt='',
+        sample_args=sample_args,
+        gen_args=gen_args
+    )
+
+def get_pool(model_provider, shared=None):
+    # the transport and balancer for the endpoints, one per endpoint and settings when shared
+    key = json.dumps([model_provider["endpoint"], model_provider.get("transport", {}), model_provider.get("balancing", {})], sort_keys=True)
+    if shared is not None and key in shared:
+        return shared[key]
+    endpoints = model_provider["endpoint"]
+    transport = model_provider.get("transport", {})
+    balancing = model_provider.get("balancing", {})
+    pool = (
+        HTTPTransport(
+            max_connections=transport.get("max_connections", 32),
+            max_concurrent=transport.get("max_concurrent", 8),
+            connect_timeout=transport.get("connect_timeout", 5.0),
+            read_timeout=transport.get("read_timeout", 120.0),
+            keepalive_timeout=transport.get("keepalive_timeout", 60.0),
+            retries=transport.get("retries", 2),
+            backoff=transport.get("backoff", 0.25),
+            max_backoff=transport.get("max_backoff", 4.0)
+        ),
+        EndpointBalancer(
+            [endpoints] if isinstance(endpoints, str) else endpoints,
+            policy=balancing.get("policy", "least_outstanding"),
+            eject_after=balancing.get("eject_after", 3),
+            eject_time=balancing.get("eject_time", 30.0)
+        )
+    )
+    if shared is not None:
+        shared[key] = pool
+    return pool
+
+def get_model_provider(args, shared=None):
     if 'model_provider' not in args:
         raise Exception('model_provider is not specified in config file.')
     if args["model_provider"]["name"] == "sukima":
-        gen_args = ModelGenArgs(
-            max_length=get_item(args["model_provider"]["gensettings"]["gen_args"], "max_length"),
-            max_time=get_item(args["model_provider"]["gensettings"]["gen_args"], "max_time"),
-            min_length=get_item(args["model_provider"]["gensettings"]["gen_args"], "min_length"),
-            eos_token_id=get_item(args["model_provider"]["gensettings"]["gen_args"], "eos_token_id"),
-            logprobs=get_item(args["model_provider"]["gensettings"]["gen_args"], "logprobs"),
-            best_of=get_item(args["model_provider"]["gensettings"]["gen_args"], "best_of"),
-        )
-        # logit biases are an array in args['model_provider']['gensettings']['logit_biases']
-        logit_biases = None
-        if 'logit_biases' in args["model_provider"]["gensettings"]["sample_args"]:
-            logit_biases = [ModelLogitBiasArgs(
-                id=logit_bias["id"],
-                bias=logit_bias["bias"]
-            ) for logit_bias in args["model_provider"]["gensettings"]["sample_args"]["logit_biases"]]
-        # phrase biases are an array in args['model_provider']['gensettings']['phrase_biases']
-        phrase_biases = None
-        if 'phrase_biases' in args["model_provider"]["gensettings"]["sample_args"]:
-            phrase_biases = [ModelPhraseBiasArgs(
-                sequences=phrase_bias["sequences"],
-                bias=phrase_bias["bias"],
-                ensure_sequence_finish=phrase_bias["ensure_sequence_finish"],
-                generate_once=phrase_bias["generate_once"]
-            ) for phrase_bias in args["model_provider"]["gensettings"]["sample_args"]["phrase_biases"]]
-        
-        sample_args = ModelSampleArgs(
-            temp=get_item(args["model_provider"]["gensettings"]["sample_args"], "temp"),
-            top_p=get_item(args["model_provider"]["gensettings"]["sample_args"], "top_p"),
-            top_a=get_item(args["model_provider"]["gensettings"]["sample_args"], "top_a"),
-            top_k=get_item(args["model_provider"]["gensettings"]["sample_args"], "top_k"),
-            typical_p=get_item(args["model_provider"]["gensettings"]["sample_args"], "typical_p"),
-            tfs=get_item(args["model_provider"]["gensettings"]["sample_args"], "tfs"),
-            rep_p=get_item(args["model_provider"]["gensettings"]["sample_args"], "rep_p"),
-            rep_p_range=get_item(args["model_provider"]["gensettings"]["sample_args"], "rep_p_range"),
-            rep_p_slope=get_item(args["model_provider"]["gensettings"]["sample_args"], "rep_p_slope"),
-            bad_words=get_item(args["model_provider"]["gensettings"]["sample_args"], "bad_words"),
-            logit_biases=logit_biases,
-            phrase_biases=phrase_biases
-        )
-
-        request = ModelGenRequest(
-            model=args["model_provider"]["gensettings"]["model"],
-            prompt='',
-            sample_args=sample_args,
-            gen_args=gen_args
-        )
+        request = get_gen_request(args["model_provider"]["gensettings"])
 
+        endpoints = args["model_provider"]["endpoint"]
+        # with a shared dict, configs with the same endpoints and transport settings share
+        # one connection pool and balancer, while keeping their own gensettings
+        if shared is not None or 'transport' in args["model_provider"] or 'balancing' in args["model_provider"] or isinstance(endpoints, list):
+            # pooled keep-alive connections with concurrency caps, timeouts and retries,
+            # balanced over every endpoint when there are several
+            transport, balancer = get_pool(args["model_provider"], shared)
+            balancing = args["model_provider"].get("balancing", {})
+            return PooledSukima_ModelProvider(
+                endpoint_url=endpoints,
+                username=args["model_provider"]["username"],
+                password=args["model_provider"]["password"],
+                args=request,
+                balancer=balancer,
+                hedge=balancing.get("hedge", False),
+                hedge_quantile=balancing.get("hedge_quantile", 0.95),
+                hedge_min_samples=balancing.get("hedge_min_samples", 20),
+                transport=transport
+            )
         return Sukima_ModelProvider(
             endpoint_url=args["model_provider"]["endpoint"],
             username=args["model_provider"]["username"],
             password=args["model_provider"]["password"],
             args=request
         )
+    elif args["model_provider"]["name"] == "stub":
+        # the same request args as Sukima, so the clients can tweak them the same way
+        return Stub_ModelProvider(
+            args=get_gen_request(args["model_provider"].get("gensettings", {})),
+            **args["model_provider"].get("stub_args", {})
+        )
     else:
         raise Exception('model_provider is not supported.')
@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import asyncio
+import threading
+
+from .logging import get_logger
+from .utils import atomic_write
+
+logger = get_logger(__name__)
+
+# one registry per file, shared by DiscordBot and AuthCog
+registries = {}
+
+def get_auth_registry(filename='auth.json', shared=None):
+    if filename not in registries:
+        registries[filename] = AuthRegistry(filename)
+    if shared is not None:
+        registries[filename].shared = shared
+    return registries[filename]
+
+
+class AuthRegistry(object):
+
+    """In-memory index of the channels authorized in auth.json.
+
+    Lookups never touch the disk except for a stat() every reload_interval
+    seconds to pick up edits made to the file by hand. Changes are written
+    back from a worker thread by writing a temporary file and renaming it
+    over the old one, so readers never see a half-written file.
+
+    When several shard processes use the same file, a shared store lock
+    makes toggle() re-read the file and write it back before anyone else
+    can, so no process overwrites another's change. That blocks, so the
+    event loop calls toggle_async(), which runs it in a thread.
+    """
+
+    def __init__(self, filename='auth.json', reload_interval=5.0):
+        self.filename = filename
+        self.reload_interval = reload_interval
+        self.shared = None
+        self.channels = {} # {channel_id: {}}, same layout as the file
+
+        self._mtime = None
+        self._checked = time.monotonic()
+        self._version = 0 # bumped on every change
+        self._written = 0 # last version that made it to disk
+        self._write_lock = threading.Lock()
+
+        self.load()
+
+    def load(self):
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+        except FileNotFoundError:
+            logger.info(f'Auth file not found. Writing a new one to {self.filename}...')
+            self.channels = {"0":{}}
+            self._write(self._version, json.dumps(self.channels))
+            return
+
+        with open(self.filename, 'r') as fp:
+            self.channels = json.load(fp)
+        self._mtime = mtime
+        logger.info(f'Loaded {len(self.channels)} authorized channels from {self.filename}')
+
+    def refresh(self):
+        now = time.monotonic()
+        if now - self._checked < self.reload_interval:
+            return
+        self._checked = now
+
+        if self._version != self._written:
+            # our own changes are still on their way to disk
+            return
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+        except OSError:
+            return
+        if mtime != self._mtime:
+            logger.info(f'{self.filename} changed on disk, reloading...')
+            try:
+                self.load()
+            except ValueError as e:
+                logger.error(f'Failed to reload {self.filename}: {e}')
+                self._mtime = mtime
+
+    def is_authorized(self, channel_id):
+        self.refresh()
+        return str(channel_id) in self.channels
+
+    def __contains__(self, channel_id):
+        return self.is_authorized(channel_id)
+
+    def toggle(self, channel_id):
+        """Flip the authorization of a channel and return whether it is now
+        authorized.
+        """
+        channel_id = str(channel_id)
+        if self.shared is not None:
+            with self.shared.lock():
+                self.load()
+                authorized = self._toggle(channel_id)
+                self._write(self._version, json.dumps(self.channels))
+            return authorized
+        authorized = self._toggle(channel_id)
+        self.persist()
+        return authorized
+
+    async def toggle_async(self, channel_id):
+        # with a shared store, toggle() waits on a cross-process lock and reads the file
+        if self.shared is None:
+            return self.toggle(channel_id)
+        return await asyncio.get_running_loop().run_in_executor(None, self.toggle, channel_id)
+
+    def _toggle(self, channel_id):
+        if channel_id in self.channels:
+            del self.channels[channel_id]
+            authorized = False
+        else:
+            self.channels[channel_id] = {}
+            authorized = True
+        self._version += 1
+        return authorized
+
+    def persist(self):
+        snapshot = (self._version, json.dumps(self.channels))
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(*snapshot)
+            return
+        loop.run_in_executor(None, self._write, *snapshot)
+
+    def _write(self, version, data):
+        with self._write_lock:
+            if version < self._written:
+                # a newer snapshot is already on disk
+                return
+            try:
+                atomic_write(self.filename, data)
+            except Exception as e:
+                logger.error(f'Failed to write {self.filename}: {e}')
+                return
+            self._mtime = os.stat(self.filename).st_mtime_ns
+            self._written = version
@@ -0,0 +1,126 @@
+import math
+import time
+import random
+import collections
+
+from .logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class Endpoint(object):
+    def __init__(self, url, window=256):
+        self.url = url.rstrip('/')
+        self.outstanding = 0
+        self.ewma = None # seconds
+        self.updated = 0.0
+        self.latencies = collections.deque(maxlen=window)
+        self.failures = 0 # in a row
+        self.ejected_until = 0.0
+
+        self.requests = 0
+        self.errors = 0
+        self.ejections = 0
+
+    def quantile(self, q):
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+class EndpointBalancer(object):
+
+    """Picks which model server a request goes to.
+
+    'least_outstanding' sends each request to the endpoint with the fewest
+    requests in flight. 'ewma' weighs that by a moving average of each
+    endpoint's latency, so a slow node gets less of the traffic even when
+    it isn't backed up yet; the average fades while an endpoint gets no
+    traffic, so one slow reply doesn't keep a node out for good. An
+    endpoint that fails eject_after times in a row is left out for
+    eject_time seconds. If every endpoint is ejected, the one that comes
+    back first is used anyway rather than failing.
+    """
+
+    policies = ('least_outstanding', 'ewma')
+
+    def __init__(self, urls, policy='least_outstanding', eject_after=3, eject_time=30.0, ewma_decay=0.3, ewma_idle=10.0, window=256):
+        if not urls:
+            raise ValueError('At least one endpoint is required')
+        if policy not in self.policies:
+            raise ValueError(f'Unknown balancing policy: {policy}')
+
+        self.endpoints = [Endpoint(url, window=window) for url in urls]
+        self.policy = policy
+        self.eject_after = eject_after
+        self.eject_time = eject_time
+        self.ewma_decay = ewma_decay
+        self.ewma_idle = ewma_idle
+
+    def _cost(self, endpoint, now):
+        if self.policy == 'ewma':
+            # unmeasured endpoints go first so they get a latency
+            ewma = (endpoint.ewma or 0.0) * math.exp((endpoint.updated - now) / self.ewma_idle)
+            return ewma * (endpoint.outstanding + 1)
+        return endpoint.outstanding
+
+    def pick(self, exclude=()):
+        candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude]
+        if not candidates:
+            return None
+        now = time.monotonic()
+        healthy = [endpoint for endpoint in candidates if endpoint.ejected_until <= now]
+        if not healthy:
+            return min(candidates, key=lambda endpoint: endpoint.ejected_until)
+        costs = [self._cost(endpoint, now) for endpoint in healthy]
+        best = min(costs)
+        # ties are broken at random so equal nodes share the load
+        return random.choice([endpoint for endpoint, cost in zip(healthy, costs) if cost == best])
+
+    def healthy(self):
+        now = time.monotonic()
+        return sum(1 for endpoint in self.endpoints if endpoint.ejected_until <= now)
+
+    def begin(self, endpoint):
+        endpoint.outstanding += 1
+        endpoint.requests += 1
+        return time.monotonic()
+
+    def end(self, endpoint, started, ok):
+        endpoint.outstanding -= 1
+        if not ok:
+            endpoint.errors += 1
+            endpoint.failures += 1
+            if endpoint.failures >= self.eject_after:
+                endpoint.failures = 0
+                endpoint.ejected_until = time.monotonic() + self.eject_time
+                endpoint.ejections += 1
+                logger.warning(f'Ejected model endpoint {endpoint.url} for {self.eject_time}s after {self.eject_after} failures in a row')
+            return
+        now = time.monotonic()
+        elapsed = now - started
+        endpoint.updated = now
+        endpoint.failures = 0
+        endpoint.latencies.append(elapsed)
+        if endpoint.ewma is None:
+            endpoint.ewma = elapsed
+        else:
+            endpoint.ewma += self.ewma_decay * (elapsed - endpoint.ewma)
+
+    def cancel(self, endpoint):
+        # a request given up on by the caller says nothing about the endpoint
+        endpoint.outstanding -= 1
+
+    def stats(self):
+        now = time.monotonic()
+        return {endpoint.url: {
+            'outstanding': endpoint.outstanding,
+            'requests': endpoint.requests,
+            'errors': endpoint.errors,
+            'ejections': endpoint.ejections,
+            'ejected': endpoint.ejected_until > now,
+            'ewma': endpoint.ewma,
+            'p50': endpoint.quantile(0.5),
+            'p95': endpoint.quantile(0.95),
+        } for endpoint in self.endpoints}
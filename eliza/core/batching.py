@@ -0,0 +1,59 @@
+import asyncio
+
+from .logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class HiddenBatcher(object):
+
+    """Sends hidden state requests in batches of up to max_batch_size.
+
+    The memory ingest workers already take everything that is queued into
+    one hidden_batch_async() call, so there is no time window to wait for
+    more. Providers that implement hidden_batch_async(model, texts, layer)
+    get a single request per batch. Sukima has no batch endpoint, so for
+    the Sukima providers a batch goes out as concurrent single requests,
+    which the pooled transport spreads over its connections and slots.
+    hidden_async() is passed through, so this can be used anywhere a model
+    provider's hidden_async() is.
+    """
+
+    def __init__(self, model_provider, max_batch_size=16):
+        if max_batch_size <= 0:
+            raise ValueError('Batch size should be > 0')
+
+        self.model_provider = model_provider
+        self.max_batch_size = max_batch_size
+
+        self.requests = 0
+        self.batches = 0
+
+    async def hidden_async(self, model, text, layer=-1):
+        self.requests += 1
+        self.batches += 1
+        return await self.model_provider.hidden_async(model, text, layer=layer)
+
+    async def hidden_batch_async(self, model, texts, layer=-1):
+        texts = list(texts)
+        batches = [texts[start:start + self.max_batch_size] for start in range(0, len(texts), self.max_batch_size)]
+        results = await asyncio.gather(*[self._send(model, batch, layer) for batch in batches])
+        return [vector for vectors in results for vector in vectors]
+
+    async def _send(self, model, texts, layer):
+        self.requests += len(texts)
+        self.batches += 1
+        if hasattr(self.model_provider, 'hidden_batch_async'):
+            vectors = await self.model_provider.hidden_batch_async(model, texts, layer=layer)
+        else:
+            vectors = await asyncio.gather(*[self.model_provider.hidden_async(model, text, layer=layer) for text in texts])
+        if len(vectors) != len(texts):
+            raise Exception(f'Expected {len(texts)} hidden states, got {len(vectors)}')
+        return vectors
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'batches': self.batches,
+            'avg_batch_size': self.requests / self.batches if self.batches else 0.0,
+        }
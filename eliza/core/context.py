@@ -0,0 +1,153 @@
+import time
+import hashlib
+import collections
+
+from transformers import AutoTokenizer
+
+from .logging import get_logger
+
+logger = get_logger(__name__)
+
+# tokenizers are expensive to load, share them between bots
+tokenizers = {}
+
+def get_tokenizer(name='gpt2'):
+    if name not in tokenizers:
+        tokenizers[name] = AutoTokenizer.from_pretrained(name)
+    return tokenizers[name]
+
+
+class TokenCache(object):
+
+    """LRU cache of tokenized text keyed by a hash of its content.
+
+    Chat lines and memories repeat from one turn to the next, so most of a
+    context is served from here instead of going through the tokenizer.
+    """
+
+    def __init__(self, tokenizer, max_entries=4096):
+        if max_entries <= 0:
+            raise ValueError('Token cache size should be > 0')
+
+        self.tokenizer = tokenizer
+        self.max_entries = max_entries
+        self._tokens = collections.OrderedDict() # {digest: tuple of token ids}
+
+        self.hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+        self.miss_tokens = 0
+        self.encode_time = 0.0
+
+    def encode(self, text):
+        key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+        tokens = self._tokens.get(key)
+        if tokens is not None:
+            self._tokens.move_to_end(key)
+            self.hits += 1
+            self.hit_tokens += len(tokens)
+            return tokens
+
+        started = time.perf_counter()
+        tokens = tuple(self.tokenizer.encode(text))
+        self.encode_time += time.perf_counter() - started
+        self.misses += 1
+        self.miss_tokens += len(tokens)
+
+        self._tokens[key] = tokens
+        if len(self._tokens) > self.max_entries:
+            self._tokens.popitem(last=False)
+        return tokens
+
+    def decode(self, tokens):
+        return self.tokenizer.decode(list(tokens))
+
+    def saved_time(self):
+        # estimated from the measured cost per token of the misses
+        if not self.miss_tokens:
+            return 0.0
+        return self.hit_tokens * self.encode_time / self.miss_tokens
+
+    def stats(self):
+        return {
+            'entries': len(self._tokens),
+            'hits': self.hits,
+            'misses': self.misses,
+            'encode_time': self.encode_time,
+            'saved_time': self.saved_time(),
+        }
+
+
+class ContextBuilder(object):
+
+    """Builds the model context from the persona prompt, memories and
+    conversation without re-tokenizing what was already seen.
+
+    The layout matches what build_ctx produced through ContextPreprocessor:
+    memories first, then the prompt, then the conversation and the bot's
+    name. The prompt is tokenized once. The conversation keeps up to
+    reserved_tokens before memories get any room, and both are trimmed from
+    the top one line at a time using cached token counts; only a line that
+    is too long to fit on its own is decoded from its token array.
+    """
+
+    def __init__(self, tokenizer, name, prompt, context_size, reserved_tokens=512, cache_size=4096):
+        self.token_cache = TokenCache(tokenizer, max_entries=cache_size)
+        self.context_size = context_size
+        self.reserved_tokens = reserved_tokens
+
+        self.prompt = f'{prompt}\n'
+        self.prompt_tokens = tuple(tokenizer.encode(self.prompt))
+        self.suffix = f'\n{name}:'
+        self.suffix_tokens = tuple(tokenizer.encode(self.suffix))
+
+    def _lines(self, text):
+        lines = text.split('\n')
+        return lines, [len(self.token_cache.encode(f'{line}\n')) for line in lines]
+
+    def _fit(self, lines, counts, budget):
+        # keep the most recent lines that fit, only cutting a line when not even
+        # the newest one fits on its own
+        kept = []
+        used = 0
+        for line, count in zip(reversed(lines), reversed(counts)):
+            if used + count <= budget:
+                kept.append(line)
+                used += count
+                continue
+            remaining = budget - used
+            if not kept and remaining > 1:
+                tokens = self.token_cache.encode(f'{line}\n')
+                kept.append(self.token_cache.decode(tokens[-remaining:]).rstrip('\n'))
+                used = budget
+            break
+        kept.reverse()
+        return kept, used
+
+    def build(self, conversation, memories=None):
+        hits, saved = self.token_cache.hits, self.token_cache.saved_time()
+
+        budget = self.context_size - len(self.suffix_tokens)
+        prompt = self.prompt
+        if len(self.prompt_tokens) > budget:
+            prompt = self.token_cache.decode(self.prompt_tokens[-budget:])
+        budget -= min(len(self.prompt_tokens), budget)
+
+        conversation_lines, conversation_counts = self._lines(conversation)
+        reserved = min(self.reserved_tokens, sum(conversation_counts), budget)
+
+        memories_text = ''
+        if memories:
+            memory_lines, memory_counts = self._lines(memories)
+            memory_lines, used = self._fit(memory_lines, memory_counts, budget - reserved)
+            if memory_lines:
+                memories_text = '\n'.join(memory_lines) + '\n'
+            budget -= used
+
+        conversation_lines, _ = self._fit(conversation_lines, conversation_counts, budget)
+
+        logger.info(f'Built context - Cached lines: {self.token_cache.hits - hits} - Tokenizer time saved: {(self.token_cache.saved_time() - saved) * 1000:.2f}ms')
+        return memories_text + prompt + '\n'.join(conversation_lines) + self.suffix
+
+    def stats(self):
+        return self.token_cache.stats()
@@ -0,0 +1,130 @@
+import time
+import heapq
+import asyncio
+import traceback
+
+from .logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class IdleScheduler(object):
+
+    """Calls callback(message) once a channel has been quiet for interval
+    seconds after someone else's message.
+
+    The last message of every channel is tracked from the gateway events
+    passed to touch(), and the deadlines are kept in a min-heap, so the
+    loop sleeps until the next channel is due instead of polling the
+    channels' history. A message from the bot itself clears the channel's
+    deadline, so the bot doesn't talk to itself. Superseded deadlines stay
+    in the heap and are skipped when they come up.
+
+    A fired channel is due again retry_delay seconds later if the callback
+    returns False, raises, or its caller reports the reply failed through
+    retry(), unless a message came in since. done() ends that.
+    """
+
+    def __init__(self, callback, interval, retry_delay=10.0):
+        self.callback = callback
+        self.interval = interval
+        self.retry_delay = retry_delay
+        self.last = {} # {channel_id: (deadline, message)}
+        self.in_flight = {} # {channel_id: message} fired and not yet answered
+        self.deadlines = [] # heap of (deadline, channel_id)
+        self._wakeup = None
+        self._task = None
+        self._firing = set()
+
+        self.fired = 0
+        self.failed = 0
+        self.retried = 0
+
+    def touch(self, message, from_bot):
+        channel_id = message.channel.id
+        if from_bot:
+            self.last.pop(channel_id, None)
+            self.in_flight.pop(channel_id, None)
+            return
+        deadline = message.created_at.timestamp() + self.interval
+        current = self.last.get(channel_id)
+        if current is not None and current[0] >= deadline:
+            # an older message seen late, e.g. when seeding
+            return
+        self.in_flight.pop(channel_id, None)
+        self._arm(channel_id, deadline, message)
+
+    def _arm(self, channel_id, deadline, message):
+        self.last[channel_id] = (deadline, message)
+        heapq.heappush(self.deadlines, (deadline, channel_id))
+        if len(self.deadlines) > 2 * len(self.last) + 64:
+            # busy channels pile up superseded deadlines, drop them
+            self.deadlines = [(deadline, channel_id) for channel_id, (deadline, _) in self.last.items()]
+            heapq.heapify(self.deadlines)
+        if self._wakeup is not None and self.deadlines[0] == (deadline, channel_id):
+            # due sooner than what the loop is sleeping for
+            self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            while self.deadlines and self.deadlines[0][0] <= now:
+                deadline, channel_id = heapq.heappop(self.deadlines)
+                current = self.last.get(channel_id)
+                if current is None or current[0] != deadline:
+                    continue
+                del self.last[channel_id]
+                self.in_flight[channel_id] = current[1]
+                task = asyncio.ensure_future(self._fire(current[1]))
+                self._firing.add(task)
+                task.add_done_callback(self._firing.discard)
+            timeout = self.deadlines[0][0] - now if self.deadlines else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, message):
+        self.fired += 1
+        try:
+            if await self.callback(message) is False:
+                self.retry(message)
+        except Exception:
+            self.failed += 1
+            logger.error(f'Failed to send an idle message - Channel: {message.channel.id}')
+            logger.error(traceback.format_exc())
+            self.retry(message)
+
+    def retry(self, message):
+        # the idle message wasn't sent, try again soon like the old polling loop did
+        channel_id = message.channel.id
+        if self.in_flight.get(channel_id) is not message:
+            # someone spoke since, their message has its own deadline
+            return
+        del self.in_flight[channel_id]
+        self.retried += 1
+        self._arm(channel_id, time.time() + self.retry_delay, message)
+
+    def done(self, message):
+        if self.in_flight.get(message.channel.id) is message:
+            del self.in_flight[message.channel.id]
+
+    def stats(self):
+        return {
+            'channels': len(self.last),
+            'pending': len(self.deadlines),
+            'fired': self.fired,
+            'failed': self.failed,
+            'retried': self.retried,
+        }
@@ -0,0 +1,169 @@
+import json
+import time
+import asyncio
+import hashlib
+import collections
+
+from .logging import get_logger
+from .utils import atomic_write
+
+logger = get_logger(__name__)
+
+
+class ImageLabelCache(object):
+
+    """Cache of image labeling results keyed by image content.
+
+    Images are identified by the SHA-256 of their bytes, so a repost under a
+    new URL still hits; when the image can't be read the proxy URL is used
+    instead. Entries expire after ttl seconds and the least recently used
+    ones are dropped past max_entries. Concurrent requests for the same image
+    share one labeling call. With a filename the cache is saved to disk in
+    the background and loaded again on the next start.
+    """
+
+    def __init__(self, namespace, max_entries=1024, ttl=86400.0, filename=None, max_hash_size=8 * 1024 * 1024):
+        if max_entries <= 0:
+            raise ValueError('Image label cache size should be > 0')
+
+        # results are only valid for the model and label sets they came from
+        self.namespace = hashlib.sha256(namespace.encode('utf-8')).hexdigest()[:16]
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.filename = filename
+        self.max_hash_size = max_hash_size
+
+        self._entries = collections.OrderedDict() # {key: (expires_at, labels)}
+        self._urls = collections.OrderedDict() # {proxy_url: key}
+        self._inflight = {} # {key: future}
+        self._save_handle = None
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+        if self.filename is not None:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as fp:
+                data = json.load(fp)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            logger.error(f'Failed to load image label cache from {self.filename}: {e}')
+            return
+        if data.get('namespace') != self.namespace:
+            logger.info('Image label sets changed, discarding the saved image label cache.')
+            return
+        now = time.time()
+        for key, (expires_at, labels) in data['entries']:
+            if expires_at > now:
+                self._entries[key] = (expires_at, labels)
+        self._trim()
+        logger.info(f'Loaded {len(self._entries)} cached image labels from {self.filename}')
+
+    def _trim(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        while len(self._urls) > self.max_entries:
+            self._urls.popitem(last=False)
+
+    async def key(self, attachment):
+        url = attachment.proxy_url
+        if url in self._urls:
+            return self._urls[url]
+        key = f'url:{url}'
+        if attachment.size <= self.max_hash_size:
+            try:
+                key = f'sha256:{hashlib.sha256(await attachment.read(use_cached=True)).hexdigest()}'
+            except Exception as e:
+                logger.info(f'Could not read attachment, caching labels by URL: {e}')
+        self._urls[url] = key
+        self._trim()
+        return key
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, labels):
+        self._entries[key] = (time.time() + self.ttl, labels)
+        self._entries.move_to_end(key)
+        self._trim()
+        if self.filename is not None:
+            self.save()
+
+    async def labels(self, attachment, fetch):
+        """Return the labels for an attachment, calling fetch() to compute
+        them only if no cached or in-flight result exists.
+        """
+        key = await self.key(attachment)
+        labels = self.get(key)
+        if labels is not None:
+            self.hits += 1
+            return labels
+
+        if key in self._inflight:
+            self.coalesced += 1
+            return await asyncio.shield(self._inflight[key])
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            labels = await fetch()
+        except Exception as e:
+            future.set_exception(e)
+            # the waiters get the exception, nobody has to retrieve it from here
+            future.exception()
+            raise
+        else:
+            future.set_result(labels)
+            self.put(key, labels)
+            return labels
+        finally:
+            if not future.done():
+                # fetch() was cancelled, let the waiters try again themselves
+                future.cancel()
+            del self._inflight[key]
+
+    def save(self, delay=5.0):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(list(self._entries.items()))
+            return
+        if self._save_handle is None:
+            # batch the entries of the next few seconds into one write
+            self._save_handle = loop.call_later(delay, self._flush, loop)
+
+    def _flush(self, loop):
+        self._save_handle = None
+        # snapshot on the event loop, serialize and write on the executor
+        loop.run_in_executor(None, self._write, list(self._entries.items()))
+
+    def _write(self, entries):
+        data = json.dumps({
+            'namespace': self.namespace,
+            'entries': entries,
+        })
+        try:
+            atomic_write(self.filename, data)
+        except Exception as e:
+            logger.error(f'Failed to save image label cache to {self.filename}: {e}')
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+        }
@@ -1,16 +1,211 @@
 import os
+import json
+import gzip
 import time
+import queue
+import atexit
+import shutil
 import logging
+import datetime
+import contextlib
+import contextvars
+import logging.handlers
 
-# check if log directory exists
-if not os.path.exists('logs'):
-    os.makedirs('logs')
+FORMAT = '[%(asctime)s] %(levelname)s: %(message)s'
+DATEFMT = '%Y-%m-%d %H:%M:%S'
+DEFAULT_FILE = f'logs/{time.strftime("%Y-%m-%d_%H-%M-%S")}.log'
+
+# fields of the message being handled, added to every record logged meanwhile
+_context = contextvars.ContextVar('log_context', default={})
+
+_state = {'handler': None, 'listener': None, 'buffer': None}
+
+
+def set_log_context(**fields):
+    return _context.set({**_context.get(), **fields})
+
+def reset_log_context(token):
+    _context.reset(token)
+
+@contextlib.contextmanager
+def log_context(**fields):
+    token = set_log_context(**fields)
+    try:
+        yield
+    finally:
+        reset_log_context(token)
+
+
+class ContextFilter(logging.Filter):
+    # runs in the thread that logs, where the context is still set
+    def filter(self, record):
+        record.context = _context.get()
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'context', {}))
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # a full queue loses the record instead of waiting for the disk
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LineWriter(object):
+    # appends lines to a data file from a listener thread, the same way the logs are written
+    def __init__(self, filename, queue_size=10000):
+        file_handler = logging.FileHandler(filename, encoding='utf-8')
+        file_handler.setFormatter(logging.Formatter('%(message)s'))
+        self.handler = DroppingQueueHandler(queue.Queue(queue_size))
+        self.listener = logging.handlers.QueueListener(self.handler.queue, file_handler)
+        self.listener.start()
+
+    def write(self, line):
+        self.handler.handle(logging.makeLogRecord({'msg': line, 'levelno': logging.INFO, 'levelname': 'INFO'}))
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            for file_handler in self.listener.handlers:
+                file_handler.close()
+            self.listener = None
+
+
+class StartupBuffer(logging.handlers.BufferingHandler):
+    # holds what's logged before main has read the config, up to capacity records
+    def shouldFlush(self, record):
+        return False
+
+    def emit(self, record):
+        if len(self.buffer) < self.capacity:
+            self.buffer.append(record)
+
+    def replay(self, handler):
+        with self.lock:
+            for record in self.buffer:
+                if logging.getLogger(record.name).isEnabledFor(record.levelno):
+                    handler.handle(record)
+            self.buffer.clear()
+
+
+def gzip_namer(name):
+    return name + '.gz'
+
+def gzip_rotator(source, dest):
+    with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(source)
+
+
+def get_file_handler(options, suffix=None):
+    filename = options.get('file', DEFAULT_FILE)
+    if suffix is not None:
+        root, ext = os.path.splitext(filename)
+        filename = f'{root}.{suffix}{ext}'
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    if options.get('max_bytes', None):
+        handler = logging.handlers.RotatingFileHandler(
+            filename,
+            maxBytes=options['max_bytes'],
+            backupCount=options.get('backup_count', 5),
+            encoding='utf-8'
+        )
+        if options.get('compress', True):
+            handler.namer = gzip_namer
+            handler.rotator = gzip_rotator
+    else:
+        # appended to, a configured file keeps the earlier runs; the default name is new every run
+        handler = logging.FileHandler(filename, encoding='utf-8')
+
+    if options.get('format', 'text') == 'json':
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(FORMAT, datefmt=DATEFMT))
+    return handler
+
+
+def setup_logging(options=None, suffix=None):
+    """Log through a queue that a listener thread drains into the log file.
+
+    The calling thread only puts the record on the queue, so a slow disk
+    never stalls the event loop; formatting, writing, rotating and
+    compressing all happen on the listener thread. options is the logging
+    block of the config. suffix is added to the file name, for processes
+    that can't share a file. Records logged before the first call are
+    kept and written once it is made.
+    """
+    options = options or {}
+    handler = DroppingQueueHandler(queue.Queue(options.get('queue_size', 10000)))
+    handler.addFilter(ContextFilter())
+    listener = logging.handlers.QueueListener(handler.queue, get_file_handler(options, suffix), respect_handler_level=True)
+    listener.start()
+
+    root = logging.getLogger()
+    root.setLevel(options.get('level', 'INFO').upper())
+    for name, level in options.get('levels', {}).items():
+        logging.getLogger(name).setLevel(level.upper())
+    # the new handler goes in before the old one is drained, so nothing is lost in between
+    root.addHandler(handler)
+    stop_logging()
+    _state.update(handler=handler, listener=listener)
+    if _state['buffer'] is not None:
+        # what was logged at startup goes to the configured file too
+        root.removeHandler(_state['buffer'])
+        _state['buffer'].replay(handler)
+        _state['buffer'] = None
+
+def stop_logging():
+    # drains what's queued, then closes the file
+    handler, listener = _state['handler'], _state['listener']
+    if handler is None:
+        return
+    logging.getLogger().removeHandler(handler)
+    _state.update(handler=None, listener=None)
+    listener.stop()
+    for file_handler in listener.handlers:
+        if handler.dropped:
+            file_handler.handle(logging.makeLogRecord({
+                'name': __name__,
+                'levelno': logging.WARNING,
+                'levelname': 'WARNING',
+                'msg': f'Log queue was full, dropped {handler.dropped} records',
+            }))
+        file_handler.close()
+
+def _after_fork():
+    # the listener thread doesn't survive a fork, the child sets up its own
+    if _state['handler'] is not None:
+        logging.getLogger().removeHandler(_state['handler'])
+    _state.update(handler=None, listener=None)
 
-logging.basicConfig(level=logging.INFO,
-                    format='[%(asctime)s] %(levelname)s: %(message)s',
-                    datefmt='%Y-%m-%d %H:%M:%S',
-                    filename=f'logs/{time.strftime("%Y-%m-%d_%H-%M-%S")}.log',
-                    filemode='w')
 
 def get_logger(name):
-    return logging.getLogger(name)
\ No newline at end of file
+    return logging.getLogger(name)
+
+
+# nothing is written until main has read the logging config, so no file is opened that isn't configured
+_state['buffer'] = StartupBuffer(10000)
+logging.getLogger().addHandler(_state['buffer'])
+logging.getLogger().setLevel(logging.INFO)
+atexit.register(stop_logging)
+os.register_at_fork(after_in_child=_after_fork)
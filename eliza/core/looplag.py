@@ -0,0 +1,65 @@
+import time
+import asyncio
+
+from .logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class LoopLagMonitor(object):
+
+    """Measures how late the event loop wakes up from a short sleep.
+
+    A busy loop delays every gateway event and reply by about this much, so
+    it is the number to watch when deciding to spread shards over more
+    processes. Every report_interval seconds the average and worst lag of
+    the window are passed to callback and the window starts over.
+    """
+
+    def __init__(self, callback=None, interval=0.5, report_interval=30.0):
+        self.callback = callback
+        self.interval = interval
+        self.report_interval = report_interval
+        self._task = None
+        self._reset()
+
+    def _reset(self):
+        self.samples = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        reported = time.monotonic()
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self.samples += 1
+            self.total += lag
+            self.max = max(self.max, lag)
+            if now - reported >= self.report_interval:
+                reported = now
+                stats = self.stats()
+                self._reset()
+                if self.callback is not None:
+                    try:
+                        self.callback(stats)
+                    except Exception as e:
+                        logger.error(f'Failed to report event loop lag: {e}')
+
+    def stats(self):
+        return {
+            'avg': self.total / self.samples if self.samples else 0.0,
+            'max': self.max,
+            'samples': self.samples,
+        }
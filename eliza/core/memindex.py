@@ -0,0 +1,177 @@
+import time
+import asyncio
+
+import numpy as np
+from shimeji.memory import str_to_numpybin
+
+from .logging import get_logger
+
+logger = get_logger(__name__)
+
+# one index per memory store and encoding, shared by the personas using that store
+indexes = {}
+
+def get_memory_index(memory_store, encoding_model, dtype='float32', refresh_interval=None):
+    key = (id(memory_store), encoding_model, np.dtype(dtype).name)
+    if key not in indexes:
+        indexes[key] = MemoryIndex(encoding_model, dtype=dtype, refresh_interval=refresh_interval)
+    return indexes[key]
+
+
+class IndexedMemory(object):
+    # same fields the memory store hands back, for memories added after warm-up
+    def __init__(self, author_id, author, text, encoding_model, encoding):
+        self.author_id = author_id
+        self.author = author
+        self.text = text
+        self.encoding_model = encoding_model
+        self.encoding = encoding
+
+
+class MemoryIndex(object):
+
+    """In-process vector index over the memory store.
+
+    The store is read once; after that new memories are appended as they are
+    ingested. Embeddings live in one contiguous, L2-normalized matrix so a
+    turn costs a single vectorized scan instead of fetching and decoding the
+    whole memory table. candidates() returns the short-term tail plus the
+    best long-term matches, which is all memory_context needs to see.
+
+    Other processes writing to the same store (shard workers, other bots)
+    don't go through add(), so with a refresh_interval refresh() reads the
+    store again once that many seconds have passed. The rows are decoded
+    into a new matrix on a worker thread and swapped in when it's done.
+    """
+
+    chunk_size = 65536
+
+    def __init__(self, encoding_model, dtype='float32', capacity=1024, refresh_interval=None):
+        self.encoding_model = encoding_model
+        self.dtype = np.dtype(dtype)
+        self.refresh_interval = refresh_interval
+        self.memories = []
+        self._matrix = None
+        self._capacity = capacity
+
+        self.warmed = False
+        self._loaded = None # when the store was last read
+        self._warm_lock = None
+        self._pending = None # memories ingested while reading the store
+        self.skipped = 0
+        self.refreshes = 0
+
+    def __len__(self):
+        return len(self.memories)
+
+    async def warm(self, memory_store):
+        if self.warmed:
+            return
+        await self._load(memory_store, False)
+
+    async def refresh(self, memory_store):
+        if self.refresh_interval is None or not self.warmed or time.monotonic() - self._loaded < self.refresh_interval:
+            return
+        try:
+            await self._load(memory_store, True)
+        except Exception as e:
+            # keep the memories we have and try again after another interval
+            self._loaded = time.monotonic()
+            logger.error(f'Failed to refresh memory index: {e!r}')
+
+    async def _load(self, memory_store, refresh):
+        if self._warm_lock is None:
+            self._warm_lock = asyncio.Lock()
+        async with self._warm_lock:
+            if self.warmed and (not refresh or time.monotonic() - self._loaded < self.refresh_interval):
+                # someone else read it while we waited
+                return
+            self._pending = []
+            try:
+                memories = await memory_store.get()
+                fresh = MemoryIndex(self.encoding_model, dtype=self.dtype, capacity=self._capacity)
+                await asyncio.get_running_loop().run_in_executor(None, fresh._extend, memories or [])
+            finally:
+                pending, self._pending = self._pending, None
+
+            # anything stored while we were reading may or may not be in the result
+            seen = set((m.author_id, m.text) for m in fresh.memories[-len(pending):]) if pending else set()
+            for memory, vector in pending:
+                if (memory.author_id, memory.text) not in seen:
+                    fresh._append(memory, vector)
+            self.memories, self._matrix, self.skipped = fresh.memories, fresh._matrix, fresh.skipped
+            self._loaded = time.monotonic()
+            if self.warmed:
+                self.refreshes += 1
+                logger.info(f'Refreshed memory index - Memories: {len(self.memories)} - Skipped: {self.skipped}')
+            else:
+                self.warmed = True
+                logger.info(f'Warmed memory index - Memories: {len(self.memories)} - Skipped: {self.skipped}')
+
+    def add(self, memory, vector=None):
+        if self._pending is not None:
+            self._pending.append((memory, vector))
+        if self.warmed:
+            # a refresh in progress picks it up from _pending too
+            self._append(memory, vector)
+
+    def _extend(self, memories):
+        for memory in memories:
+            self._append(memory, None)
+
+    def _append(self, memory, vector):
+        if memory.encoding_model != self.encoding_model:
+            self.skipped += 1
+            return
+        if vector is None:
+            vector = str_to_numpybin(memory.encoding)
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector = vector / norm
+
+        if self._matrix is None:
+            self._matrix = np.zeros((self._capacity, vector.shape[0]), dtype=self.dtype)
+        elif vector.shape[0] != self._matrix.shape[1]:
+            self.skipped += 1
+            return
+        if len(self.memories) == self._matrix.shape[0]:
+            grown = np.zeros((self._matrix.shape[0] * 2, self._matrix.shape[1]), dtype=self.dtype)
+            grown[:len(self.memories)] = self._matrix
+            self._matrix = grown
+
+        self._matrix[len(self.memories)] = vector
+        self.memories.append(memory)
+
+    def _scores(self, query, count):
+        query = query.astype(np.float32)
+        scores = np.empty(count, dtype=np.float32)
+        for start in range(0, count, self.chunk_size):
+            end = min(start + self.chunk_size, count)
+            # float16 rows are widened chunk by chunk so the product runs in BLAS
+            scores[start:end] = self._matrix[start:end].astype(np.float32, copy=False) @ query
+        return scores
+
+    def search(self, query_index, k, limit=None):
+        """Indices of the k memories before limit most similar to the memory
+        at query_index, best first.
+        """
+        if limit is None:
+            limit = len(self.memories)
+        if k <= 0 or limit <= 0:
+            return []
+        scores = self._scores(self._matrix[query_index], limit)
+        if k < limit:
+            top = np.argpartition(-scores, k)[:k]
+        else:
+            top = np.arange(limit)
+        return top[np.argsort(-scores[top])].tolist()
+
+    def candidates(self, short_term, long_term):
+        if not self.memories:
+            return []
+        count = len(self.memories)
+        tail = max(count - short_term, 0)
+        # a few spare matches in case the caller ranks slightly differently
+        top = self.search(count - 1, long_term * 2, limit=tail)
+        return [self.memories[i] for i in sorted(top)] + self.memories[tail:]
@@ -0,0 +1,200 @@
+import time
+import asyncio
+import traceback
+
+from shimeji.memory import array_to_str
+
+from .memindex import IndexedMemory
+from .logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class MemoryItem(object):
+    def __init__(self, author_id, author, text, encode_text, dedupe_text):
+        self.author_id = author_id
+        self.author = author
+        self.text = text
+        self.encode_text = encode_text # what the embedding is computed from
+        self.dedupe_text = dedupe_text # what the duplicate check is run against
+        self.queued_at = time.monotonic()
+
+
+class MemoryIngestQueue(object):
+
+    """Write-behind pipeline for memories.
+
+    submit() only enqueues; a few workers run the duplicate check, the
+    encoding and the insert in the background so none of it sits between a
+    message and its reply. A worker takes up to batch_size waiting items at
+    a time and encodes them in one hidden_batch_async() call when the
+    provider has one. When the queue is full submit() waits for room,
+    which slows producers down instead of growing without bound. close()
+    drains what is left before the workers are stopped.
+    """
+
+    stages = ('queued', 'dedupe', 'encode', 'insert')
+
+    def __init__(self, memory_store, model_provider, mem_args, workers=2, max_queued=256, duplicate_ratio=0.8, memory_index=None, batch_size=16):
+        if workers <= 0:
+            raise ValueError('Memory ingest worker count should be > 0')
+        if batch_size <= 0:
+            raise ValueError('Memory ingest batch size should be > 0')
+
+        self.memory_store = memory_store
+        self.model_provider = model_provider
+        self.mem_args = mem_args
+        self.workers = workers
+        self.max_queued = max_queued
+        self.duplicate_ratio = duplicate_ratio
+        self.memory_index = memory_index
+        self.batch_size = batch_size
+
+        self.queue = None
+        self._tasks = []
+        self._closed = False
+
+        self.ingested = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.batches = 0
+        self.timings = {stage: [0, 0.0, 0.0] for stage in self.stages} # {stage: [count, total, max]}
+
+    def start(self):
+        if self._tasks:
+            return
+        self.queue = asyncio.Queue(maxsize=self.max_queued)
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def submit(self, author_id, author, text, encode_text, dedupe_text=None):
+        if self._closed:
+            raise Exception('Memory ingest queue is closed')
+        self.start()
+        if dedupe_text is None:
+            dedupe_text = text
+        await self.queue.put(MemoryItem(author_id, author, text, encode_text, dedupe_text))
+
+    def _time(self, stage, started):
+        elapsed = time.monotonic() - started
+        timing = self.timings[stage]
+        timing[0] += 1
+        timing[1] += elapsed
+        timing[2] = max(timing[2], elapsed)
+        return time.monotonic()
+
+    async def encode(self, text):
+        return await self.model_provider.hidden_async(
+            self.mem_args['model'],
+            text,
+            layer=self.mem_args['model_layer']
+        )
+
+    async def encode_batch(self, texts):
+        if hasattr(self.model_provider, 'hidden_batch_async'):
+            return await self.model_provider.hidden_batch_async(
+                self.mem_args['model'],
+                texts,
+                layer=self.mem_args['model_layer']
+            )
+        return await asyncio.gather(*[self.encode(text) for text in texts])
+
+    def _failed(self, item):
+        self.failed += 1
+        logger.error(f'Failed to store memory from {item.author}')
+        logger.error(traceback.format_exc())
+
+    async def _ingest(self, items):
+        fresh = []
+        for item in items:
+            started = self._time('queued', item.queued_at)
+            try:
+                duplicate = await self.memory_store.check_duplicates(text=item.dedupe_text, duplicate_ratio=self.duplicate_ratio) != False
+            except Exception:
+                self._failed(item)
+                continue
+            self._time('dedupe', started)
+            if duplicate:
+                self.duplicates += 1
+            else:
+                fresh.append(item)
+        if not fresh:
+            return
+
+        started = time.monotonic()
+        try:
+            encodings = await self.encode_batch([item.encode_text for item in fresh])
+        except Exception:
+            for item in fresh:
+                self._failed(item)
+            return
+        self._time('encode', started)
+        self.batches += 1
+
+        for item, encoding in zip(fresh, encodings):
+            started = time.monotonic()
+            memory = IndexedMemory(
+                author_id=item.author_id,
+                author=item.author,
+                text=item.text,
+                encoding_model=self.mem_args['model'],
+                encoding=array_to_str(encoding)
+            )
+            try:
+                await self.memory_store.add(
+                    author_id=memory.author_id,
+                    author=memory.author,
+                    text=memory.text,
+                    encoding_model=memory.encoding_model,
+                    encoding=memory.encoding
+                )
+            except Exception:
+                self._failed(item)
+                continue
+            self._time('insert', started)
+            if self.memory_index is not None:
+                self.memory_index.add(memory, encoding)
+            self.ingested += 1
+
+    async def _worker(self):
+        while True:
+            items = [await self.queue.get()]
+            # whatever else is waiting goes into the same encoding request
+            while len(items) < self.batch_size and not self.queue.empty():
+                items.append(self.queue.get_nowait())
+            try:
+                await self._ingest(items)
+            except Exception:
+                self.failed += len(items)
+                logger.error(traceback.format_exc())
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+
+    async def close(self, timeout=30.0):
+        if self._closed:
+            return
+        self._closed = True
+        if not self._tasks:
+            return
+        if not self.queue.empty():
+            logger.info(f'Draining {self.queue.qsize()} queued memories...')
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f'Dropped {self.queue.qsize()} memories that were not stored in time')
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logger.info(f'Memory ingest stopped - {self.stats()}')
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize() if self.queue is not None else 0,
+            'ingested': self.ingested,
+            'duplicates': self.duplicates,
+            'failed': self.failed,
+            'batches': self.batches,
+            'avg': {stage: (total / count if count else 0.0) for stage, (count, total, _) in self.timings.items()},
+            'max': {stage: timing[2] for stage, timing in self.timings.items()},
+        }
@@ -0,0 +1,211 @@
+import re
+import sys
+import time
+import types
+import random
+import collections
+
+from .utils import replace_emojis_pings, replace_emojis_pings_inverse
+
+whitespace_re = re.compile(r'\s+')
+user_ping_re = re.compile(r'<@(\d+)>')
+custom_emoji_re = re.compile(r'<:(\w+):(\d+)>')
+
+
+class MentionIndex(object):
+
+    """Per-guild lookup tables for translating between '@name' / ':emoji:'
+    and Discord's '<@id>' / '<:emoji:id>' markup.
+
+    This does the same job as core.utils.replace_emojis_pings and
+    replace_emojis_pings_inverse in a single pass over the text instead of
+    one str.replace per member and emoji, and is kept up to date from the
+    member and emoji events instead of being rebuilt for every message.
+    """
+
+    def __init__(self, members=(), emojis=()):
+        self.member_names = {} # {member_id: name}
+        self.member_ids = {} # {name: [member_id, ...]}, first one wins
+        self.name_lengths = collections.Counter()
+        self._lengths = None # distinct name lengths, longest first
+
+        self.emoji_names = {} # {emoji_id: name}
+        self.emoji_ids = {} # {name: emoji_id}
+
+        for member in members:
+            self.add_member(member)
+        self.set_emojis(emojis)
+
+    @classmethod
+    def from_guild(cls, guild):
+        return cls(members=guild.members, emojis=guild.emojis)
+
+    def add_member(self, member):
+        if member.id in self.member_names:
+            if self.member_names[member.id] == member.name:
+                return
+            self.remove_member(member)
+        self.member_names[member.id] = member.name
+        if member.name not in self.member_ids:
+            self.member_ids[member.name] = []
+            self.name_lengths[len(member.name)] += 1
+            self._lengths = None
+        self.member_ids[member.name].append(member.id)
+
+    def remove_member(self, member):
+        name = self.member_names.pop(member.id, None)
+        if name is None:
+            return
+        ids = self.member_ids[name]
+        ids.remove(member.id)
+        if not ids:
+            del self.member_ids[name]
+            self.name_lengths[len(name)] -= 1
+            if self.name_lengths[len(name)] <= 0:
+                del self.name_lengths[len(name)]
+                self._lengths = None
+
+    def update_member(self, member):
+        if member.id in self.member_names:
+            self.add_member(member)
+
+    def set_emojis(self, emojis):
+        self.emoji_names = {}
+        self.emoji_ids = {}
+        for emoji in emojis:
+            self.emoji_names[emoji.id] = emoji.name
+            if emoji.name not in self.emoji_ids:
+                self.emoji_ids[emoji.name] = emoji.id
+
+    def _name_lengths(self):
+        if self._lengths is None:
+            self._lengths = sorted(self.name_lengths, reverse=True)
+        return self._lengths
+
+    def _replace_pings(self, text):
+        start = text.find('@')
+        if start == -1 or not self.member_ids:
+            return text
+        lengths = self._name_lengths()
+        parts = []
+        pos = 0
+        while start != -1:
+            match = None
+            # try the longest names first, like sorting the members by name length
+            for length in lengths:
+                name = text[start + 1:start + 1 + length]
+                if len(name) == length and name in self.member_ids:
+                    match = name
+                    break
+            if match is None:
+                start = text.find('@', start + 1)
+                continue
+            parts.append(text[pos:start])
+            parts.append(f'<@{self.member_ids[match][0]}>')
+            pos = start + 1 + len(match)
+            start = text.find('@', pos)
+        parts.append(text[pos:])
+        return ''.join(parts)
+
+    def _replace_emojis(self, text):
+        start = text.find(':')
+        if start == -1 or not self.emoji_ids:
+            return text
+        parts = []
+        pos = 0
+        while start != -1:
+            end = text.find(':', start + 1)
+            if end == -1:
+                break
+            name = text[start + 1:end]
+            if name not in self.emoji_ids:
+                # the closing colon may open the next emoji
+                start = end
+                continue
+            parts.append(text[pos:start])
+            parts.append(f'<:{name}:{self.emoji_ids[name]}>')
+            pos = end + 1
+            start = text.find(':', pos)
+        parts.append(text[pos:])
+        return ''.join(parts)
+
+    def replace(self, text):
+        text = self._replace_pings(text)
+        text = self._replace_emojis(text)
+        # remove any excess spaces
+        return whitespace_re.sub(' ', text)
+
+    def _ping_name(self, match):
+        name = self.member_names.get(int(match.group(1)))
+        if name is None:
+            return match.group(0)
+        return f'@{name}'
+
+    def _emoji_name(self, match):
+        if self.emoji_names.get(int(match.group(2))) != match.group(1):
+            return match.group(0)
+        return f':{match.group(1)}:'
+
+    def replace_inverse(self, text):
+        if '<' not in text:
+            return text
+        text = user_ping_re.sub(self._ping_name, text)
+        return custom_emoji_re.sub(self._emoji_name, text)
+
+
+def bench(sizes=(100, 1000, 10000, 50000), calls=20, seed=0):
+    # synthetic guilds, checked against replace_emojis_pings and its inverse
+    rng = random.Random(seed)
+    emojis = [types.SimpleNamespace(id=900000 + index, name=f'emoji{index}') for index in range(50)]
+    for size in sizes:
+        members = [types.SimpleNamespace(id=100000 + index, name=f'user{index}') for index in range(size)]
+        texts = []
+        for _ in range(calls):
+            words = [rng.choice(['hey', 'look', 'at', 'this', 'lol']) for _ in range(12)]
+            words += [f'@{rng.choice(members).name}' for _ in range(3)]
+            words += [f':{rng.choice(emojis).name}:' for _ in range(2)]
+            rng.shuffle(words)
+            texts.append(' '.join(words))
+
+        started = time.perf_counter()
+        index = MentionIndex(members, emojis)
+        built = time.perf_counter() - started
+
+        old = new = old_inverse = new_inverse = 0.0
+        for text in texts:
+            started = time.perf_counter()
+            expected = replace_emojis_pings(text, list(members), emojis)
+            old += time.perf_counter() - started
+            started = time.perf_counter()
+            result = index.replace(text)
+            new += time.perf_counter() - started
+            if result != expected:
+                print(f'MentionIndex.replace differs from replace_emojis_pings on {text!r}')
+                return 1
+
+            started = time.perf_counter()
+            expected_inverse = replace_emojis_pings_inverse(expected, members, emojis)
+            old_inverse += time.perf_counter() - started
+            started = time.perf_counter()
+            result_inverse = index.replace_inverse(expected)
+            new_inverse += time.perf_counter() - started
+            if result_inverse != expected_inverse:
+                print(f'MentionIndex.replace_inverse differs from replace_emojis_pings_inverse on {expected!r}')
+                return 1
+
+        print(f'{size} members - build: {built * 1000:.1f}ms - '
+            f'replace: {old / calls * 1000:.3f}ms -> {new / calls * 1000:.3f}ms - '
+            f'inverse: {old_inverse / calls * 1000:.3f}ms -> {new_inverse / calls * 1000:.3f}ms per call')
+    print('identical output')
+    return 0
+
+
+def main(argv):
+    # python -m core.mentions --bench
+    if argv != ['--bench']:
+        print('usage: python -m core.mentions --bench')
+        return 1
+    return bench()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,119 @@
+import asyncio
+import collections
+
+from .logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class MessageCache(object):
+
+    """Bounded per-channel ring buffer of recent messages.
+
+    Channels start cold. The first history() call for a channel fetches its
+    history once from Discord; after that the buffer is kept up to date from
+    the gateway events and no more REST calls are made for the channel.
+    """
+
+    def __init__(self, max_messages=40):
+        if max_messages <= 0:
+            raise ValueError('Message cache size should be > 0')
+
+        self.max_messages = max_messages
+        self.channels = {} # {channel_id: deque of messages, oldest first}
+        self.hits = 0
+        self.misses = 0
+        self._locks = {} # {channel_id: asyncio.Lock}, for channels being warmed up
+        self._pending = {} # {channel_id: [messages received while warming up]}
+
+    def __contains__(self, channel_id):
+        return channel_id in self.channels
+
+    def _lock(self, channel_id):
+        if channel_id not in self._locks:
+            self._locks[channel_id] = asyncio.Lock()
+        return self._locks[channel_id]
+
+    def append(self, message):
+        channel_id = message.channel.id
+        if channel_id in self.channels:
+            self.channels[channel_id].append(message)
+        elif channel_id in self._pending:
+            # the history fetch for this channel is in flight, merge afterwards
+            self._pending[channel_id].append(message)
+
+    def edit(self, channel_id, message_id, data):
+        buffer = self.channels.get(channel_id)
+        if buffer is None:
+            return
+        for message in buffer:
+            if message.id == message_id:
+                # messages from on_message are the same objects discord.py keeps
+                # in its own cache and are already updated, the ones we fetched
+                # ourselves are not
+                message._update(data)
+                return
+
+    def remove(self, channel_id, message_ids):
+        buffer = self.channels.get(channel_id)
+        if buffer is None:
+            return
+        message_ids = set(message_ids)
+        kept = [m for m in buffer if m.id not in message_ids]
+        if len(kept) != len(buffer):
+            # deleted messages leave room that only a refetch could fill, so
+            # shrink the window instead of going back to the network
+            self.channels[channel_id] = collections.deque(kept, maxlen=self.max_messages)
+
+    def evict(self, channel_id):
+        self.channels.pop(channel_id, None)
+        lock = self._locks.get(channel_id)
+        if lock is not None and not lock.locked():
+            # a warm-up in flight still needs it, otherwise a later one makes a new lock
+            del self._locks[channel_id]
+
+    async def history(self, channel, limit=None):
+        """Return up to limit recent messages of a channel, newest first, like
+        channel.history(limit=limit).flatten() does.
+        """
+        if limit is None or limit > self.max_messages:
+            limit = self.max_messages
+
+        if channel.id in self.channels:
+            self.hits += 1
+        else:
+            async with self._lock(channel.id):
+                if channel.id in self.channels:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                    await self._warm(channel)
+                    # only needed while the channel is cold, whoever is still waiting holds a reference
+                    self._locks.pop(channel.id, None)
+
+        buffer = self.channels[channel.id]
+        return [buffer[i] for i in range(len(buffer) - 1, max(len(buffer) - limit, 0) - 1, -1)]
+
+    async def _warm(self, channel):
+        self._pending[channel.id] = []
+        try:
+            fetched = await channel.history(limit=self.max_messages).flatten()
+        finally:
+            pending = self._pending.pop(channel.id)
+
+        messages = {m.id: m for m in fetched}
+        for message in pending:
+            messages[message.id] = message
+        # snowflakes are ordered by creation time
+        ordered = sorted(messages.values(), key=lambda m: m.id)
+        self.channels[channel.id] = collections.deque(ordered, maxlen=self.max_messages)
+        logger.info(f'Warmed message cache - Channel: {channel.id} - Messages: {len(ordered)}')
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'channels': len(self.channels),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,127 @@
+import time
+import asyncio
+import traceback
+
+from .logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class Speculation(object):
+    __slots__ = ('task', 'started', 'cost', 'actual')
+
+    def __init__(self, task, started):
+        self.task = task
+        self.started = started
+        self.cost = None # seconds the prefetch took
+        self.actual = 0.0 # seconds the message still spent on the same work
+
+
+class ContextPrefetcher(object):
+
+    """Warms a channel's context while someone is typing in it.
+
+    typing() starts warm(channel) in the background: it loads the history,
+    runs the anti-spam filter, reads the memories and tokenizes the context,
+    leaving everything in the caches the message path reads from. When the
+    message arrives claim() hands over the speculation (waiting for it if
+    it's still running), so only the new line is left to do. A speculation
+    that isn't claimed within ttl seconds is counted as wasted and dropped;
+    since it only filled caches, there's nothing to undo. At most one
+    prefetch per channel runs every min_interval seconds and no more than
+    max_inflight run at once.
+    """
+
+    def __init__(self, warm, ttl=30.0, min_interval=5.0, max_inflight=8):
+        self.warm = warm
+        self.ttl = ttl
+        self.min_interval = min_interval
+        self.max_inflight = max_inflight
+        self.speculations = {} # {channel_id: Speculation}
+        self.claimed = {} # {channel_id: Speculation}, until the reply is done
+
+        self.started = 0
+        self.used = 0
+        self.wasted = 0
+        self.dropped = 0
+        self.saved = 0.0
+
+    def _expire(self, now):
+        for channel_id, speculation in list(self.speculations.items()):
+            if now - speculation.started > self.ttl:
+                del self.speculations[channel_id]
+                speculation.task.cancel()
+                self.wasted += 1
+
+    def inflight(self):
+        return sum(1 for speculation in self.speculations.values() if not speculation.task.done())
+
+    def typing(self, channel):
+        now = time.monotonic()
+        self._expire(now)
+        speculation = self.speculations.get(channel.id)
+        if speculation is not None and now - speculation.started < self.min_interval:
+            return
+        if self.inflight() >= self.max_inflight:
+            self.dropped += 1
+            return
+        if speculation is not None:
+            # superseded before anyone sent a message
+            speculation.task.cancel()
+            self.wasted += 1
+        speculation = Speculation(None, now)
+        speculation.task = asyncio.ensure_future(self._run(channel, speculation))
+        self.speculations[channel.id] = speculation
+        self.started += 1
+
+    async def _run(self, channel, speculation):
+        started = time.perf_counter()
+        try:
+            await self.warm(channel)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.error(f'Failed to prefetch the context of channel {channel.id}')
+            logger.error(traceback.format_exc())
+        speculation.cost = time.perf_counter() - started
+
+    async def claim(self, channel_id):
+        speculation = self.speculations.pop(channel_id, None)
+        if speculation is None:
+            return None
+        if time.monotonic() - speculation.started > self.ttl:
+            speculation.task.cancel()
+            self.wasted += 1
+            return None
+        # still running, it's doing the work this message needs anyway
+        await asyncio.shield(speculation.task)
+        if speculation.cost is None:
+            return None
+        self.used += 1
+        self.claimed[channel_id] = speculation
+        return speculation
+
+    def spent(self, channel_id, elapsed):
+        """Add time the message path spent on context work."""
+        speculation = self.claimed.get(channel_id)
+        if speculation is not None:
+            speculation.actual += elapsed
+
+    def finish(self, channel_id):
+        speculation = self.claimed.pop(channel_id, None)
+        if speculation is None:
+            return None
+        saved = max(0.0, speculation.cost - speculation.actual)
+        self.saved += saved
+        return saved
+
+    def stats(self):
+        settled = self.used + self.wasted
+        return {
+            'started': self.started,
+            'used': self.used,
+            'wasted': self.wasted,
+            'dropped': self.dropped,
+            'waste_ratio': self.wasted / settled if settled else 0.0,
+            'saved': self.saved,
+        }
@@ -0,0 +1,248 @@
+import re
+import sys
+import json
+import math
+import time
+import zlib
+import random
+import collections
+
+import numpy as np
+
+from .logging import get_logger, LineWriter
+
+logger = get_logger(__name__)
+
+
+def bucket(value, edges):
+    # index of the first edge value is below, so features stay coarse
+    for index, edge in enumerate(edges):
+        if value < edge:
+            return index
+    return len(edges)
+
+
+class HashedNgramScorer(object):
+
+    """Logistic regression over hashed word and character n-grams.
+
+    Scores how likely the model is to want to reply to a message, from the
+    message text and a few coarse facts about the channel. Features are
+    hashed into a fixed number of weights, so there is no vocabulary to
+    keep and unseen words cost nothing. Trained from the decisions logged
+    by ResponsePrefilter.
+    """
+
+    def __init__(self, bits=18):
+        self.bits = bits
+        self.weights = np.zeros(1 << bits, dtype=np.float32)
+        self.bias = 0.0
+
+    def features(self, text, since_bot, rate):
+        text = text.lower()
+        words = re.findall(r"\w+|[^\w\s]", text)
+        grams = [f'w:{word}' for word in words]
+        grams += [f'b:{a} {b}' for a, b in zip(words, words[1:])]
+        grams += [f'c:{text[i:i + 3]}' for i in range(len(text) - 2)]
+        grams += [
+            f'len:{bucket(len(text), (4, 16, 48, 128))}',
+            f'since_bot:{bucket(since_bot, (10, 60, 300, 1800))}',
+            f'rate:{bucket(rate, (2, 6, 20))}',
+        ]
+        mask = (1 << self.bits) - 1
+        return np.unique(np.array([zlib.crc32(gram.encode('utf-8')) & mask for gram in grams], dtype=np.int64))
+
+    def score(self, text, since_bot, rate):
+        z = self.bias + float(self.weights[self.features(text, since_bot, rate)].sum())
+        return 1.0 / (1.0 + math.exp(-max(-30.0, min(30.0, z))))
+
+    def train(self, samples, epochs=5, lr=0.1, l2=1e-6):
+        """samples is a list of (text, since_bot, rate, responded)."""
+        rows = [(self.features(text, since_bot, rate), 1.0 if responded else 0.0) for text, since_bot, rate, responded in samples]
+        for _ in range(epochs):
+            random.shuffle(rows)
+            for index, label in rows:
+                z = self.bias + float(self.weights[index].sum())
+                gradient = 1.0 / (1.0 + math.exp(-max(-30.0, min(30.0, z)))) - label
+                self.weights[index] -= lr * (gradient + l2 * self.weights[index])
+                self.bias -= lr * gradient
+
+    def save(self, filename):
+        with open(filename, 'wb') as fp:
+            np.savez_compressed(fp, weights=self.weights, bias=np.array([self.bias]))
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        scorer = cls(bits=int(math.log2(len(data['weights']))))
+        scorer.weights = data['weights'].astype(np.float32)
+        scorer.bias = float(data['bias'][0])
+        return scorer
+
+
+class ChannelActivity(object):
+    __slots__ = ('messages', 'bot_spoke')
+
+    def __init__(self):
+        self.messages = collections.deque()
+        self.bot_spoke = None
+
+
+class ResponsePrefilter(object):
+
+    """Decides the obvious cases before asking the model whether to reply.
+
+    A message is skipped without a model call when it is shorter than
+    min_length, when the bot spoke in the channel less than min_gap seconds
+    ago, or when the channel is busier than max_channel_rate messages a
+    minute. With a scorer, a message scoring below skip_below is skipped and
+    one above respond_above is answered. Anything else goes to the model.
+
+    A fraction audit_rate of the skipped messages is still sent to the model
+    to measure how often the prefilter agrees with it, and every model
+    decision is appended to log_file to train the scorer on, unless the
+    caller passes log=False for messages that must not be kept.
+    """
+
+    def __init__(self, min_length=0, min_gap=None, max_channel_rate=None, scorer=None, skip_below=0.05, respond_above=None, audit_rate=0.05, log_file=None, max_channels=10000):
+        self.min_length = min_length
+        self.min_gap = min_gap
+        self.max_channel_rate = max_channel_rate
+        self.scorer = scorer
+        self.skip_below = skip_below
+        self.respond_above = respond_above
+        self.audit_rate = audit_rate
+        self.max_channels = max_channels
+        self.channels = collections.OrderedDict() # {channel_id: ChannelActivity}
+
+        self.log = None
+        if log_file is not None:
+            # written by a listener thread, so a slow disk doesn't stall the event loop
+            self.log = LineWriter(log_file)
+
+        self.saved = 0
+        self.model_calls = 0
+        self.reasons = collections.Counter()
+        self.audited = 0
+        self.audit_agreed = 0
+        self.scored = 0
+        self.score_agreed = 0
+
+    def _activity(self, channel_id):
+        activity = self.channels.get(channel_id)
+        if activity is None:
+            activity = ChannelActivity()
+            self.channels[channel_id] = activity
+            if len(self.channels) > self.max_channels:
+                self.channels.popitem(last=False)
+        else:
+            self.channels.move_to_end(channel_id)
+        return activity
+
+    def observe(self, channel_id, from_bot, now=None):
+        now = time.monotonic() if now is None else now
+        activity = self._activity(channel_id)
+        activity.messages.append(now)
+        while activity.messages and now - activity.messages[0] > 60.0:
+            activity.messages.popleft()
+        if from_bot:
+            activity.bot_spoke = now
+
+    def context(self, channel_id, now=None):
+        # seconds since the bot spoke and messages in the last minute
+        now = time.monotonic() if now is None else now
+        activity = self._activity(channel_id)
+        since_bot = now - activity.bot_spoke if activity.bot_spoke is not None else float('inf')
+        rate = sum(1 for sent in activity.messages if now - sent <= 60.0)
+        return since_bot, rate
+
+    def decide(self, text, channel_id):
+        """Return (decision, reason, score, context); decision is None when
+        the model has to be asked. context is the (since_bot, rate) the
+        decision was made on, to hand back to record().
+        """
+        context = self.context(channel_id)
+        since_bot, rate = context
+        if len(text.strip()) < self.min_length:
+            return False, 'length', None, context
+        if self.min_gap is not None and since_bot < self.min_gap:
+            return False, 'gap', None, context
+        if self.max_channel_rate is not None and rate > self.max_channel_rate:
+            return False, 'rate', None, context
+        if self.scorer is None:
+            return None, None, None, context
+        score = self.scorer.score(text, since_bot, rate)
+        if score < self.skip_below:
+            return False, 'score', score, context
+        if self.respond_above is not None and score > self.respond_above:
+            return True, 'score', score, context
+        return None, None, score, context
+
+    def audit(self):
+        return random.random() < self.audit_rate
+
+    def skipped(self, reason):
+        self.saved += 1
+        self.reasons[reason] += 1
+
+    def record(self, text, context, predicted, score, decision, log=True):
+        """Count a model decision against what the prefilter predicted.
+
+        context is the one decide() returned, so the log holds what the
+        channel looked like when the message came in, not after the model
+        answered.
+        """
+        self.model_calls += 1
+        if predicted is not None:
+            self.audited += 1
+            self.audit_agreed += predicted == decision
+        if score is not None:
+            self.scored += 1
+            self.score_agreed += (score >= 0.5) == decision
+        if self.log is not None and log:
+            since_bot, rate = context
+            self.log.write(json.dumps({
+                'text': text,
+                'since_bot': since_bot if since_bot != float('inf') else None,
+                'rate': rate,
+                'responded': bool(decision),
+            }))
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+
+    def stats(self):
+        return {
+            'saved': self.saved,
+            'model_calls': self.model_calls,
+            'reasons': dict(self.reasons),
+            'audit_agreement': self.audit_agreed / self.audited if self.audited else None,
+            'score_agreement': self.score_agreed / self.scored if self.scored else None,
+        }
+
+
+def main(argv):
+    # python -m core.prefilter decisions.jsonl prefilter.npz
+    if len(argv) != 2:
+        print('usage: python -m core.prefilter <decision log> <output scorer>')
+        return 1
+    samples = []
+    with open(argv[0], encoding='utf-8') as fp:
+        for line in fp:
+            row = json.loads(line)
+            since_bot = row['since_bot'] if row['since_bot'] is not None else float('inf')
+            samples.append((row['text'], since_bot, row['rate'], row['responded']))
+    random.shuffle(samples)
+    held_out = samples[:len(samples) // 10]
+    scorer = HashedNgramScorer()
+    scorer.train(samples[len(held_out):])
+    if held_out:
+        correct = sum((scorer.score(text, since_bot, rate) >= 0.5) == responded for text, since_bot, rate, responded in held_out)
+        print(f'Held-out accuracy: {correct / len(held_out):.3f} over {len(held_out)} decisions')
+    scorer.save(argv[1])
+    print(f'Trained on {len(samples) - len(held_out)} decisions, saved to {argv[1]}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,219 @@
+import copy
+import time
+import asyncio
+import collections
+
+import aiohttp
+import numpy as np
+from shimeji.model_provider import Sukima_ModelProvider
+
+from .transport import HTTPTransport, TransportError
+from .balancer import EndpointBalancer
+from .logging import get_logger
+
+logger = get_logger(__name__)
+
+
+def to_payload(value):
+    # request args as plain JSON, without the fields that aren't set
+    if hasattr(value, 'dict'):
+        value = value.dict()
+    elif hasattr(value, '__dict__'):
+        value = vars(value)
+    if isinstance(value, dict):
+        return {k: to_payload(v) for k, v in value.items() if v is not None}
+    if isinstance(value, (list, tuple)):
+        return [to_payload(v) for v in value]
+    return value
+
+
+class PooledSukima_ModelProvider(Sukima_ModelProvider):
+
+    """Sukima_ModelProvider whose async requests go through an HTTPTransport.
+
+    Generation and hidden state requests are sent on the transport's pooled
+    keep-alive connections, limited to its concurrency cap and retried by
+    its rules; hidden states are idempotent, generations are not. With
+    several endpoints each request goes where the balancer picks, a failed
+    hidden state request is tried once more on another endpoint, and with
+    hedging a generation that runs past the p95 of recent generations is
+    also sent to a second endpoint, keeping whichever answers first. The
+    p95 is taken over generations of the same kind and max_length. Image
+    labeling keeps shimeji's own client on the first endpoint but still
+    waits for a slot. The synchronous methods used by the terminal and
+    Twitter clients are unchanged.
+
+    response_stream_async() yields a reply in pieces of chunk_length tokens,
+    each generated as a continuation of the prompt and what came before,
+    since Sukima only returns whole completions. Each piece sends and
+    prefills the whole prompt again, so a reply costs about
+    max_length / chunk_length prompt passes instead of one.
+    """
+
+    generate_path = '/api/v1/models/generate'
+    hidden_path = '/api/v1/models/hidden'
+
+    def __init__(self, endpoint_url, transport=None, balancer=None, hedge=False, hedge_quantile=0.95, hedge_min_samples=20, **kwargs):
+        urls = [endpoint_url] if isinstance(endpoint_url, str) else list(endpoint_url)
+        urls = [url.rstrip('/') for url in urls]
+        super().__init__(urls[0], **kwargs)
+        self.endpoint = urls[0]
+        self.transport = transport or HTTPTransport()
+        self.balancer = balancer or EndpointBalancer(urls)
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        # the args as configured, before any call changes the shared ones
+        self.response_args = copy.deepcopy(kwargs['args'])
+
+        # every node has its own users, so log in to each on first use
+        self.tokens = {self.endpoint: self.token}
+        # short generations (should_respond, streamed chunks) would pull the deadline
+        # of whole replies down, so every kind of generation hedges on its own latencies
+        self.latencies = {} # {kind: deque of seconds}
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+
+    def _login(self, url):
+        # log in through a copy, so the token and URL the synchronous methods use stay the first node's
+        node = copy.copy(self)
+        node.endpoint_url = url
+        node.auth()
+        return node.token
+
+    async def _send(self, endpoint, path, payload, idempotent):
+        if endpoint.url not in self.tokens:
+            self.tokens[endpoint.url] = await asyncio.get_running_loop().run_in_executor(None, self._login, endpoint.url)
+        started = self.balancer.begin(endpoint)
+        ok = False
+        try:
+            status, data = await self.transport.post(endpoint.url, path, payload, headers={'Authorization': f'Bearer {self.tokens[endpoint.url]}'}, idempotent=idempotent)
+            if status == 401:
+                # the token expired, log in again once
+                self.tokens[endpoint.url] = await asyncio.get_running_loop().run_in_executor(None, self._login, endpoint.url)
+                status, data = await self.transport.post(endpoint.url, path, payload, headers={'Authorization': f'Bearer {self.tokens[endpoint.url]}'}, idempotent=idempotent)
+            if status == 200 and not isinstance(data, dict):
+                # Sukima always answers in JSON, this came from a proxy in front of the node
+                status = 502
+            # client errors are the request's fault, not the node's
+            ok = status < 500 and status != 429
+            if status != 200:
+                raise TransportError(status, data)
+            return data
+        except asyncio.CancelledError:
+            self.balancer.cancel(endpoint)
+            started = None
+            raise
+        finally:
+            if started is not None:
+                self.balancer.end(endpoint, started, ok)
+
+    async def _post(self, path, payload, idempotent):
+        endpoint = self.balancer.pick()
+        try:
+            return await self._send(endpoint, path, payload, idempotent)
+        except TransportError as e:
+            if e.status < 500 and e.status != 429:
+                raise
+            failover = e
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            failover = e
+        other = self.balancer.pick(exclude=(endpoint,))
+        if not idempotent or other is None:
+            raise failover
+        self.failovers += 1
+        logger.warning(f'Request to {endpoint.url} failed, trying {other.url}: {failover!r}')
+        return await self._send(other, path, payload, idempotent)
+
+    def hedge_deadline(self, kind):
+        latencies = self.latencies.get(kind, ())
+        if not self.hedge or len(latencies) < self.hedge_min_samples or self.balancer.healthy() < 2:
+            return None
+        latencies = sorted(latencies)
+        return latencies[min(len(latencies) - 1, int(self.hedge_quantile * len(latencies)))]
+
+    async def _generate(self, payload, kind):
+        deadline = self.hedge_deadline(kind)
+        if deadline is None:
+            return await self._post(self.generate_path, payload, idempotent=False)
+
+        first = self.balancer.pick()
+        tasks = [asyncio.ensure_future(self._send(first, self.generate_path, payload, False))]
+        done, _ = await asyncio.wait(tasks, timeout=deadline)
+        if not done:
+            second = self.balancer.pick(exclude=(first,))
+            if second is not None:
+                self.hedged += 1
+                tasks.append(asyncio.ensure_future(self._send(second, self.generate_path, payload, False)))
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            self.hedge_wins += 1
+                        return task.result()
+            # both failed, report the first one's error
+            return tasks[0].result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def generate_async(self, args):
+        return await self._complete(args, 'generate')
+
+    async def _complete(self, args, name):
+        payload = to_payload(args)
+        # generations of the same length take about as long as each other
+        kind = (name, payload.get('gen_args', {}).get('max_length'))
+        started = time.monotonic()
+        data = await self._generate(payload, kind)
+        self.latencies.setdefault(kind, collections.deque(maxlen=256)).append(time.monotonic() - started)
+        output = data['output']
+        if output.startswith(payload['prompt']):
+            output = output[len(payload['prompt']):]
+        return output
+
+    async def response_stream_async(self, context, chunk_length=16):
+        args = copy.deepcopy(self.response_args)
+        args.prompt = context
+        if args.gen_args.eos_token_id is None:
+            # replies end at a newline, like the ones shimeji generates
+            args.gen_args.eos_token_id = 198
+        args.gen_args.min_length = 1
+        max_length = args.gen_args.max_length or chunk_length
+        generated = 0
+        while generated < max_length:
+            args.gen_args.max_length = min(chunk_length, max_length - generated)
+            text = await self._complete(args, 'stream')
+            if not text:
+                return
+            yield text
+            if '\n' in text:
+                # the reply is over, same as hitting eos
+                return
+            args.prompt += text
+            generated += args.gen_args.max_length
+
+    async def hidden_async(self, model, text, layer=-1):
+        data = await self._post(self.hidden_path, {'model': model, 'prompt': text, 'layers': [layer]}, idempotent=True)
+        return np.asarray(data[str(layer)], dtype=np.float32)
+
+    async def image_label_async(self, model, url, labels):
+        async with self.transport.slot(self.endpoint):
+            return await super().image_label_async(model, url, labels)
+
+    async def close(self):
+        logger.info(f'Model provider stopped - {self.stats()}')
+        await self.transport.close()
+
+    def stats(self):
+        return {
+            'endpoints': self.balancer.stats(),
+            'transport': self.transport.stats(),
+            'hedged': self.hedged,
+            'hedge_wins': self.hedge_wins,
+            'failovers': self.failovers,
+        }
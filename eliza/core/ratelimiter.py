@@ -1,14 +1,56 @@
+import sys
 import asyncio
 import time
+import queue
+import sqlite3
 import functools
 import threading
 import collections
 
+from .logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class CallbackDispatcher(object):
+
+    """Runs rate limit callbacks on one long-lived daemon thread instead of
+    starting a new thread every time a limit is hit.
+    """
+
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _run(self):
+        while True:
+            callback, args = self._queue.get()
+            try:
+                callback(*args)
+            except Exception:
+                pass
+
+    def dispatch(self, callback, *args):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='ratelimit-callbacks', daemon=True)
+                    self._thread.start()
+        self._queue.put((callback, args))
+
+dispatcher = CallbackDispatcher()
+
 
 class RateLimiter(object):
 
     """Provides rate limiting for an operation with a configurable number of
     requests for a time period.
+
+    Callers reserve a start time under the lock and then wait for it outside
+    the lock, so a caller that has to wait doesn't hold up the others. Time
+    is measured with the monotonic clock; the until value handed to the
+    callback is still a time.time() timestamp.
     """
 
     def __init__(self, max_calls, period=1.0, callback=None):
@@ -20,18 +62,14 @@ class RateLimiter(object):
         if max_calls <= 0:
             raise ValueError('Rate limiting number of calls should be > 0')
 
-        # We're using a deque to store the last execution timestamps, not for
-        # its maxlen attribute, but to allow constant time front removal.
+        # Start times of the calls in the sliding window, including the ones
+        # reserved for callers that are still waiting. Always sorted.
         self.calls = collections.deque()
 
         self.period = period
         self.max_calls = max_calls
         self.callback = callback
         self._lock = threading.Lock()
-        self._alock = None
-
-        # Lock to protect creation of self._alock
-        self._init_lock = threading.Lock()
 
     def __call__(self, f):
         """The __call__ function allows the RateLimiter object to be used as a
@@ -43,65 +81,323 @@ class RateLimiter(object):
                 return f(*args, **kwargs)
         return wrapped
 
-    def __enter__(self):
+    def _reserve(self, now, wait=True):
+        # Returns the reserved start time, or None when wait is False and
+        # the call could not start right away. Must hold self._lock.
+        while self.calls and self.calls[0] <= now - self.period:
+            self.calls.popleft()
+        if len(self.calls) < self.max_calls:
+            slot = now
+        else:
+            slot = max(now, self.calls[-self.max_calls] + self.period)
+            if not wait and slot > now:
+                return None
+        self.calls.append(slot)
+        return slot
+
+    def reserve(self):
+        """Reserve the next free slot and return how many seconds the caller
+        has to wait before starting.
+        """
         with self._lock:
-            # We want to ensure that no more than max_calls were run in the allowed
-            # period. For this, we store the last timestamps of each call and run
-            # the rate verification upon each __enter__ call.
-            if len(self.calls) >= self.max_calls:
-                until = time.time() + self.period - self._timespan
-                if self.callback:
-                    t = threading.Thread(target=self.callback, args=(until,))
-                    t.daemon = True
-                    t.start()
-                sleeptime = until - time.time()
-                if sleeptime > 0:
-                    time.sleep(sleeptime)
-            return self
+            now = time.monotonic()
+            delay = self._reserve(now) - now
+        if delay > 0 and self.callback:
+            self._notify(time.time() + delay)
+        return delay
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
+    def _notify(self, until):
+        dispatcher.dispatch(self.callback, until)
+
+    def try_acquire(self):
+        """Take a slot if one is free right now, without waiting."""
         with self._lock:
-            # Store the last operation timestamp.
-            self.calls.append(time.time())
+            return self._reserve(time.monotonic(), wait=False) is not None
 
-            # Pop the timestamp list front (ie: the older calls) until the sum goes
-            # back below the period. This is our 'sliding period' window.
-            while self._timespan >= self.period:
-                self.calls.popleft()
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
 
-    @property
-    def _timespan(self):
-        return self.calls[-1] - self.calls[0]
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # the call was accounted for when its slot was reserved
+        pass
 
 
 class AsyncRateLimiter(RateLimiter):
 
-    def _init_async_lock(self):
-        with self._init_lock:
-            if self._alock is None:
-                self._alock = asyncio.Lock()
+    # The lock is only held for the reservation itself, never while waiting,
+    # so taking it on the event loop thread doesn't block the loop.
+
+    def _notify(self, until):
+        asyncio.ensure_future(self.callback(until))
 
     async def pop_call(self):
-        async with self._alock:
+        with self._lock:
             if self.calls:
                 return self.calls.pop()
 
+    async def acquire_async(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
     async def __aenter__(self):
-        if self._alock is None:
-            self._init_async_lock()
+        await self.acquire_async()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class TokenBucket(object):
+
+    """A bucket of max_calls tokens that refills over period seconds."""
+
+    __slots__ = ('capacity', 'rate', 'tokens', 'updated')
+
+    def __init__(self, max_calls, period, now):
+        self.capacity = float(max_calls)
+        self.rate = max_calls / period
+        self.tokens = float(max_calls)
+        self.updated = now
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available, 0 if one is available now."""
+        self._refill(now)
+        if self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1.0
+
+
+class HierarchicalRateLimiter(object):
 
-        async with self._alock:
-            # We want to ensure that no more than max_calls were run in the allowed
-            # period. For this, we store the last timestamps of each call and run
-            # the rate verification upon each __enter__ call.
+    """Token buckets at the global, guild, channel and user level.
+
+    A call goes through only if every configured level has a token, and then
+    takes one from each. Checks never sleep; they return how long the caller
+    would have to wait instead. Buckets are kept in least recently used
+    order and dropped once they have been idle for longer than it takes them
+    to refill, so memory stays bounded by the number of recently active
+    guilds, channels and users (and by max_buckets on top of that).
+
+    limits maps a level to {'max_calls': n, 'period': seconds}; missing levels
+    aren't limited. role_limits maps a role to overrides of the same shape,
+    where a level set to None is not limited for that role.
+
+    With a shared store, the levels in shared_levels are kept in the store
+    instead, so they hold across shard processes. A guild and its channels
+    always live on one shard, so only the global and user levels need it.
+    The store can wait on another process's lock, so code on the event loop
+    uses check_async() and try_acquire_async(), which call it from a thread.
+    """
+
+    levels = ('global', 'guild', 'channel', 'user')
+
+    def __init__(self, limits, role_limits=None, max_buckets=100000, shared=None, shared_levels=('global', 'user')):
+        for level in list(limits) + [level for overrides in (role_limits or {}).values() for level in overrides]:
+            if level not in self.levels:
+                raise ValueError(f'Unknown rate limit level: {level}')
+
+        self.limits = limits
+        self.role_limits = role_limits or {}
+        self.max_buckets = max_buckets
+        self.shared = shared
+        self.shared_levels = shared_levels if shared is not None else ()
+        self.buckets = collections.OrderedDict() # {(level, role, id): TokenBucket}
+
+        periods = [limit['period'] for limit in limits.values()]
+        periods += [limit['period'] for overrides in self.role_limits.values() for limit in overrides.values() if limit is not None]
+        self.idle_ttl = max(periods) if periods else 0.0
+
+        self.allowed = 0
+        self.limited = 0
+        self.evicted = 0
+        self.store_errors = 0
+
+    def _limits(self, role):
+        limits = dict(self.limits)
+        if role in self.role_limits:
+            limits.update(self.role_limits[role])
+        return limits
+
+    def _evict(self, now):
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            if len(self.buckets) <= self.max_buckets and now - bucket.updated < self.idle_ttl:
+                break
+            del self.buckets[key]
+            self.evicted += 1
+
+    def _buckets(self, ids, role, now):
+        buckets = []
+        shared = [] # [(key, max_calls, period)]
+        for level, limit in self._limits(role).items():
+            if limit is None:
+                continue
+            # roles with their own limits get their own buckets
+            key = (level, role if level in self.role_limits.get(role, {}) else None, ids[level])
+            if level in self.shared_levels:
+                shared.append((':'.join(str(part) for part in key), limit['max_calls'], limit['period']))
+                continue
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(limit['max_calls'], limit['period'], now)
+                self.buckets[key] = bucket
+            else:
+                self.buckets.move_to_end(key)
+            buckets.append(bucket)
+        return buckets, shared
+
+    def check(self, guild_id=None, channel_id=None, user_id=None, role=None):
+        """Seconds until a call would be allowed, without taking a token."""
+        now = time.monotonic()
+        ids = {'global': None, 'guild': guild_id, 'channel': channel_id, 'user': user_id}
+        buckets, shared = self._buckets(ids, role, now)
+        wait = max([bucket.wait_time(now) for bucket in buckets], default=0.0)
+        if shared:
+            wait = max(wait, self.shared.try_acquire(shared, consume=False))
+        self._evict(now)
+        return wait
+
+    def try_acquire(self, guild_id=None, channel_id=None, user_id=None, role=None):
+        """Take a token from every level and return 0, or return how many
+        seconds to wait if any level is out of tokens.
+        """
+        now = time.monotonic()
+        ids = {'global': None, 'guild': guild_id, 'channel': channel_id, 'user': user_id}
+        buckets, shared = self._buckets(ids, role, now)
+        wait = max([bucket.wait_time(now) for bucket in buckets], default=0.0)
+        if wait == 0 and shared:
+            # the shared levels take their tokens here when they have them
+            wait = self.shared.try_acquire(shared)
+        if wait > 0:
+            self.limited += 1
+        else:
+            for bucket in buckets:
+                bucket.consume(now)
+            self.allowed += 1
+        self._evict(now)
+        return wait
+
+    async def _shared_wait(self, shared, consume):
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, self.shared.try_acquire, shared, consume)
+        except sqlite3.OperationalError as e:
+            # a store locked past its timeout doesn't hold up the reply, the local levels still apply
+            self.store_errors += 1
+            logger.warning(f'Skipped the shared rate limits: {e}')
+            return 0.0
+
+    async def check_async(self, guild_id=None, channel_id=None, user_id=None, role=None):
+        now = time.monotonic()
+        ids = {'global': None, 'guild': guild_id, 'channel': channel_id, 'user': user_id}
+        buckets, shared = self._buckets(ids, role, now)
+        wait = max([bucket.wait_time(now) for bucket in buckets], default=0.0)
+        if shared:
+            wait = max(wait, await self._shared_wait(shared, False))
+        self._evict(time.monotonic())
+        return wait
+
+    async def try_acquire_async(self, guild_id=None, channel_id=None, user_id=None, role=None):
+        now = time.monotonic()
+        ids = {'global': None, 'guild': guild_id, 'channel': channel_id, 'user': user_id}
+        buckets, shared = self._buckets(ids, role, now)
+        wait = max([bucket.wait_time(now) for bucket in buckets], default=0.0)
+        if wait == 0 and shared:
+            wait = await self._shared_wait(shared, True)
+            # other calls may have taken the local tokens while the store was busy
+            now = time.monotonic()
+            wait = max([wait] + [bucket.wait_time(now) for bucket in buckets])
+        if wait > 0:
+            self.limited += 1
+        else:
+            for bucket in buckets:
+                bucket.consume(now)
+            self.allowed += 1
+        self._evict(now)
+        return wait
+
+    def stats(self):
+        return {
+            'buckets': len(self.buckets),
+            'allowed': self.allowed,
+            'limited': self.limited,
+            'evicted': self.evicted,
+            'store_errors': self.store_errors,
+        }
+
+
+class LockedRateLimiter(object):
+
+    # The limiter as it was before slots were reserved: it sleeps while
+    # holding its lock. Only kept to compare against in bench().
+
+    def __init__(self, max_calls, period=1.0):
+        self.calls = collections.deque()
+        self.period = period
+        self.max_calls = max_calls
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        with self._lock:
             if len(self.calls) >= self.max_calls:
-                until = time.time() + self.period - self._timespan
-                if self.callback:
-                    asyncio.ensure_future(self.callback(until))
-                sleeptime = until - time.time()
+                sleeptime = self.period - (self.calls[-1] - self.calls[0])
                 if sleeptime > 0:
-                    await asyncio.sleep(sleeptime)
+                    time.sleep(sleeptime)
             return self
 
-    async def __aexit__(self, exc_type, exc_value, traceback):
-         return super(AsyncRateLimiter, self).__exit__(exc_type, exc_value, traceback)
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self._lock:
+            self.calls.append(time.time())
+            while self.calls[-1] - self.calls[0] >= self.period:
+                self.calls.popleft()
+
+
+def bench(callers=(1, 8, 64), calls=20, work=0.001):
+    # threads making calls calls each, with work seconds of work per call
+    def run(limiter, count):
+        def caller():
+            for _ in range(calls):
+                with limiter:
+                    time.sleep(work)
+        threads = [threading.Thread(target=caller) for _ in range(count)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+    for name, max_calls, period in (('limited to 50 calls / 0.1s', 50, 0.1), ('unlimited', 10 ** 9, 1.0)):
+        for count in callers:
+            old = run(LockedRateLimiter(max_calls, period), count)
+            new = run(RateLimiter(max_calls, period), count)
+            # the window alone allows max_calls per period
+            floor = max(0, count * calls - max_calls) / max_calls * period
+            print(f'{name} - {count} callers: {old:.3f}s -> {new:.3f}s - floor: {floor:.3f}s')
+    return 0
+
+
+def main(argv):
+    # python -m core.ratelimiter --bench
+    if argv != ['--bench']:
+        print('usage: python -m core.ratelimiter --bench')
+        return 1
+    return bench()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,119 @@
+import time
+import asyncio
+import traceback
+
+from .logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class ChannelTurn(object):
+    def __init__(self):
+        self.messages = [] # [(message, mentioned)] waiting for a turn, oldest first
+        self.since = None
+        self.task = None
+        self.idle = False # nobody spoke, the bot starts the turn on its own
+
+
+class ChannelScheduler(object):
+
+    """Runs at most one response turn per channel and at most max_concurrent
+    turns overall.
+
+    Messages that arrive while a channel is busy, or while it waits for a
+    free slot, are merged into a single follow-up turn. The handler gets all
+    of them with whether each was a mention, so the turn answers the newest
+    one while the earlier ones are still remembered and rate limited, and
+    mentions are never lost to a response that was already in flight.
+
+    An idle turn is only queued for a channel with nothing running or
+    waiting, and a message arriving before it starts makes it a normal
+    turn. The handler is told which kind it got.
+
+    The queue depth and waiting times from stats() are logged every
+    report_interval seconds while turns are being run.
+    """
+
+    def __init__(self, handler, max_concurrent=4, report_interval=300.0):
+        if max_concurrent <= 0:
+            raise ValueError('Scheduler concurrency should be > 0')
+
+        self.handler = handler # async handler(messages, waited, idle), messages as [(message, mentioned)]
+        self.max_concurrent = max_concurrent
+        self.report_interval = report_interval
+        self._reported = time.monotonic()
+        self.channels = {} # {channel_id: ChannelTurn}
+        self._semaphore = None
+
+        self.running = 0
+        self.turns = 0
+        self.merged = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def submit(self, message, mentioned=False, idle=False):
+        """Queue message for a turn in its channel. Returns False for an idle
+        turn the channel is too busy for.
+        """
+        channel_id = message.channel.id
+        turn = self.channels.get(channel_id)
+        if idle and turn is not None:
+            return False
+        if turn is None:
+            turn = ChannelTurn()
+            self.channels[channel_id] = turn
+
+        if not turn.messages:
+            turn.since = time.monotonic()
+        else:
+            self.merged += 1
+        turn.messages.append((message, mentioned))
+        turn.idle = idle
+
+        if turn.task is None:
+            turn.task = asyncio.ensure_future(self._run(channel_id, turn))
+        return True
+
+    async def _run(self, channel_id, turn):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        try:
+            while turn.messages:
+                async with self._semaphore:
+                    messages, idle = turn.messages, turn.idle
+                    waited = time.monotonic() - turn.since
+                    turn.messages, turn.since, turn.idle = [], None, False
+
+                    self.turns += 1
+                    self.wait_total += waited
+                    self.wait_max = max(self.wait_max, waited)
+                    self.running += 1
+                    try:
+                        await self.handler(messages, waited, idle)
+                    except Exception:
+                        logger.error(traceback.format_exc())
+                    finally:
+                        self.running -= 1
+                if time.monotonic() - self._reported >= self.report_interval:
+                    # queue depth and waits, logged while there is traffic
+                    self._reported = time.monotonic()
+                    logger.info(f'Channel scheduler - {self.stats()}')
+        finally:
+            turn.task = None
+            if not turn.messages:
+                # don't keep state around for channels that went quiet
+                self.channels.pop(channel_id, None)
+
+    def depth(self):
+        return sum(len(turn.messages) for turn in self.channels.values())
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'queued_channels': sum(1 for turn in self.channels.values() if turn.messages),
+            'queued_messages': self.depth(),
+            'turns': self.turns,
+            'merged': self.merged,
+            'avg_wait': self.wait_total / self.turns if self.turns else 0.0,
+            'max_wait': self.wait_max,
+        }
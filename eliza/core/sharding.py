@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import signal
+import multiprocessing
+import urllib.request
+
+from .logging import get_logger
+
+logger = get_logger(__name__)
+
+
+def get_shard_count(bearer_token):
+    # the number of shards Discord recommends for this bot
+    request = urllib.request.Request(
+        'https://discord.com/api/v10/gateway/bot',
+        headers={'Authorization': f'Bot {bearer_token}', 'User-Agent': 'DiscordBot (eliza, 1.0)'}
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)['shards']
+
+def split_shards(shard_count, processes):
+    # shard i goes to process i % processes, so big and small guild ranges mix
+    return [list(range(index, shard_count, processes)) for index in range(min(processes, shard_count))]
+
+
+class ShardSupervisor(object):
+
+    """Runs the shards of one bot over several worker processes.
+
+    Each worker gets a fixed group of shard ids and runs target(*args,
+    shard_ids, shard_count). A worker that exits with an error is started
+    again after restart_delay seconds; one that exits cleanly is left alone.
+    On shutdown every worker gets SIGINT, so it can drain its queues the
+    same way as a single process on Ctrl+C, and is terminated if it takes
+    longer than stop_timeout. While running, the lag reports the shards
+    write to the shared store are logged every report_interval seconds.
+    """
+
+    def __init__(self, target, args, shard_count, processes, store=None, report_interval=30.0, restart_delay=5.0, stop_timeout=30.0):
+        if processes <= 0:
+            raise ValueError('Shard process count should be > 0')
+
+        self.target = target
+        self.args = args
+        self.shard_count = shard_count
+        self.groups = split_shards(shard_count, processes)
+        self.store = store
+        self.report_interval = report_interval
+        self.restart_delay = restart_delay
+        self.stop_timeout = stop_timeout
+
+        # workers are forked so they can run the target from the __main__ script
+        self.context = multiprocessing.get_context('fork')
+        self.workers = [None] * len(self.groups)
+        self.restarts = 0
+
+    def _start(self, index):
+        worker = self.context.Process(
+            target=self.target,
+            args=(*self.args, self.groups[index], self.shard_count),
+            name=f'shards-{index}'
+        )
+        worker.start()
+        self.workers[index] = worker
+        logger.info(f'Started shard worker - PID: {worker.pid} - Shards: {self.groups[index]}/{self.shard_count}')
+
+    def run(self):
+        if self.store is not None:
+            self.store.clear_shards()
+        for index in range(len(self.groups)):
+            self._start(index)
+
+        restarts = {} # {index: time to start again}
+        reported = time.monotonic()
+        try:
+            while True:
+                time.sleep(1.0)
+                now = time.monotonic()
+                for index, worker in enumerate(self.workers):
+                    if worker is None or worker.is_alive():
+                        continue
+                    if index in restarts:
+                        if now >= restarts[index]:
+                            del restarts[index]
+                            self.restarts += 1
+                            self._start(index)
+                    elif worker.exitcode != 0:
+                        logger.error(f'Shard worker exited - PID: {worker.pid} - Exit code: {worker.exitcode} - Restarting in {self.restart_delay}s')
+                        restarts[index] = now + self.restart_delay
+                    else:
+                        self.workers[index] = None
+                if all(worker is None for worker in self.workers):
+                    return
+                if now - reported >= self.report_interval:
+                    reported = now
+                    self.report()
+        finally:
+            self.stop()
+
+    def report(self):
+        if self.store is None:
+            return
+        for report in self.store.shard_reports():
+            age = time.time() - report['updated']
+            logger.info(f'Shard {report["shard_id"]} - PID: {report["pid"]} - Loop lag avg: {report["lag_avg"] * 1000:.2f}ms - max: {report["lag_max"] * 1000:.2f}ms - Gateway latency: {report["latency"] * 1000:.2f}ms - Reported {age:.0f}s ago')
+
+    def stop(self):
+        workers = [worker for worker in self.workers if worker is not None and worker.is_alive()]
+        for worker in workers:
+            try:
+                os.kill(worker.pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + self.stop_timeout
+        for worker in workers:
+            worker.join(max(0.0, deadline - time.monotonic()))
+            if worker.is_alive():
+                logger.warning(f'Shard worker did not stop in time, terminating - PID: {worker.pid}')
+                worker.terminate()
+                worker.join()
+        self.workers = [None] * len(self.groups)
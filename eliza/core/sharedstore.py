@@ -0,0 +1,118 @@
+import os
+import time
+import sqlite3
+import threading
+import contextlib
+
+from .logging import get_logger
+
+logger = get_logger(__name__)
+
+# one store per file and process, a connection must not be used across a fork
+stores = {}
+
+def get_shared_store(filename='shared.db'):
+    key = (filename, os.getpid())
+    if key not in stores:
+        stores[key] = SharedStore(filename)
+    return stores[key]
+
+
+class SharedStore(object):
+
+    """State shared by the shard processes of one bot on the same host.
+
+    Backed by a SQLite database in WAL mode, which every process opens on
+    its own. Writes go through BEGIN IMMEDIATE transactions so they are
+    serialized between processes. It holds the token buckets that span
+    shards (the global and per-user rate limits), the shard lag reports and
+    a lock used to serialize changes to auth.json. Nothing in here has to
+    survive a crash, so it isn't synced to disk.
+    """
+
+    def __init__(self, filename='shared.db', timeout=5.0, prune_interval=60.0):
+        self.filename = filename
+        self.prune_interval = prune_interval
+        self._lock = threading.Lock()
+        self._pruned = time.time()
+
+        self.conn = sqlite3.connect(filename, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=OFF')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL, expires REAL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS shards (shard_id INTEGER PRIMARY KEY, pid INTEGER, lag_avg REAL, lag_max REAL, latency REAL, updated REAL)')
+
+        self.transactions = 0
+        self.busy_time = 0.0
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self._lock:
+            started = time.perf_counter()
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            else:
+                self.conn.execute('COMMIT')
+            finally:
+                self.transactions += 1
+                self.busy_time += time.perf_counter() - started
+
+    def lock(self):
+        """Cross-process lock, held for as long as the transaction is open."""
+        return self.transaction()
+
+    def try_acquire(self, buckets, consume=True):
+        """Check (and with consume, take) a token from every bucket in one
+        transaction. buckets is a list of (key, max_calls, period). Returns
+        0 if a token was available in all of them, otherwise the seconds
+        until one would be.
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            states = []
+            wait = 0.0
+            for key, max_calls, period in buckets:
+                rate = max_calls / period
+                row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+                tokens = float(max_calls)
+                if row is not None:
+                    tokens = min(float(max_calls), row[0] + max(0.0, now - row[1]) * rate)
+                if tokens < 1.0:
+                    wait = max(wait, (1.0 - tokens) / rate)
+                states.append((key, tokens, now + period))
+            if consume and wait == 0.0:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO buckets (key, tokens, updated, expires) VALUES (?, ?, ?, ?)',
+                    [(key, tokens - 1.0, now, expires) for key, tokens, expires in states]
+                )
+            if now - self._pruned > self.prune_interval:
+                # buckets that have refilled are the same as missing ones
+                self._pruned = now
+                conn.execute('DELETE FROM buckets WHERE expires < ?', (now,))
+        return wait
+
+    def report_shard(self, shard_id, lag_avg, lag_max, latency):
+        with self.transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO shards (shard_id, pid, lag_avg, lag_max, latency, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                (shard_id, os.getpid(), lag_avg, lag_max, latency, time.time())
+            )
+
+    def shard_reports(self):
+        with self._lock:
+            rows = self.conn.execute('SELECT shard_id, pid, lag_avg, lag_max, latency, updated FROM shards ORDER BY shard_id').fetchall()
+        return [dict(zip(('shard_id', 'pid', 'lag_avg', 'lag_max', 'latency', 'updated'), row)) for row in rows]
+
+    def clear_shards(self):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM shards')
+
+    def stats(self):
+        return {
+            'transactions': self.transactions,
+            'busy_time': self.busy_time,
+        }
@@ -0,0 +1,81 @@
+import time
+import asyncio
+
+from .logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class StreamingMessage(object):
+
+    """A Discord message that grows while its text is being generated.
+
+    The first update sends the message and later ones edit it. Edits are
+    held back until edit_interval seconds have passed since the last one,
+    and only the newest text is sent then, so a fast stream costs a few
+    edits instead of one per chunk and stays under the channel's edit
+    rate limit. A held back edit goes out when its interval is up even if
+    no more text arrives, and finish() always sends the final text.
+    """
+
+    def __init__(self, channel, edit_interval=1.0):
+        self.channel = channel
+        self.edit_interval = edit_interval
+        self.message = None
+        self.text = ''
+        self.pending = None
+        self._lock = asyncio.Lock() # keeps the edits in order
+        self._flush = None
+
+        self.started = time.monotonic()
+        self.first_text = None
+        self._edited = 0.0
+        self.edits = 0
+        self.coalesced = 0
+
+    async def _push(self, text):
+        async with self._lock:
+            if text == self.text:
+                return
+            if self.message is None:
+                self.message = await self.channel.send(text)
+                self.first_text = time.monotonic() - self.started
+            else:
+                await self.message.edit(content=text)
+                self.edits += 1
+            self.text = text
+            self._edited = time.monotonic()
+
+    async def update(self, text):
+        if not text or text == self.text:
+            return
+        if self.message is not None and time.monotonic() - self._edited < self.edit_interval:
+            if self.pending is not None:
+                self.coalesced += 1
+            self.pending = text
+            if self._flush is None:
+                self._flush = asyncio.ensure_future(self._flush_later())
+            return
+        self.pending = None
+        await self._push(text)
+
+    async def _flush_later(self):
+        try:
+            while self.pending is not None:
+                await asyncio.sleep(max(0.0, self._edited + self.edit_interval - time.monotonic()))
+                if self.pending is not None and time.monotonic() - self._edited >= self.edit_interval:
+                    text, self.pending = self.pending, None
+                    await self._push(text)
+        except Exception as e:
+            logger.error(f'Failed to edit a streamed response: {e!r}')
+        finally:
+            self._flush = None
+
+    async def finish(self, text):
+        if self._flush is not None:
+            self._flush.cancel()
+        self.pending = None
+        if text:
+            await self._push(text)
+        logger.info(f'Streamed response - First text: {self.first_text or 0.0:.2f}s - Total: {time.monotonic() - self.started:.2f}s - Edits: {self.edits} - Coalesced: {self.coalesced}')
+        return self.message
@@ -0,0 +1,86 @@
+import re
+import asyncio
+import hashlib
+
+import numpy as np
+
+
+class Stub_ModelProvider(object):
+
+    """Local stand-in for Sukima_ModelProvider that needs no model server.
+
+    Hidden states are pseudo-random vectors seeded by the text, so the same
+    text always encodes to the same vector. Generation echoes a fixed reply.
+    Every call is counted so tests can check how many requests were made.
+    As with the other providers, the request args are in kwargs['args'].
+    """
+
+    def __init__(self, dimensions=768, response=' Hello.', latency=0.0, **kwargs):
+        self.dimensions = dimensions
+        self.response_text = response
+        self.latency = latency
+        self.kwargs = kwargs
+        self.calls = {}
+
+    def _count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    async def _wait(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def _encode(self, text):
+        seed = int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+        return np.random.default_rng(seed).standard_normal(self.dimensions).astype(np.float32)
+
+    def hidden(self, model, text, layer=-1):
+        self._count('hidden')
+        return self._encode(text)
+
+    async def hidden_async(self, model, text, layer=-1):
+        self._count('hidden')
+        await self._wait()
+        return self._encode(text)
+
+    async def hidden_batch_async(self, model, texts, layer=-1):
+        self._count('hidden_batch')
+        await self._wait()
+        return [self._encode(text) for text in texts]
+
+    def generate(self, args):
+        self._count('generate')
+        return self.response_text
+
+    async def generate_async(self, args):
+        self._count('generate')
+        await self._wait()
+        return self.response_text
+
+    def response(self, context):
+        self._count('response')
+        return self.response_text
+
+    async def response_async(self, context):
+        self._count('response')
+        await self._wait()
+        return self.response_text
+
+    async def response_stream_async(self, context, chunk_length=16):
+        self._count('response_stream')
+        for piece in re.findall(r'\s*\S+', self.response_text):
+            await self._wait()
+            yield piece
+
+    def should_respond(self, context, name):
+        self._count('should_respond')
+        return True
+
+    async def should_respond_async(self, context, name):
+        self._count('should_respond')
+        await self._wait()
+        return True
+
+    async def image_label_async(self, model, url, labels):
+        self._count('image_label')
+        await self._wait()
+        return {'labels': [{label: 1.0 / len(label_set) for label in label_set} for label_set in labels]}
@@ -0,0 +1,134 @@
+import json
+import time
+import random
+import asyncio
+import contextlib
+
+import aiohttp
+
+from .logging import get_logger
+
+logger = get_logger(__name__)
+
+# statuses worth another try, the server didn't do the work
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+class TransportError(Exception):
+    def __init__(self, status, data):
+        super().__init__(f'Request failed with status {status}: {data}')
+        self.status = status
+        self.data = data
+
+
+def decode(body):
+    # error pages from proxies in front of the servers aren't JSON, those come back as text
+    try:
+        return json.loads(body)
+    except ValueError:
+        return body.decode('utf-8', errors='replace')
+
+
+class HTTPTransport(object):
+
+    """Keep-alive HTTP client shared by every request to the model servers.
+
+    Connections are pooled by one aiohttp session, so a burst of requests
+    reuses open sockets instead of setting up a new TCP/TLS connection each.
+    Each endpoint has a semaphore that caps how many requests are in flight
+    on it; the rest wait their turn here instead of piling up on the server.
+    Idempotent requests are retried with full-jitter exponential backoff on
+    timeouts, dropped connections and 429/502/503/504 responses. Other
+    requests are only retried when the connection could not be made at all,
+    since then the server never saw them.
+    """
+
+    def __init__(self, max_connections=32, max_concurrent=8, connect_timeout=5.0, read_timeout=120.0, keepalive_timeout=60.0, retries=2, backoff=0.25, max_backoff=4.0):
+        if max_concurrent <= 0:
+            raise ValueError('Transport concurrency should be > 0')
+
+        self.max_connections = max_connections
+        self.max_concurrent = max_concurrent
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.session = None
+        self.semaphores = {} # {endpoint: asyncio.Semaphore}
+        self.endpoint_stats = {} # {endpoint: {requests, retries, failures, in_flight, waited}}
+
+    def _session(self):
+        # created on first use, so it belongs to the loop the requests run on
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=self.keepalive_timeout),
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+            )
+        return self.session
+
+    def _stats(self, endpoint):
+        if endpoint not in self.endpoint_stats:
+            self.endpoint_stats[endpoint] = {'requests': 0, 'retries': 0, 'failures': 0, 'in_flight': 0, 'waited': 0.0}
+        return self.endpoint_stats[endpoint]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, endpoint):
+        """Hold one of the endpoint's concurrency slots."""
+        if endpoint not in self.semaphores:
+            self.semaphores[endpoint] = asyncio.Semaphore(self.max_concurrent)
+        stats = self._stats(endpoint)
+        started = time.monotonic()
+        async with self.semaphores[endpoint]:
+            stats['waited'] += time.monotonic() - started
+            stats['in_flight'] += 1
+            try:
+                yield
+            finally:
+                stats['in_flight'] -= 1
+
+    def delay(self, attempt):
+        return random.uniform(0.0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    async def post(self, endpoint, path, payload, headers=None, idempotent=False, read_timeout=None):
+        """POST payload as JSON and return (status, decoded JSON body). A
+        body that isn't JSON is returned as text.
+        """
+        stats = self._stats(endpoint)
+        timeout = None
+        if read_timeout is not None:
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout, sock_read=read_timeout)
+        attempt = 0
+        while True:
+            stats['requests'] += 1
+            try:
+                async with self.slot(endpoint):
+                    async with self._session().post(f'{endpoint}{path}', json=payload, headers=headers, timeout=timeout) as response:
+                        status = response.status
+                        body = await response.read()
+                if status not in RETRY_STATUSES or not idempotent or attempt >= self.retries:
+                    return status, decode(body)
+                logger.warning(f'{endpoint}{path} returned {status}, retrying...')
+            except aiohttp.ClientConnectorError as e:
+                # never reached the server, safe to send again
+                if attempt >= self.retries:
+                    stats['failures'] += 1
+                    raise
+                logger.warning(f'Could not connect to {endpoint}, retrying: {e}')
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not idempotent or attempt >= self.retries:
+                    stats['failures'] += 1
+                    raise
+                logger.warning(f'{endpoint}{path} failed, retrying: {e!r}')
+            stats['retries'] += 1
+            await asyncio.sleep(self.delay(attempt))
+            attempt += 1
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+    def stats(self):
+        return {endpoint: dict(stats) for endpoint, stats in self.endpoint_stats.items()}
@@ -0,0 +1,117 @@
+import json
+import difflib
+import collections
+
+from .logging import get_logger
+from .utils import atomic_write
+
+logger = get_logger(__name__)
+
+
+class TweetBuffer(object):
+
+    """Tweets generated ahead of time for the scheduled posts.
+
+    refill() asks generate(n) for a batch of n candidates whenever fewer
+    than min_buffered are left. Candidates that are empty, too long, carry
+    links or mentions, or are too close to a buffered or recently posted
+    tweet are thrown away; the rest are ranked so finished sentences of a
+    reasonable length go first. The buffer and the recent posts are saved
+    to filename, so a restart neither loses them nor repeats itself.
+    """
+
+    def __init__(self, generate, batch_size=4, min_buffered=2, max_buffered=8, recent_size=50, similarity=0.8, max_length=280, filename=None):
+        self.generate = generate
+        self.batch_size = batch_size
+        self.min_buffered = min_buffered
+        self.max_buffered = max_buffered
+        self.similarity = similarity
+        self.max_length = max_length
+        self.filename = filename
+
+        self.buffer = []
+        self.recent = collections.deque(maxlen=recent_size)
+
+        self.generated = 0
+        self.rejected = 0
+        self.posted_count = 0
+
+        if self.filename is not None:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as fp:
+                data = json.load(fp)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            logger.error(f'Failed to load tweet buffer from {self.filename}: {e}')
+            return
+        self.buffer = data.get('buffer', [])
+        self.recent.extend(data.get('recent', []))
+        logger.info(f'Loaded {len(self.buffer)} buffered tweets from {self.filename}')
+
+    def save(self):
+        if self.filename is None:
+            return
+        try:
+            atomic_write(self.filename, json.dumps({'buffer': self.buffer, 'recent': list(self.recent)}))
+        except Exception as e:
+            logger.error(f'Failed to save tweet buffer to {self.filename}: {e}')
+
+    def similar(self, text):
+        for other in list(self.buffer) + list(self.recent):
+            matcher = difflib.SequenceMatcher(None, text, other)
+            if matcher.real_quick_ratio() >= self.similarity and matcher.quick_ratio() >= self.similarity and matcher.ratio() >= self.similarity:
+                return True
+        return False
+
+    def acceptable(self, text):
+        if not text or len(text) > self.max_length:
+            return False
+        if '@' in text or 'http' in text:
+            return False
+        return not self.similar(text)
+
+    def rank(self, text):
+        # finished sentences first, then longer ones up to a point
+        return (text.endswith(('.', '!', '?', '"', "'")), min(len(text), 200))
+
+    async def refill(self):
+        if len(self.buffer) >= self.min_buffered:
+            return
+        while len(self.buffer) < self.max_buffered:
+            candidates = await self.generate(self.batch_size)
+            self.generated += len(candidates)
+            accepted = 0
+            for text in sorted((text.strip() for text in candidates), key=self.rank, reverse=True):
+                if self.acceptable(text):
+                    self.buffer.append(text)
+                    accepted += 1
+                else:
+                    self.rejected += 1
+            logger.info(f'Generated tweets - Candidates: {len(candidates)} - Accepted: {accepted} - Buffered: {len(self.buffer)}')
+            if not accepted:
+                # don't spin on a model that only repeats itself
+                break
+        self.buffer.sort(key=self.rank, reverse=True)
+        self.save()
+
+    def pop(self):
+        if not self.buffer:
+            return None
+        return self.buffer.pop(0)
+
+    def posted(self, text):
+        self.recent.append(text)
+        self.posted_count += 1
+        self.save()
+
+    def stats(self):
+        return {
+            'buffered': len(self.buffer),
+            'generated': self.generated,
+            'rejected': self.rejected,
+            'posted': self.posted_count,
+        }
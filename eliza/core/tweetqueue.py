@@ -0,0 +1,168 @@
+import time
+import threading
+import traceback
+import collections
+
+from .logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class QueuedTweet(object):
+    __slots__ = ('item', 'key', 'queued_at', 'taken')
+
+    def __init__(self, item, key):
+        self.item = item
+        self.key = key
+        self.queued_at = time.monotonic()
+        self.taken = False
+
+
+class TweetWorkerPool(object):
+
+    """Bounded queue of tweets worked off by a pool of threads.
+
+    submit() never blocks, so the streaming thread only hands tweets over.
+    Tweets with the same key (the conversation id) are handled one at a
+    time in the order they came in, while different conversations run in
+    parallel. When max_queued tweets are waiting, policy decides what gives:
+    'drop_new' rejects the incoming tweet and 'drop_oldest' sheds the one
+    that has waited longest, which is the least likely to still be worth a
+    reply. handler(item, waited) is called with the seconds the tweet spent
+    in the queue.
+    """
+
+    policies = ('drop_new', 'drop_oldest')
+
+    def __init__(self, handler, workers=4, max_queued=256, policy='drop_oldest', window=1024):
+        if workers <= 0:
+            raise ValueError('Tweet worker count should be > 0')
+        if policy not in self.policies:
+            raise ValueError(f'Unknown queue policy: {policy}')
+
+        self.handler = handler
+        self.max_queued = max_queued
+        self.policy = policy
+
+        self.queues = {} # {key: deque of QueuedTweet}
+        self.ready = collections.deque() # keys with tweets waiting and none being handled
+        self.active = set() # keys being handled
+        self.order = collections.deque() # every QueuedTweet in arrival order, for shedding
+        self.size = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.shed = 0
+        self.waits = collections.deque(maxlen=window)
+
+        self.threads = [threading.Thread(target=self._worker, name=f'tweets-{index}', daemon=True) for index in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, item, key):
+        """Queue item and return False if it was dropped."""
+        with self.cond:
+            if self.closed:
+                self.dropped += 1
+                return False
+            if self.size >= self.max_queued:
+                if self.policy == 'drop_new' or not self._shed():
+                    self.dropped += 1
+                    logger.warning(f'Tweet queue is full, dropped a tweet - Queued: {self.size}')
+                    return False
+            queued = QueuedTweet(item, key)
+            self.queues.setdefault(key, collections.deque()).append(queued)
+            self.order.append(queued)
+            self.size += 1
+            if key not in self.active and len(self.queues[key]) == 1:
+                self.ready.append(key)
+                self.cond.notify()
+            return True
+
+    def _shed(self):
+        while self.order:
+            queued = self.order.popleft()
+            if queued.taken:
+                continue
+            self.queues[queued.key].remove(queued)
+            if not self.queues[queued.key]:
+                del self.queues[queued.key]
+                if queued.key in self.ready:
+                    self.ready.remove(queued.key)
+            self.size -= 1
+            self.shed += 1
+            logger.warning(f'Tweet queue is full, shed a tweet that waited {time.monotonic() - queued.queued_at:.2f}s')
+            return True
+        return False
+
+    def _take(self):
+        with self.cond:
+            while not self.ready:
+                if self.closed and not self.size:
+                    return None
+                self.cond.wait()
+            key = self.ready.popleft()
+            queued = self.queues[key].popleft()
+            queued.taken = True
+            self.active.add(key)
+            self.size -= 1
+            while self.order and self.order[0].taken:
+                self.order.popleft()
+            return queued
+
+    def _done(self, key):
+        with self.cond:
+            self.active.discard(key)
+            if self.queues.get(key):
+                # the conversation's next tweet can go now
+                self.ready.append(key)
+                self.cond.notify()
+            else:
+                self.queues.pop(key, None)
+            if self.closed and not self.size:
+                self.cond.notify_all()
+
+    def _worker(self):
+        while True:
+            queued = self._take()
+            if queued is None:
+                return
+            waited = time.monotonic() - queued.queued_at
+            self.waits.append(waited)
+            try:
+                self.handler(queued.item, waited)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                logger.error(traceback.format_exc())
+            finally:
+                self._done(queued.key)
+
+    def close(self, timeout=30.0):
+        """Stop taking tweets and give the queued ones timeout seconds."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        if self.size:
+            logger.warning(f'Tweet queue stopped with {self.size} tweets left')
+        logger.info(f'Tweet queue stopped - {self.stats()}')
+
+    def stats(self):
+        waits = sorted(self.waits)
+        return {
+            'queued': self.size,
+            'active': len(self.active),
+            'processed': self.processed,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'shed': self.shed,
+            'wait_avg': sum(waits) / len(waits) if waits else 0.0,
+            'wait_p95': waits[min(len(waits) - 1, int(0.95 * len(waits)))] if waits else 0.0,
+            'wait_max': waits[-1] if waits else 0.0,
+        }
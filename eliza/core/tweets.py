@@ -0,0 +1,144 @@
+import threading
+import collections
+
+from .logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class CachedTweet(object):
+    __slots__ = ('author', 'text', 'parents')
+
+    def __init__(self, author, text, parents):
+        self.author = author
+        self.text = text
+        self.parents = parents # ids of the referenced tweets
+
+
+class ConversationResolver(object):
+
+    """Resolves the thread above a tweet with as few API calls as possible.
+
+    Tweets are kept in an LRU cache by id with their author, text and the
+    ids they reference. Resolving walks up the thread without recursion and
+    fetches every id it is missing in one get_tweets call (up to batch_size
+    per call). The referenced tweets come back as includes in the same
+    response, so each call climbs two levels. A new reply in a thread that
+    was seen before costs a single lookup for the reply itself. Tweets that
+    can't be fetched (deleted, protected) are left out of the conversation.
+    """
+
+    expansions = ['referenced_tweets.id', 'author_id', 'referenced_tweets.id.author_id']
+    tweet_fields = ['referenced_tweets', 'author_id']
+    user_fields = ['name']
+
+    def __init__(self, client_api, max_entries=4096, batch_size=100, max_depth=64):
+        self.client_api = client_api
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+        self.max_depth = max_depth
+
+        self.tweets = collections.OrderedDict() # {tweet_id: CachedTweet or None if unavailable}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.calls = 0
+
+    def add(self, tweet_id, author, text, parents=()):
+        with self._lock:
+            self._put(tweet_id, CachedTweet(author, text, list(parents)))
+
+    def _put(self, tweet_id, tweet):
+        self.tweets[tweet_id] = tweet
+        self.tweets.move_to_end(tweet_id)
+        while len(self.tweets) > self.max_entries:
+            self.tweets.popitem(last=False)
+
+    def _get(self, tweet_id):
+        with self._lock:
+            if tweet_id not in self.tweets:
+                return False
+            self.tweets.move_to_end(tweet_id)
+            return self.tweets[tweet_id]
+
+    def fetch(self, ids):
+        response = self.client_api.get_tweets(
+            ids=ids,
+            expansions=self.expansions,
+            tweet_fields=self.tweet_fields,
+            user_fields=self.user_fields
+        )
+        self.calls += 1
+        includes = response.includes or {}
+        users = {user.id: user.name for user in includes.get('users', [])}
+        found = {}
+        for tweet in list(response.data or []) + list(includes.get('tweets', [])):
+            parents = [reference.id for reference in (tweet.referenced_tweets or [])]
+            found[tweet.id] = CachedTweet(users.get(tweet.author_id, 'Unknown'), tweet.text, parents)
+        with self._lock:
+            for tweet_id, tweet in found.items():
+                self._put(tweet_id, tweet)
+            for tweet_id in ids:
+                if tweet_id not in found:
+                    self._put(tweet_id, None)
+
+    def _missing(self, tweet_id):
+        # ids in the thread above tweet_id that aren't cached yet
+        missing = []
+        seen = set()
+        stack = [(tweet_id, 0)]
+        while stack:
+            current, depth = stack.pop()
+            if current in seen or depth > self.max_depth:
+                continue
+            seen.add(current)
+            tweet = self._get(current)
+            if tweet is False:
+                missing.append(current)
+            elif tweet is not None:
+                stack.extend((parent, depth + 1) for parent in tweet.parents)
+        return missing
+
+    def resolve(self, tweet_id):
+        """Return the conversation ending at tweet_id as 'author: text'
+        lines, oldest first.
+        """
+        fetched = 0
+        while True:
+            missing = self._missing(tweet_id)
+            if not missing:
+                break
+            fetched += len(missing)
+            for start in range(0, len(missing), self.batch_size):
+                self.fetch(missing[start:start + self.batch_size])
+        self.misses += fetched
+
+        # same order as the old recursion: the referenced tweets' threads,
+        # last reference first, then the tweet itself
+        conversation = []
+        seen = set()
+        stack = [(tweet_id, 0, False)]
+        while stack:
+            current, depth, expanded = stack.pop()
+            tweet = self._get(current)
+            if not tweet:
+                continue
+            if expanded:
+                conversation.append(f'{tweet.author}: {tweet.text}')
+                continue
+            if current in seen or depth > self.max_depth:
+                continue
+            seen.add(current)
+            stack.append((current, depth, True))
+            stack.extend((parent, depth + 1, False) for parent in tweet.parents)
+        self.hits += max(0, len(conversation) - fetched)
+        return conversation
+
+    def stats(self):
+        return {
+            'entries': len(self.tweets),
+            'hits': self.hits,
+            'misses': self.misses,
+            'calls': self.calls,
+        }
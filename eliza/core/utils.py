@@ -1,27 +1,27 @@
+import os
 import re
+import tempfile
 from difflib import SequenceMatcher
 from typing import List
 from discord import Emoji, User
 
-# funky globals
-supporter_guild = None
-supporter_roles = None
-
-def set_guild(guild):
-    global supporter_guild
-    supporter_guild = guild
-
-def get_guild():
-    global supporter_guild
-    return supporter_guild
-
-def set_roles(roles):
-    global supporter_roles
-    supporter_roles = roles
-
-def get_roles():
-    global supporter_roles
-    return supporter_roles
+def atomic_write(filename, data):
+    # write to a temporary file next to the target and rename it over the
+    # target, so readers see either the old or the new file, never half of one
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, filename)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
 
 def anti_spam(messages, threshold=0.8):
     to_remove = []
@@ -85,3 +85,14 @@ def cut_trailing_sentence(text):
     text = text[: last_punc + 1]
     text = fix_trailing_quotes(text)
     return text
+
+def complete_sentences(text):
+    # like cut_trailing_sentence, but empty until a sentence has been finished
+    text = standardize_punctuation(text)
+    last_punc = max(text.rfind("."), text.rfind("!"), text.rfind("?"), text.rfind(".\""), text.rfind("!\""), text.rfind("?\""), text.rfind(".\'"), text.rfind("!\'"), text.rfind("?\'"))
+    et_token = text.find("<")
+    if et_token > 0:
+        last_punc = min(last_punc, et_token - 1)
+    if last_punc <= 0:
+        return ''
+    return fix_trailing_quotes(text[: last_punc + 1])
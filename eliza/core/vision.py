@@ -0,0 +1,96 @@
+import os
+import heapq
+
+from .logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class LabelSet(object):
+    def __init__(self, name, filename, prefix, suffix, requires=None):
+        self.name = name
+        self.requires = requires # {'set': name, 'any': [labels], 'not': [labels]}
+        with open(filename) as f:
+            loaded_labels = f.read().split('\n')
+        self.prompts = [f'{prefix}{p}{suffix}' for p in loaded_labels]
+        self.raw = dict(zip(self.prompts, loaded_labels)) # {prompt: label}
+
+    def allowed(self, best):
+        """Whether this set should be scored, given the best raw label of
+        every set scored so far.
+        """
+        if self.requires is None:
+            return True
+        label = best.get(self.requires['set'])
+        if label is None:
+            return False
+        if 'any' in self.requires and label not in self.requires['any']:
+            return False
+        if 'not' in self.requires and label in self.requires['not']:
+            return False
+        return True
+
+
+class ImageLabeler(object):
+
+    """Scores an image against the configured label sets in stages.
+
+    Sets without a 'requires' rule are scored first. A gated set is only
+    sent to the model once the set it depends on has been scored and its
+    best label passes the rule, e.g. Touhou characters only when the people
+    count isn't 'are no people'. Without any rules this is a single call
+    over every set, same as before.
+    """
+
+    def __init__(self, text_sets):
+        self.sets = []
+        for text_set in text_sets:
+            name = text_set.get('name', os.path.splitext(os.path.basename(text_set['filename']))[0])
+            self.sets.append(LabelSet(
+                name=name,
+                filename=text_set['filename'],
+                prefix=text_set['prefix'],
+                suffix=text_set['suffix'],
+                requires=text_set.get('requires', None)
+            ))
+
+        names = set(label_set.name for label_set in self.sets)
+        for label_set in self.sets:
+            if label_set.requires is not None and label_set.requires['set'] not in names:
+                raise Exception(f'Label set {label_set.name} requires unknown label set {label_set.requires["set"]}')
+
+    @property
+    def labels(self):
+        return [label_set.prompts for label_set in self.sets]
+
+    async def label(self, model_provider, model, url):
+        """Return {'labels': [{prompt: score}, ...]} for every set that was
+        scored, in the same shape as image_label_async.
+        """
+        results = []
+        best = {} # {set name: best raw label}
+        done = []
+        while True:
+            # a stage is every set whose rule can be decided from what was scored so far
+            stage = [label_set for label_set in self.sets if label_set not in done and label_set.allowed(best)]
+            if not stage:
+                break
+            done.extend(stage)
+
+            clip_labels = await model_provider.image_label_async(model, url, [label_set.prompts for label_set in stage])
+            for label_set, scores in zip(stage, clip_labels['labels']):
+                results.append(scores)
+                if scores:
+                    top = max(scores.items(), key=lambda x: x[1])[0]
+                    best[label_set.name] = label_set.raw.get(top, top)
+
+        scored = sum(len(scores) for scores in results)
+        total = sum(len(label_set.prompts) for label_set in self.sets)
+        logger.info(f'Labeled image - Scored labels: {scored}/{total}')
+        return {'labels': results}
+
+
+def top_labels(clip_labels, top_k):
+    # the best label of each set, for the top_k sets with the most confident best label
+    best = [max(scores.items(), key=lambda x: x[1]) for scores in clip_labels['labels'] if scores]
+    return [label for label, _ in heapq.nlargest(top_k, best, key=lambda x: x[1])]
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the app runs as python eliza, so its modules import each other as core.x and client.x
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'eliza'))
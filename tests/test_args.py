@@ -0,0 +1,43 @@
+import pytest
+
+model_provider = pytest.importorskip('shimeji.model_provider')
+
+from core.args import get_model_provider
+
+
+def persona(temp, endpoint='http://localhost:8000'):
+    return {'model_provider': {
+        'name': 'sukima',
+        'endpoint': endpoint,
+        'username': 'eliza',
+        'password': 'secret',
+        'gensettings': {'model': 'c1-6B', 'gen_args': {'max_length': 40}, 'sample_args': {'temp': temp}},
+    }}
+
+
+@pytest.fixture(autouse=True)
+def offline(monkeypatch):
+    # no model server to log in to
+    def auth(self):
+        self.token = 'token'
+    monkeypatch.setattr(model_provider.Sukima_ModelProvider, 'auth', auth)
+
+
+def test_personas_on_one_endpoint_share_a_pool():
+    shared = {}
+    reimu = get_model_provider(persona(0.7), shared=shared)
+    sakuya = get_model_provider(persona(0.9), shared=shared)
+    assert reimu.transport is sakuya.transport
+    assert reimu.balancer is sakuya.balancer
+    assert len(shared) == 1
+    # each keeps its own gensettings
+    assert reimu.response_args.sample_args.temp == 0.7
+    assert sakuya.response_args.sample_args.temp == 0.9
+
+
+def test_other_endpoints_get_their_own_pool():
+    shared = {}
+    reimu = get_model_provider(persona(0.7), shared=shared)
+    chen = get_model_provider(persona(0.7, endpoint='http://localhost:8001'), shared=shared)
+    assert reimu.transport is not chen.transport
+    assert len(shared) == 2
@@ -0,0 +1,73 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from core.batching import HiddenBatcher
+from core.stub import Stub_ModelProvider
+
+
+class SingleOnly(object):
+    # a provider without hidden_batch_async, like Sukima
+    def __init__(self):
+        self.stub = Stub_ModelProvider(dimensions=8)
+
+    async def hidden_async(self, model, text, layer=-1):
+        return await self.stub.hidden_async(model, text, layer=layer)
+
+
+class Failing(object):
+    async def hidden_batch_async(self, model, texts, layer=-1):
+        raise RuntimeError('model server is down')
+
+
+def test_batch_is_one_request():
+    stub = Stub_ModelProvider(dimensions=8)
+    batcher = HiddenBatcher(stub, max_batch_size=16)
+
+    vectors = asyncio.run(batcher.hidden_batch_async('model', [f'text {i}' for i in range(5)]))
+    assert stub.calls == {'hidden_batch': 1}
+    for i, vector in enumerate(vectors):
+        assert np.array_equal(vector, stub.hidden('model', f'text {i}'))
+    assert batcher.stats()['avg_batch_size'] == 5
+
+
+def test_large_batches_are_split():
+    stub = Stub_ModelProvider(dimensions=8)
+    batcher = HiddenBatcher(stub, max_batch_size=8)
+
+    vectors = asyncio.run(batcher.hidden_batch_async('model', [f'text {i}' for i in range(20)]))
+    assert stub.calls == {'hidden_batch': 3}
+    assert len(vectors) == 20
+    # in the order they were given
+    assert np.array_equal(vectors[19], stub.hidden('model', 'text 19'))
+
+
+def test_single_calls_are_passed_through():
+    stub = Stub_ModelProvider(dimensions=8)
+    batcher = HiddenBatcher(stub)
+
+    vector = asyncio.run(batcher.hidden_async('model', 'single', layer=-2))
+    assert stub.calls == {'hidden': 1}
+    assert np.array_equal(vector, stub.hidden('model', 'single'))
+
+
+def test_providers_without_batch_calls_get_single_requests():
+    provider = SingleOnly()
+    batcher = HiddenBatcher(provider, max_batch_size=16)
+
+    vectors = asyncio.run(batcher.hidden_batch_async('model', [f'text {i}' for i in range(4)]))
+    assert provider.stub.calls == {'hidden': 4}
+    assert np.array_equal(vectors[3], provider.stub.hidden('model', 'text 3'))
+
+
+def test_errors_reach_the_caller():
+    batcher = HiddenBatcher(Failing(), max_batch_size=16)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(batcher.hidden_batch_async('model', ['one', 'two']))
+
+
+def test_invalid_settings():
+    with pytest.raises(ValueError):
+        HiddenBatcher(Stub_ModelProvider(), max_batch_size=0)
@@ -0,0 +1,71 @@
+import asyncio
+import datetime
+from types import SimpleNamespace
+
+from core.idle import IdleScheduler
+
+
+def message(message_id, channel_id):
+    created_at = datetime.datetime.now(datetime.timezone.utc)
+    return SimpleNamespace(id=message_id, channel=SimpleNamespace(id=channel_id), created_at=created_at)
+
+
+class Callback(object):
+    # answers with the queued results in turn, an exception is raised
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = []
+
+    async def __call__(self, message):
+        self.calls.append(message.id)
+        result = self.results.pop(0) if self.results else True
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def run(scheduler, *messages, wait=0.1):
+    async def main():
+        scheduler.start()
+        for m in messages:
+            scheduler.touch(m, False)
+        await asyncio.sleep(wait)
+        scheduler.stop()
+    asyncio.run(main())
+
+
+def test_skipped_idle_message_is_tried_again():
+    callback = Callback(False, True)
+    scheduler = IdleScheduler(callback, 0.01, retry_delay=0.01)
+    run(scheduler, message(1, 10))
+    assert callback.calls == [1, 1]
+    assert scheduler.retried == 1
+
+
+def test_failed_idle_message_is_tried_again():
+    callback = Callback(RuntimeError('model server down'), True)
+    scheduler = IdleScheduler(callback, 0.01, retry_delay=0.01)
+    run(scheduler, message(1, 10))
+    assert callback.calls == [1, 1]
+    assert scheduler.failed == 1
+
+
+def test_no_retry_once_someone_spoke():
+    callback = Callback()
+    scheduler = IdleScheduler(callback, 0.01, retry_delay=0.01)
+
+    async def main():
+        scheduler.start()
+        first = message(1, 10)
+        scheduler.touch(first, False)
+        await asyncio.sleep(0.03)
+        # the bot replied, then the turn reports a failure
+        scheduler.touch(message(2, 10), True)
+        scheduler.retry(first)
+        await asyncio.sleep(0.05)
+        scheduler.stop()
+
+    asyncio.run(main())
+    assert callback.calls == [1]
+    assert scheduler.retried == 0
+    assert scheduler.last == {}
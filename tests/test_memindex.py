@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('shimeji')
+
+from core.memindex import MemoryIndex, IndexedMemory
+
+
+class MemoryStore(object):
+    # stands in for the database that every shard worker reads
+    def __init__(self):
+        self.memories = []
+
+    async def get(self):
+        return list(self.memories)
+
+
+def test_refresh_picks_up_memories_written_elsewhere():
+    store = MemoryStore()
+    store.memories.append(IndexedMemory(0, 'user0', 'first', 'model', '1 0 0 0'))
+    index = MemoryIndex('model', refresh_interval=0.0)
+
+    async def run():
+        await index.warm(store)
+        # another worker stores a memory, this index never sees it go through add()
+        store.memories.append(IndexedMemory(1, 'user1', 'second', 'model', '0 1 0 0'))
+        await index.refresh(store)
+
+    asyncio.run(run())
+    assert [m.text for m in index.memories] == ['first', 'second']
+    assert index.refreshes == 1
+
+
+def test_refresh_waits_for_the_interval():
+    store = MemoryStore()
+    index = MemoryIndex('model', refresh_interval=3600.0)
+
+    async def run():
+        await index.warm(store)
+        store.memories.append(IndexedMemory(1, 'user1', 'second', 'model', '1 0 0 0'))
+        await index.refresh(store)
+
+    asyncio.run(run())
+    assert len(index) == 0
+    assert index.refreshes == 0
+
+
+def test_memories_added_during_a_refresh_are_kept():
+    store = MemoryStore()
+    index = MemoryIndex('model', refresh_interval=0.0)
+    added = IndexedMemory(2, 'user2', 'added', 'model', '0 1 0 0')
+
+    async def run():
+        await index.warm(store)
+        store.memories.append(IndexedMemory(1, 'user1', 'stored', 'model', '1 0 0 0'))
+        original_get = store.get
+
+        async def get():
+            # ingested while the store is being read, and not in what it returns
+            index.add(added)
+            return await original_get()
+        store.get = get
+        await index.refresh(store)
+
+    asyncio.run(run())
+    assert sorted(m.text for m in index.memories) == ['added', 'stored']
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('shimeji')
+
+from core.batching import HiddenBatcher
+from core.memqueue import MemoryIngestQueue
+from core.stub import Stub_ModelProvider
+
+
+class MemoryStore(object):
+    # keeps memories in a list, duplicates are exact matches
+    def __init__(self):
+        self.memories = []
+
+    async def check_duplicates(self, text, duplicate_ratio):
+        return any(memory['text'] == text for memory in self.memories)
+
+    async def add(self, author_id, author, text, encoding_model, encoding):
+        self.memories.append({'author_id': author_id, 'author': author, 'text': text})
+
+
+mem_args = {'model': 'model', 'model_layer': -1}
+
+
+def test_waiting_memories_are_encoded_together():
+    stub = Stub_ModelProvider(dimensions=8, latency=0.01)
+    store = MemoryStore()
+    memory_queue = MemoryIngestQueue(store, HiddenBatcher(stub, max_batch_size=16), mem_args, workers=2, batch_size=16)
+
+    async def run():
+        for i in range(20):
+            await memory_queue.submit(author_id=i, author=f'user{i}', text=f'memory {i}', encode_text=f'user{i}: memory {i}')
+        await memory_queue.close()
+
+    asyncio.run(run())
+    assert len(store.memories) == 20
+    assert memory_queue.stats()['ingested'] == 20
+    # two workers of up to 16 items, instead of one request per memory
+    assert stub.calls['hidden_batch'] <= 4
+
+
+def test_duplicates_are_not_encoded():
+    stub = Stub_ModelProvider(dimensions=8)
+    store = MemoryStore()
+    store.memories.append({'author_id': 0, 'author': 'user0', 'text': 'hello'})
+    memory_queue = MemoryIngestQueue(store, HiddenBatcher(stub), mem_args, workers=1)
+
+    async def run():
+        await memory_queue.submit(author_id=0, author='user0', text='hello', encode_text='user0: hello')
+        await memory_queue.close()
+
+    asyncio.run(run())
+    assert memory_queue.stats()['duplicates'] == 1
+    assert stub.calls == {}
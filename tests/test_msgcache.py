@@ -0,0 +1,61 @@
+import asyncio
+from types import SimpleNamespace
+
+from core.msgcache import MessageCache
+
+
+class History(object):
+    def __init__(self, messages):
+        self.messages = messages
+
+    async def flatten(self):
+        return list(self.messages)
+
+
+class Channel(object):
+    # hands back its messages newest first, like channel.history() does
+    def __init__(self, channel_id, messages):
+        self.id = channel_id
+        self.messages = messages
+        self.fetches = 0
+
+    def history(self, limit=None):
+        self.fetches += 1
+        return History(list(reversed(self.messages))[:limit])
+
+
+def message(message_id, channel):
+    return SimpleNamespace(id=message_id, channel=channel)
+
+
+def test_channel_is_fetched_once():
+    channel = Channel(1, [])
+    channel.messages = [message(i, channel) for i in range(5)]
+    cache = MessageCache(10)
+
+    async def run():
+        first = await cache.history(channel, limit=3)
+        cache.append(message(5, channel))
+        second = await cache.history(channel, limit=3)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert [m.id for m in first] == [4, 3, 2]
+    assert [m.id for m in second] == [5, 4, 3]
+    assert channel.fetches == 1
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_locks_are_not_kept_for_warm_or_evicted_channels():
+    cache = MessageCache(10)
+    channels = [Channel(i, []) for i in range(100)]
+
+    async def run():
+        await asyncio.gather(*[cache.history(channel) for channel in channels])
+        for channel in channels:
+            cache.evict(channel.id)
+
+    asyncio.run(run())
+    assert cache._locks == {}
+    assert cache.channels == {}
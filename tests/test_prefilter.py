@@ -0,0 +1,20 @@
+import json
+
+from core.prefilter import ResponsePrefilter
+
+
+def test_decision_is_logged_with_the_context_it_was_made_on(tmp_path):
+    log_file = tmp_path / 'decisions.jsonl'
+    prefilter = ResponsePrefilter(log_file=str(log_file))
+    prefilter.observe(1, False)
+    predicted, reason, score, context = prefilter.decide('hello there', 1)
+    # the bot answers elsewhere in the channel while the model is asked
+    prefilter.observe(1, True)
+    prefilter.observe(1, False)
+    prefilter.record('hello there', context, predicted, score, True)
+    prefilter.close()
+
+    row = json.loads(log_file.read_text(encoding='utf-8'))
+    assert row['since_bot'] is None
+    assert row['rate'] == 1
+    assert row['responded'] is True
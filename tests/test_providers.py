@@ -0,0 +1,74 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+model_provider = pytest.importorskip('shimeji.model_provider')
+
+from core.providers import PooledSukima_ModelProvider
+
+
+@pytest.fixture
+def provider(monkeypatch):
+    def auth(self):
+        self.token = 'token'
+    monkeypatch.setattr(model_provider.Sukima_ModelProvider, 'auth', auth)
+    provider = PooledSukima_ModelProvider(
+        ['http://a', 'http://b'],
+        username='eliza',
+        password='secret',
+        args=SimpleNamespace(prompt='', gen_args=SimpleNamespace(max_length=40, min_length=None, eos_token_id=None)),
+        hedge=True,
+        hedge_min_samples=5
+    )
+
+    provider.payloads = []
+
+    async def send(endpoint, path, payload, idempotent):
+        provider.payloads.append(payload)
+        # a generation takes about a millisecond per token
+        await asyncio.sleep(payload['gen_args']['max_length'] * 0.001)
+        return {'output': payload['prompt'] + ' yes'}
+    provider._send = send
+    return provider
+
+
+def request(max_length):
+    return SimpleNamespace(prompt='Hi', gen_args=SimpleNamespace(max_length=max_length))
+
+
+def test_short_generations_dont_lower_the_reply_deadline(provider):
+    async def run():
+        # should_respond style calls far outnumber the replies
+        for _ in range(40):
+            await provider.generate_async(request(2))
+        for _ in range(5):
+            await provider.generate_async(request(40))
+
+    asyncio.run(run())
+    assert provider.hedge_deadline(('generate', 40)) >= 0.04
+    assert provider.hedge_deadline(('generate', 2)) < 0.04
+    assert provider.hedged == 0
+
+
+def test_streamed_chunks_have_their_own_deadline(provider):
+    async def run():
+        for _ in range(5):
+            await provider.generate_async(request(40))
+        for _ in range(10):
+            await provider.generate_async(request(2))
+        return [chunk async for chunk in provider.response_stream_async('Hi', chunk_length=8)]
+
+    assert asyncio.run(run())
+    assert ('stream', 8) in provider.latencies
+    assert provider.hedge_deadline(('generate', 40)) >= 0.04
+
+
+def test_streaming_keeps_the_configured_eos(provider):
+    provider.response_args.gen_args.eos_token_id = 50256
+
+    async def run():
+        return [chunk async for chunk in provider.response_stream_async('Hi', chunk_length=8)]
+
+    asyncio.run(run())
+    assert {payload['gen_args']['eos_token_id'] for payload in provider.payloads} == {50256}
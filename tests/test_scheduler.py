@@ -0,0 +1,85 @@
+import asyncio
+from types import SimpleNamespace
+
+from core.scheduler import ChannelScheduler
+
+
+def message(message_id, channel_id):
+    return SimpleNamespace(id=message_id, channel=SimpleNamespace(id=channel_id))
+
+
+class Handler(object):
+    # records every turn and holds it until release is set
+    def __init__(self):
+        self.turns = []
+        self.release = asyncio.Event()
+        self.running = 0
+        self.max_running = 0
+
+    async def __call__(self, messages, waited, idle):
+        self.turns.append(([m.id for m, _ in messages], idle))
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await self.release.wait()
+        self.running -= 1
+
+
+def test_idle_turn_is_skipped_while_the_channel_is_busy():
+    async def run():
+        handler = Handler()
+        scheduler = ChannelScheduler(handler)
+        scheduler.submit(message(1, 10), True)
+        await asyncio.sleep(0)
+        queued = scheduler.submit(message(1, 10), idle=True)
+        handler.release.set()
+        await asyncio.sleep(0.01)
+        return queued, handler.turns
+
+    queued, turns = asyncio.run(run())
+    assert queued is False
+    assert turns == [([1], False)]
+
+
+def test_message_before_an_idle_turn_makes_it_a_normal_one():
+    async def run():
+        handler = Handler()
+        handler.release.set()
+        scheduler = ChannelScheduler(handler)
+        scheduler.submit(message(1, 10), idle=True)
+        scheduler.submit(message(2, 10), False)
+        await asyncio.sleep(0.01)
+        return handler.turns
+
+    assert asyncio.run(run()) == [([1, 2], False)]
+
+
+def test_idle_turns_share_the_concurrency_cap():
+    async def run():
+        handler = Handler()
+        scheduler = ChannelScheduler(handler, max_concurrent=2)
+        for channel_id in range(4):
+            scheduler.submit(message(channel_id, channel_id), idle=True)
+        await asyncio.sleep(0.01)
+        running = handler.running
+        handler.release.set()
+        await asyncio.sleep(0.01)
+        return running, handler
+
+    running, handler = asyncio.run(run())
+    assert running == 2
+    assert handler.max_running == 2
+    assert all(idle for _, idle in handler.turns)
+    assert len(handler.turns) == 4
+
+
+def test_stats_are_logged_while_running(caplog):
+    async def run():
+        handler = Handler()
+        handler.release.set()
+        scheduler = ChannelScheduler(handler, report_interval=0.0)
+        scheduler.submit(message(1, 10), True)
+        await asyncio.sleep(0.01)
+
+    with caplog.at_level('INFO', logger='core.scheduler'):
+        asyncio.run(run())
+    assert any('Channel scheduler' in record.message and "'turns': 1" in record.message for record in caplog.records)
@@ -0,0 +1,50 @@
+import asyncio
+
+from core.streaming import StreamingMessage
+
+
+class Channel(object):
+    # records what would have been sent to Discord
+    def __init__(self):
+        self.log = []
+
+    async def send(self, text):
+        self.log.append(('send', text))
+        return Message(self.log)
+
+
+class Message(object):
+    def __init__(self, log):
+        self.log = log
+
+    async def edit(self, content):
+        self.log.append(('edit', content))
+
+
+def test_held_back_edit_is_sent_without_more_text():
+    channel = Channel()
+    streamed = StreamingMessage(channel, edit_interval=0.05)
+
+    async def run():
+        await streamed.update('Hello.')
+        await streamed.update('Hello. How')
+        await streamed.update('Hello. How are you?')
+        # the model stalls, the held back text still goes out
+        await asyncio.sleep(0.2)
+
+    asyncio.run(run())
+    assert channel.log == [('send', 'Hello.'), ('edit', 'Hello. How are you?')]
+    assert streamed.coalesced == 1
+
+
+def test_finish_sends_the_final_text_once():
+    channel = Channel()
+    streamed = StreamingMessage(channel, edit_interval=10.0)
+
+    async def run():
+        await streamed.update('Hello.')
+        await streamed.update('Hello. How')
+        await streamed.finish('Hello. How are you?')
+
+    asyncio.run(run())
+    assert channel.log == [('send', 'Hello.'), ('edit', 'Hello. How are you?')]
@@ -0,0 +1,80 @@
+import asyncio
+
+from aiohttp import web
+
+from core.transport import HTTPTransport
+
+
+async def serve(responses):
+    # a local server that answers with the given (status, body, content type) in order
+    requests = []
+
+    async def handler(request):
+        requests.append(await request.json())
+        status, body, content_type = responses[min(len(requests), len(responses)) - 1]
+        return web.Response(status=status, text=body, content_type=content_type)
+
+    app = web.Application()
+    app.router.add_post('/api/v1/models/hidden', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}', requests
+
+
+html = '<html><body><h1>502 Bad Gateway</h1></body></html>'
+
+
+def test_html_error_pages_are_retried():
+    async def run():
+        runner, endpoint, requests = await serve([
+            (502, html, 'text/html'),
+            (503, html, 'text/html'),
+            (200, '{"-1": [0.5]}', 'application/json'),
+        ])
+        transport = HTTPTransport(retries=2, backoff=0.0)
+        try:
+            result = await transport.post(endpoint, '/api/v1/models/hidden', {'prompt': 'hi'}, idempotent=True)
+        finally:
+            await transport.close()
+            await runner.cleanup()
+        return result, requests, transport.stats()[endpoint]
+
+    (status, data), requests, stats = asyncio.run(run())
+    assert status == 200
+    assert data == {'-1': [0.5]}
+    assert len(requests) == 3
+    assert stats['retries'] == 2
+
+
+def test_html_error_page_is_returned_as_text():
+    async def run():
+        runner, endpoint, requests = await serve([(502, html, 'text/html')])
+        transport = HTTPTransport(retries=2, backoff=0.0)
+        try:
+            result = await transport.post(endpoint, '/api/v1/models/hidden', {'prompt': 'hi'}, idempotent=False)
+        finally:
+            await transport.close()
+            await runner.cleanup()
+        return result, requests
+
+    (status, data), requests = asyncio.run(run())
+    # not idempotent, so not sent again, and the caller gets the status to fail over on
+    assert status == 502
+    assert data == html
+    assert len(requests) == 1
+
+
+def test_json_errors_are_decoded():
+    async def run():
+        runner, endpoint, _ = await serve([(422, '{"detail": "bad request"}', 'application/json')])
+        transport = HTTPTransport(retries=2, backoff=0.0)
+        try:
+            return await transport.post(endpoint, '/api/v1/models/hidden', {'prompt': 'hi'}, idempotent=True)
+        finally:
+            await transport.close()
+            await runner.cleanup()
+
+    assert asyncio.run(run()) == (422, {'detail': 'bad request'})
@@ -0,0 +1,80 @@
+from types import SimpleNamespace
+
+from core.tweets import ConversationResolver
+
+
+class Client(object):
+    # answers get_tweets from a dict of tweets, the way the v2 API does
+    def __init__(self, tweets, users):
+        self.tweets = tweets # {id: (author_id, text, parent id or None)}
+        self.users = users
+        self.calls = []
+
+    def tweet(self, tweet_id):
+        author_id, text, parent = self.tweets[tweet_id]
+        references = [SimpleNamespace(id=parent, type='replied_to')] if parent is not None else None
+        return SimpleNamespace(id=tweet_id, author_id=author_id, text=text, referenced_tweets=references)
+
+    def get_tweets(self, ids, expansions=None, tweet_fields=None, user_fields=None):
+        self.calls.append(list(ids))
+        data = [self.tweet(tweet_id) for tweet_id in ids if tweet_id in self.tweets]
+        # referenced tweets come back as includes
+        parents = [tweet.referenced_tweets[0].id for tweet in data if tweet.referenced_tweets]
+        included = [self.tweet(tweet_id) for tweet_id in parents if tweet_id in self.tweets]
+        authors = {tweet.author_id for tweet in data + included}
+        users = [SimpleNamespace(id=user_id, name=self.users[user_id]) for user_id in authors]
+        return SimpleNamespace(data=data or None, includes={'tweets': included, 'users': users})
+
+
+def thread():
+    tweets = {
+        1: (10, 'first', None),
+        2: (20, 'second', 1),
+        3: (10, 'third', 2),
+        4: (20, 'fourth', 3),
+    }
+    return Client(tweets, {10: 'alice', 20: 'bob'})
+
+
+def test_thread_is_resolved_oldest_first():
+    client = thread()
+    resolver = ConversationResolver(client)
+    assert resolver.resolve(4) == ['alice: first', 'bob: second', 'alice: third', 'bob: fourth']
+    # each call climbs two levels
+    assert len(client.calls) == 2
+
+
+def test_new_reply_costs_one_lookup():
+    client = thread()
+    resolver = ConversationResolver(client)
+    resolver.resolve(4)
+    client.tweets[5] = (10, 'fifth', 4)
+    calls = len(client.calls)
+    assert resolver.resolve(5)[-1] == 'alice: fifth'
+    assert len(client.calls) == calls + 1
+
+
+def test_deleted_tweets_are_left_out():
+    client = thread()
+    del client.tweets[2]
+    resolver = ConversationResolver(client)
+    assert resolver.resolve(4) == ['alice: third', 'bob: fourth']
+
+
+def test_deleted_tweet_resolves_to_nothing():
+    client = thread()
+    resolver = ConversationResolver(client)
+    assert resolver.resolve(99) == []
+    # remembered as unavailable, not fetched again
+    assert resolver.resolve(99) == []
+    assert len(client.calls) == 1
+
+
+def test_own_tweets_are_not_fetched():
+    client = thread()
+    resolver = ConversationResolver(client)
+    resolver.resolve(4)
+    resolver.add(6, 'eliza', 'a reply', [4])
+    calls = len(client.calls)
+    assert resolver.resolve(6)[-1] == 'eliza: a reply'
+    assert len(client.calls) == calls